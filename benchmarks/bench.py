@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+Load test PeonServer with a temporary `create-website` layout.
+
+A throwaway website is created in a temporary directory with a few extra
+static files, a template and a route module using the Validator decorator.
+For every server configuration a server process is forked serving make_app()
+on a random local port, and each scenario is driven by loadgen at every
+concurrency level. RPS and p50/p99/p999 latency are printed and can be
+written as JSON and compared against a previous run:
+
+    python benchmarks/bench.py --output baseline.json
+    python benchmarks/bench.py --baseline baseline.json --threshold 10
+"""
+import io
+import os
+import sys
+import json
+import time
+import socket
+import contextlib
+import logging
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+
+import tornado
+import tornado.netutil
+
+import loadgen
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from peonserver import server
+from peonserver.scripts.create_website import create_website
+
+HOST = "127.0.0.1"
+SEED = 8085
+RESULT_VERSION = 1
+
+ROUTE_MODULE = '''
+import tornado.web
+from peonserver import Validator, EmailValidator
+
+class EmailHandler(tornado.web.RequestHandler):
+
+    @Validator(EmailValidator)
+    def get(self, params, error):
+        self.set_status(400 if error else 200)
+        self.write(params)
+
+class TemplateHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        self.render("bench.html", title="Benchmark", items=list(range(50)))
+
+ROUTES = [
+    (r"/bench/email", EmailHandler),
+    (r"/bench/template", TemplateHandler),
+]
+'''
+
+TEMPLATE = '''<html>
+<head><title>{{ title }}</title></head>
+<body>
+<ul>
+{% for item in items %}  <li class="item-{{ item }}">Item {{ item }}</li>
+{% end %}</ul>
+</body>
+</html>
+'''
+
+GZIP = {"Accept-Encoding": "gzip, deflate, br"}
+
+# name -> (make_app options, path, request headers)
+SCENARIOS = {
+    "index": ({}, "/", {}),
+    "index-page-cache": ({"page_cache": True}, "/", {}),
+    "static-small": ({}, "/static/css/bench.css", {}),
+    "static-small-gzip": ({}, "/static/css/bench.css", GZIP),
+    "static-large": ({}, "/static/js/bench.bin", {}),
+    "template": ({}, "/bench/template", {}),
+    "validator-valid": ({}, "/bench/email?email=peon%40example.com", {}),
+    "validator-invalid": ({}, "/bench/email?email=not-an-email", {}),
+}
+
+
+def make_website(root):
+    """Create the benchmark website under root, the directory must be named `website`"""
+    path = os.path.join(root, "website")
+    with contextlib.redirect_stdout(io.StringIO()):
+        create_website(path)
+    rng = random.Random(SEED)
+    with open(os.path.join(path, "static", "css", "bench.css"), 'w') as f:
+        for i in range(400):
+            f.write(f".bench-{i} {{ margin: {i % 16}px; color: #{rng.randrange(0xffffff):06x}; }}\n")
+    with open(os.path.join(path, "static", "js", "bench.bin"), 'wb') as f:
+        f.write(bytes(rng.getrandbits(8) for _ in range(2 * 1024 * 1024)))
+    with open(os.path.join(path, "html", "bench.html"), 'w') as f:
+        f.write(TEMPLATE)
+    with open(os.path.join(path, "routes", "bench_routes.py"), 'w') as f:
+        f.write(ROUTE_MODULE)
+    return path
+
+def serve_process(sockets, website, options):
+    # Keep the expected 400s and startup chatter out of the results table
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.ERROR)
+    logging.getLogger().addHandler(handler)
+    asyncio.run(server.serve(sockets, website=website, **options))
+
+def start_server(website, options):
+    sockets = tornado.netutil.bind_sockets(0, HOST)
+    port = sockets[0].getsockname()[1]
+    process = multiprocessing.get_context("fork").Process(
+        target=serve_process, args=(sockets, website, options), daemon=True)
+    process.start()
+    for s in sockets:
+        s.close()
+    wait_ready(port)
+    return process, port
+
+def wait_ready(port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    request = loadgen.build_request(HOST, port, "/")
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((HOST, port), timeout=timeout) as s:
+                s.sendall(request)
+                if s.recv(12).startswith(b"HTTP/1.1"):
+                    return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Benchmark server on port {port} did not start")
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "tornado": tornado.version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+def run(scenarios, levels, duration, warmup):
+    results = []
+    with tempfile.TemporaryDirectory(prefix="peonserver-bench-") as root:
+        website = make_website(root)
+        # One server per distinct configuration, reused by its scenarios
+        configs = {}
+        for name in scenarios:
+            options = SCENARIOS[name][0]
+            configs.setdefault(json.dumps(options, sort_keys=True), []).append(name)
+
+        for key, names in configs.items():
+            process, port = start_server(website, json.loads(key))
+            try:
+                for name in names:
+                    options, path, headers = SCENARIOS[name]
+                    for level in levels:
+                        result = asyncio.run(loadgen.run(HOST, port, name, path, level, duration,
+                                                         headers, warmup))
+                        results.append(result.as_dict())
+                        print_row(results[-1])
+            finally:
+                process.terminate()
+                process.join()
+    return results
+
+def print_header():
+    print(f"{'scenario':<22}{'conc':>6}{'requests':>10}{'errors':>8}{'rps':>10}"
+          f"{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}")
+
+def print_row(r):
+    fmt = lambda v: f"{v:.2f}" if v is not None else "-"
+    print(f"{r['scenario']:<22}{r['concurrency']:>6}{r['requests']:>10}{r['errors']:>8}{r['rps']:>10.1f}"
+          f"{fmt(r['p50_ms']):>10}{fmt(r['p99_ms']):>10}{fmt(r['p999_ms']):>10}", flush=True)
+
+def compare(results, baseline, threshold):
+    """Print changes against baseline, returns the number of regressions beyond threshold percent"""
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline.get("results", [])}
+    regressions = 0
+    print(f"\n{'scenario':<22}{'conc':>6}{'rps':>12}{'p99':>12}")
+    for r in results:
+        base = previous.get((r["scenario"], r["concurrency"]))
+        if base is None or not base["rps"] or not base["p99_ms"] or r["p99_ms"] is None:
+            continue
+        rps = (r["rps"] - base["rps"]) / base["rps"] * 100.0
+        p99 = (r["p99_ms"] - base["p99_ms"]) / base["p99_ms"] * 100.0
+        regressed = rps < -threshold or p99 > threshold
+        regressions += regressed
+        print(f"{r['scenario']:<22}{r['concurrency']:>6}{rps:>+11.1f}%{p99:>+11.1f}%"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def parser():
+    parser = argparse.ArgumentParser(prog="bench", description="PeonServer load test")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Comma separated scenarios out of: {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,16,64", help="Comma separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=5.0, help="Measured seconds per scenario and level")
+    parser.add_argument("--warmup", type=float, default=1.0, help="Unmeasured seconds before each measurement")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare against results JSON from a previous run")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="Percent of RPS loss or p99 growth against the baseline counted as a regression")
+    return parser
+
+def main():
+    args = parser().parse_args()
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(unknown)}")
+    levels = [int(c) for c in args.concurrency.split(",") if c]
+
+    print_header()
+    results = run(scenarios, levels, args.duration, args.warmup)
+    report = {"version": RESULT_VERSION, "environment": environment(),
+              "settings": {"duration": args.duration, "warmup": args.warmup, "concurrency": levels},
+              "results": results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
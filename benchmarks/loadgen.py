@@ -0,0 +1,124 @@
+"""
+Minimal asyncio HTTP/1.1 load generator.
+
+Each simulated client holds one keep-alive connection and sends its next
+request as soon as the previous response is read (closed loop), so the
+concurrency level is the number of requests in flight. Only what is needed
+to read PeonServer's responses is parsed: the status line, Content-Length,
+chunked bodies and Connection: close.
+"""
+import time
+import asyncio
+
+
+class Result():
+
+    def __init__(self, scenario, concurrency):
+        self.scenario = scenario
+        self.concurrency = concurrency
+        self.latencies = []
+        self.errors = 0
+        self.statuses = {}
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def as_dict(self):
+        count = len(self.latencies)
+        ms = lambda v: round(v * 1000.0, 3) if v is not None else None
+        return {
+            "scenario": self.scenario,
+            "concurrency": self.concurrency,
+            "requests": count,
+            "errors": self.errors,
+            "statuses": {str(k): v for k, v in sorted(self.statuses.items())},
+            "duration_s": round(self.elapsed, 3),
+            "rps": round(count / self.elapsed, 1) if self.elapsed else 0.0,
+            "bytes": self.bytes,
+            "mean_ms": ms(sum(self.latencies) / count) if count else None,
+            "p50_ms": ms(self.percentile(0.50)),
+            "p99_ms": ms(self.percentile(0.99)),
+            "p999_ms": ms(self.percentile(0.999)),
+            "max_ms": ms(max(self.latencies)) if count else None,
+        }
+
+
+def build_request(host, port, path, headers=None):
+    lines = [f"GET {path} HTTP/1.1", f"Host: {host}:{port}", "User-Agent: peonserver-bench"]
+    lines.extend(f"{k}: {v}" for k, v in (headers or {}).items())
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+async def read_response(reader):
+    """Read one response, returns (status, body length, keep alive)"""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ", 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+
+    size = 0
+    if status in (204, 304) or 100 <= status < 200:
+        pass
+    elif headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            chunk_size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            if chunk_size == 0:
+                await reader.readuntil(b"\r\n")
+                break
+            await reader.readexactly(chunk_size + 2)
+            size += chunk_size
+    elif "content-length" in headers:
+        size = int(headers["content-length"])
+        await reader.readexactly(size)
+    else:
+        size = len(await reader.read())
+        return status, size, False
+    return status, size, headers.get("connection", "").lower() != "close"
+
+async def client(host, port, request, deadline, result):
+    loop = asyncio.get_running_loop()
+    reader = writer = None
+    while loop.time() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            start = time.perf_counter()
+            writer.write(request)
+            status, size, keep_alive = await read_response(reader)
+            result.latencies.append(time.perf_counter() - start)
+            result.statuses[status] = result.statuses.get(status, 0) + 1
+            result.bytes += size
+            if not keep_alive:
+                writer.close()
+                writer = None
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            result.errors += 1
+            if writer is not None:
+                writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+async def run(host, port, scenario, path, concurrency, duration, headers=None, warmup=0.0):
+    """Drive path with concurrency clients for duration seconds after warmup seconds"""
+    request = build_request(host, port, path, headers)
+    loop = asyncio.get_running_loop()
+    if warmup > 0:
+        discard = Result(scenario, concurrency)
+        deadline = loop.time() + warmup
+        await asyncio.gather(*[client(host, port, request, deadline, discard) for _ in range(concurrency)])
+
+    result = Result(scenario, concurrency)
+    started = loop.time()
+    deadline = started + duration
+    await asyncio.gather(*[client(host, port, request, deadline, result) for _ in range(concurrency)])
+    result.elapsed = loop.time() - started
+    return result
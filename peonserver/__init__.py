@@ -1,9 +1,11 @@
 import os
-from formencode import validators, Schema, api
+import inspect
 import functools
 
+from peonserver.cache import cached, cached_response
 
-__all__ = ["HERE", "Validator", "EmailValidator"]
+
+__all__ = ["HERE", "Validator", "EmailValidator", "cached", "cached_response"]
 
 HERE = os.path.abspath(os.path.dirname(__file__))
 
@@ -16,29 +18,52 @@ def args_to_dict(params):
     return p
 
 class Validator():
+    """
+    Validate request arguments with a FormEncode schema before calling the handler.
+
+    The handler is called as func(self, params, error, ...) where params are the
+    converted values, or dict(error=message) with error True when validation
+    fails. Both plain and `async def` handlers can be decorated. The schema is
+    compiled once, see peonserver.validation.
+    """
     def __init__(self, validator, *args, **kwargs):
+        # FormEncode is only imported once a route module uses validation
+        from peonserver.validation import compile_schema
         self.validator = validator
+        self.compiled = compile_schema(validator)
 
     def __call__(self, func, *args, **kwargs):
-        v = self.validator
-        def wrapper(self, *args, **kwargs):
-            # Coerce to dict
-            params = args_to_dict(self.request.arguments)
-            # Coerce to proper values
+        from peonserver.validation import Invalid
+        check = self.compiled.check
+
+        def validate(handler):
             try:
-                params = v.to_python(params)
-                return func(self, params, False, *args, **kwargs)
-            except api.Invalid as Invalid:
-                return func(self, dict(error=str(Invalid)), True,
-                         *args, **kwargs)
-        return wrapper
+                return check(handler), False
+            except Invalid as iE:
+                return dict(error=str(iE)), True
 
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(self, *args, **kwargs):
+                params, error = validate(self)
+                return await func(self, params, error, *args, **kwargs)
+            return async_wrapper
 
-### VALIDATORS ###
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            params, error = validate(self)
+            return func(self, params, error, *args, **kwargs)
+        return wrapper
 
-class EmailValidator(Schema):
-    allow_extra_fields = True
 
-    email = validators.Email(not_empty=True, min=5, max=256, strip=True)
+### VALIDATORS ###
 
+# Defined in peonserver.validation, imported on first use so that FormEncode is
+# not loaded by websites that never validate anything.
+LAZY_VALIDATION = ("EmailValidator", "validators", "Schema", "api")
 
+def __getattr__(name):
+    if name in LAZY_VALIDATION:
+        from peonserver import validation
+        return getattr(validation, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,315 @@
+"""
+Admission control and per client rate limiting.
+
+install() wraps an application's handler delegates so that every request has
+to be admitted before its handler is created:
+
+  - a token bucket per client IP answers 429 once a client exceeds its rate
+  - at most `max_in_flight` requests run at once, and optionally fewer for a
+    given route (the URL pattern it was registered with in make_app)
+  - requests over capacity wait in a bounded FIFO queue for at most
+    `queue_timeout` seconds, after which, or when the queue is full, they are
+    answered with 503 and Retry-After without running any handler code
+
+A request holds its slot until the handler finishes (the application's
+log_function) or the connection is lost before the handler ran. Rejections
+are written straight to the connection, so refusing work stays cheap when the
+server is already overloaded.
+"""
+import math
+import asyncio
+import collections
+
+import tornado.httputil
+
+import peonserver.log as plog
+
+DEFAULT_QUEUE_TIMEOUT = 1.0  # seconds
+DEFAULT_MAX_QUEUE = 128
+MAX_CLIENTS = 65536  # rate limited client addresses tracked before idle ones are pruned
+
+# Optional website globals.py names and the make_app keyword arguments they fill in
+WEBSITE_SETTINGS = {
+    "MAX_IN_FLIGHT": "max_in_flight",
+    "ROUTE_LIMITS": "route_limits",
+    "QUEUE_TIMEOUT": "queue_timeout",
+    "MAX_QUEUE": "max_queue",
+    "RATE_LIMIT": "rate_limit",
+    "RATE_BURST": "rate_burst",
+}
+
+
+class RateLimiter():
+    """Token bucket per client address, `rate` requests per second with bursts of `burst`"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst else max(self.rate, 1.0)
+        self.buckets = {}  # address -> [tokens, last update]
+
+    def take(self, address, now):
+        """Returns 0 when the request may proceed, otherwise seconds until it would"""
+        bucket = self.buckets.get(address)
+        if bucket is None:
+            if len(self.buckets) >= MAX_CLIENTS:
+                self.prune(now)
+            bucket = self.buckets[address] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1.0:
+            bucket[0] -= 1.0
+            return 0
+        return (1.0 - bucket[0]) / self.rate
+
+    def prune(self, now):
+        # Buckets that refilled completely are the same as new ones
+        full = self.burst / self.rate
+        for address in [a for a, (_, last) in self.buckets.items() if now - last >= full]:
+            del self.buckets[address]
+
+
+class Admission():
+    """
+    In-flight request limits with a bounded wait queue.
+
+    Usage: CONTROL.configure(max_in_flight=100) and install(app, handlers). An
+    unconfigured instance admits everything.
+    """
+
+    def __init__(self):
+        self.routes = {}  # handler class -> route label
+        self.configure()
+
+    def configure(self, **kwargs):
+        """
+        :Parameters:
+            - max_in_flight: requests handled at once, 0 or None for no limit
+            - route_limits: {url pattern: limit}, a limit of 0 exempts the route from in-flight limits
+            - queue_timeout: seconds a request may wait for a slot, default 1.0
+            - max_queue: requests allowed to wait at once, default 128
+            - rate_limit: requests per second per client address, 0 or None to disable
+            - rate_burst: requests a client may make at once, defaults to rate_limit
+        """
+        self.max_in_flight = kwargs.get("max_in_flight") or None
+        self.route_limits = dict(kwargs.get("route_limits") or {})
+        timeout = kwargs.get("queue_timeout")
+        self.queue_timeout = DEFAULT_QUEUE_TIMEOUT if timeout is None else float(timeout)
+        max_queue = kwargs.get("max_queue")
+        self.max_queue = DEFAULT_MAX_QUEUE if max_queue is None else int(max_queue)
+        rate = kwargs.get("rate_limit")
+        self.limiter = RateLimiter(rate, kwargs.get("rate_burst")) if rate else None
+        self.in_flight = 0
+        self.route_in_flight = collections.Counter()
+        self.waiters = collections.deque()  # (future, route)
+        self.overloaded = 0
+        self.rate_limited = 0
+
+    @property
+    def enabled(self):
+        return bool(self.max_in_flight or self.route_limits or self.limiter)
+
+    @property
+    def queued(self):
+        return sum(1 for future, _ in self.waiters if not future.done())
+
+    def register_routes(self, handlers):
+        """Label handler classes with the URL pattern they were first registered for"""
+        for spec in handlers:
+            if isinstance(spec, (tuple, list)):
+                pattern, handler_class = spec[0], spec[1]
+            else:  # tornado.web.url / URLSpec
+                pattern, handler_class = spec.regex.pattern, spec.handler_class
+            if isinstance(handler_class, type):
+                self.routes.setdefault(handler_class, pattern)
+
+    def route(self, handler_class):
+        return self.routes.get(handler_class, handler_class.__name__)
+
+    def exempt(self, route):
+        return self.route_limits.get(route) == 0
+
+    def has_slot(self, route):
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return False
+        limit = self.route_limits.get(route)
+        return not limit or self.route_in_flight[route] < limit
+
+    def acquire(self, route):
+        self.in_flight += 1
+        self.route_in_flight[route] += 1
+
+    def release(self, route):
+        self.in_flight -= 1
+        self.route_in_flight[route] -= 1
+        # Hand freed capacity to the oldest waiters that fit, skipping expired ones
+        skipped = []
+        while self.waiters and (not self.max_in_flight or self.in_flight < self.max_in_flight):
+            future, waiting_route = self.waiters.popleft()
+            if future.done():
+                continue
+            if not self.has_slot(waiting_route):
+                skipped.append((future, waiting_route))
+                continue
+            self.acquire(waiting_route)
+            future.set_result(True)
+        self.waiters.extendleft(reversed(skipped))
+
+    def try_acquire(self, route):
+        """True if route got a slot right away, a Future resolving to whether it got one later, or None"""
+        # release() hands capacity to waiters as soon as it frees up, so a free
+        # slot here is one that no waiter can use
+        if self.has_slot(route):
+            self.acquire(route)
+            return True
+        while self.waiters and self.waiters[0][0].done():
+            self.waiters.popleft()
+        if self.queued >= self.max_queue or self.queue_timeout <= 0:
+            return None
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.waiters.append((future, route))
+        loop.call_later(self.queue_timeout, self.expire, future)
+        return future
+
+    def expire(self, future):
+        if not future.done():
+            future.set_result(False)
+
+    def retry_after(self):
+        return max(1, math.ceil(self.queue_timeout))
+
+
+CONTROL = Admission()
+
+
+class AdmissionDelegate(tornado.httputil.HTTPMessageDelegate):
+    """Holds a request back from its handler delegate until it is admitted"""
+
+    def __init__(self, control, request, route, delegate):
+        self.control = control
+        self.request = request
+        self.route = route
+        self.delegate = delegate
+        self.admitted = False
+        self.started = False
+        self.rejection = None  # (status, seconds to retry after)
+
+    def headers_received(self, start_line, headers):
+        control = self.control
+        if control.limiter is not None:
+            wait = control.limiter.take(self.request.remote_ip, asyncio.get_running_loop().time())
+            if wait:
+                control.rate_limited += 1
+                return self.reject(429, math.ceil(wait))
+        if control.exempt(self.route):
+            return self.forward(start_line, headers, acquired=False)
+        slot = control.try_acquire(self.route)
+        if slot is True:
+            return self.forward(start_line, headers)
+        if slot is None:
+            control.overloaded += 1
+            return self.reject(503, control.retry_after())
+        return self.wait(slot, start_line, headers)
+
+    async def wait(self, slot, start_line, headers):
+        if await slot:
+            result = self.forward(start_line, headers)
+            if result is not None:
+                await result
+        else:
+            self.control.overloaded += 1
+            self.reject(503, self.control.retry_after())
+
+    def forward(self, start_line, headers, acquired=True):
+        self.admitted = True
+        if acquired:
+            # Released by log_function once the handler finishes
+            self.request.peonserver_admission = (self.control, self.route)
+        if getattr(self.delegate, "stream_request_body", False):
+            self.started = True
+        return self.delegate.headers_received(start_line, headers)
+
+    def reject(self, status, retry_after):
+        self.rejection = (status, retry_after)
+        headers = self.request.headers
+        if "Content-Length" in headers or "Transfer-Encoding" in headers:
+            # Answer without reading the body, the connection is closed after
+            self.respond()
+        return None
+
+    def respond(self):
+        status, retry_after = self.rejection
+        reason = tornado.httputil.responses.get(status, "Unknown")
+        body = f"{status}: {reason}\n".encode("utf-8")
+        headers = tornado.httputil.HTTPHeaders({
+            "Content-Type": "text/plain; charset=UTF-8",
+            "Content-Length": str(len(body)),
+            "Retry-After": str(retry_after),
+        })
+        connection = self.request.connection
+        connection.write_headers(tornado.httputil.ResponseStartLine("HTTP/1.1", status, reason),
+                                 headers, body)
+        connection.finish()
+        self.rejection = (status, None)
+
+    def data_received(self, chunk):
+        if self.admitted:
+            return self.delegate.data_received(chunk)
+        return None
+
+    def finish(self):
+        if self.admitted:
+            self.started = True
+            self.delegate.finish()
+        elif self.rejection is not None and self.rejection[1] is not None:
+            self.respond()
+
+    def on_connection_close(self):
+        if not self.admitted:
+            return
+        if not self.started:
+            release(self.request)
+        else:
+            self.delegate.on_connection_close()
+
+
+def release(request):
+    admitted = getattr(request, "peonserver_admission", None)
+    if admitted is not None:
+        request.peonserver_admission = None
+        control, route = admitted
+        control.release(route)
+
+def log_function(previous=None):
+    """Wraps the application's log_function to free the slot of each finished request"""
+    previous = previous or plog.access_logger()
+
+    def log_request(handler):
+        release(handler.request)
+        previous(handler)
+    return log_request
+
+
+def install(app, handlers, control=CONTROL):
+    """Admit requests to app, whose routes are handlers, through control"""
+    control.register_routes(handlers)
+    get_handler_delegate = app.get_handler_delegate
+
+    def admit(request, target_class, *args, **kwargs):
+        delegate = get_handler_delegate(request, target_class, *args, **kwargs)
+        if getattr(request, "peonserver_internal", False):
+            return delegate  # replayed by the response cache for an admitted request
+        return AdmissionDelegate(control, request, control.route(target_class), delegate)
+
+    app.get_handler_delegate = admit
+    app.settings["log_function"] = log_function(app.settings.get("log_function"))
+    app.settings["admission"] = control
+    limits = [f"max {control.max_in_flight} in flight" if control.max_in_flight else "no global limit"]
+    if control.route_limits:
+        limits.append(f"{len(control.route_limits)} route limit(s)")
+    if control.limiter is not None:
+        limits.append(f"{control.limiter.rate:g} req/s per client")
+    plog.LOG.info(f"Admission control enabled: {', '.join(limits)}, "
+                  f"queue {control.max_queue} for {control.queue_timeout:g}s")
+    return app
@@ -4,44 +4,75 @@ import asyncio
 import datetime
 import tornado
 import tornado.web
-import tornado.escape
 
 from argparse import Namespace
-from formencode import Invalid
 
 # tornado.web.authenticated
-from peonserver import *
+from peonserver import HERE
 import peonserver.log as plog
+from peonserver.templates import CachedPageMixin
 
-LOG = plog.LOG
+TEMPLATE_TYPES = (str, int, float, bool, type(None))
 
-class MainHandler(tornado.web.RequestHandler):
+
+def key_variables(settings):
+    """
+    The settings that can change what index.html renders to, for its page
+    cache key. Objects among the application settings (session store,
+    database pool, ...) are left out, they are the same for the life of the
+    application and would only make every key longer.
+    """
+    return {name: value for name, value in settings.items() if isinstance(value, TEMPLATE_TYPES)}
+
+
+class MainHandler(CachedPageMixin, tornado.web.RequestHandler):
 
     async def get(self):
-        self.render(os.path.join(self.settings.get("static_path"), "index.html"),
-                    **self.settings)
+        self.render_cached(os.path.join(self.settings.get("static_path"), "index.html"),
+                           cache_key=key_variables(self.settings), **self.settings)
         # self.static_url("index.html")
 
 
 class AuthenticatedHandler(tornado.web.RequestHandler):
+    """
+    The current user is kept in a server-side session, see peonserver.sessions,
+    the cookie only carries the session id.
+    """
+
+    session = None
 
     async def prepare(self):
         self.current_user = await self.get_current_user()
 
+    async def get_session(self):
+        if self.session is None:
+            store = self.settings["session_store"]
+            self.session = await store.get(self.get_cookie(store.cookie_name))
+        return self.session
+
     async def get_current_user(self):
-        return self.get_secure_cookie("user")
+        session = await self.get_session()
+        return session.data.get("user") if session is not None else None
 
     async def set_current_user(self, user):
-        user = str(user)
+        store = self.settings["session_store"]
+        session = await self.get_session()
+        if session is not None:
+            await store.delete(session.id)
+            self.session = None
         if user:
-            self.set_secure_cookie("user", tornado.escape.json_encode(user))
+            # Always a new id on login, an id known before it must not become authenticated
+            self.session = await store.create({"user": str(user)})
+            self.set_cookie(store.cookie_name, self.session.id, expires_days=store.ttl / 86400.0,
+                            httponly=True, samesite="Lax", secure=self.request.protocol == "https")
         else:
-            self.clear_cookie("user")
+            self.clear_cookie(store.cookie_name)
+        self.current_user = str(user) if user else None
 
-class TemplateTestHandler(tornado.web.RequestHandler):
+class TemplateTestHandler(CachedPageMixin, tornado.web.RequestHandler):
 
     async def get(self):
-        self.render("test.html", value1="one", value2="two")
+        self.render_cached("test.html", value1="one", value2="two")
 
 #
 # class AdminLoginHandler(AuthenticatedHandler):
@@ -52,7 +83,7 @@ class TemplateTestHandler(tornado.web.RequestHandler):
 #
 #         user = await self.get_current_user()
 #         if user:
-#             LOG.info(f"User {user} already authenticated, redirecting")
+#             plog.LOG.info(f"User {user} already authenticated, redirecting")
 #             self.redirect("/admindashboard")
 #             return
 #
@@ -66,21 +97,21 @@ class TemplateTestHandler(tornado.web.RequestHandler):
 #         return self.render(os.path.join(HERE, "static/index.html"))
 #
 #         # if await db.adminlogin(username, password):
-#         #     LOG.info(f"db adminlogin successful for {username}")
+#         #     plog.LOG.info(f"db adminlogin successful for {username}")
 #         #     await self.set_current_user(f"{username}")
-#         #     LOG.info(f"Cookie set for {username}")
+#         #     plog.LOG.info(f"Cookie set for {username}")
 #         #     self.redirect("/admindashboard")
 #         #     return
 #         #
 #         # else:
-#         #     LOG.info("render the admin page, login attempt failed")
+#         #     plog.LOG.info("render the admin page, login attempt failed")
 #         #     self.render(os.path.join(HERE, "admin.html"))
 #
 # class AdminHandler(AuthenticatedHandler):
 #
 #     @tornado.web.authenticated
 #     async def get(self):
-#         LOG.info("Authenticated against AdminHandler, checking current user then rendering page")
+#         plog.LOG.info("Authenticated against AdminHandler, checking current user then rendering page")
 #         user = await self.get_current_user()
 #         if not user:
 #             return
@@ -0,0 +1,242 @@
+"""
+JS and CSS bundles.
+
+A website declares bundles in its globals.py, each a list of static paths or
+glob patterns concatenated in order:
+
+    BUNDLES = {
+        "site.js": ["js/vendor/*.js", "js/site.js"],
+        "site.css": ["css/site.css", "css/print.css"],
+    }
+
+build() writes every bundle and its source map to ``bundles/`` under the
+static path, where the static build fingerprints and precompresses them
+like any other file. It runs after the sass build at startup and again when
+a static file changes under --debug. A bundle is only rewritten when one of
+its sources changed.
+
+CSS is minified with libsass, which is already needed for the sass build, and
+JS with ``rjsmin`` from requirements.txt. Without rjsmin installed JS is
+concatenated as is, which is logged once, precompression still takes the
+most off.
+Relative url() and @import references in CSS are rewritten to point from
+the bundle to where the source file referred to.
+
+Source maps map each line of an unminified bundle back to its source line.
+Minified code is mapped at file level only: its lines point to the first
+line of the file they came from, so browsers name the source file but not
+the line within it.
+
+Templates link to a bundle with ``{% raw bundle_tag("site.js") %}`` or
+``{{ bundle_url("site.css") }}``.
+"""
+import os
+import re
+import glob
+import json
+import posixpath
+import mimetypes
+
+import tornado.escape
+
+import peonserver.log as plog
+from peonserver.sassbuild import cache_path
+from peonserver.staticbuild import write_file
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+js_unminified_logged = False
+
+BUNDLE_DIR = "bundles"
+CACHE_NAME = "bundles.json"
+CACHE_VERSION = 2  # bundles built by an older version are rebuilt
+JS_EXTENSIONS = (".js", ".mjs")
+CSS_EXTENSIONS = (".css",)
+BASE64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+CSS_REFERENCE = re.compile(r"""url\(\s*(['"]?)([^'"()]*?)\1\s*\)|(@import\s+)(['"])([^'"]*)\4""", re.IGNORECASE)
+ABSOLUTE_URL = re.compile(r"^(?:[a-z][a-z0-9+.-]*:|/|#)", re.IGNORECASE)
+
+mimetypes.add_type("application/json", ".map")
+
+
+def vlq(value):
+    """Base64 VLQ of an integer, as source map mappings are written"""
+    value = (-value << 1) | 1 if value < 0 else value << 1
+    encoded = ""
+    while True:
+        digit = value & 31
+        value >>= 5
+        encoded += BASE64[digit | (32 if value else 0)]
+        if not value:
+            return encoded
+
+def source_map(name, sources, lines):
+    """
+    Source map of bundle name, lines holds (source index, source line) for
+    every generated line, None for lines of no source
+    """
+    mappings = []
+    previous_source = previous_line = 0
+    for line in lines:
+        if line is None:
+            mappings.append("")
+            continue
+        source, source_line = line
+        mappings.append("A" + vlq(source - previous_source) + vlq(source_line - previous_line) + "A")
+        previous_source, previous_line = source, source_line
+    return {"version": 3, "file": name, "sources": sources, "names": [], "mappings": ";".join(mappings)}
+
+def bundle_kind(name):
+    ext = os.path.splitext(name)[1].lower()
+    if ext in JS_EXTENSIONS:
+        return "js"
+    if ext in CSS_EXTENSIONS:
+        return "css"
+    return None
+
+def expand(static_path, patterns):
+    """Static paths of a bundle's sources, in order and each once"""
+    found = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.join(static_path, *pattern.split("/"))))
+        if not matches:
+            plog.LOG.warning(f"Bundle source {pattern} matches no file")
+        for path in matches:
+            rel = os.path.relpath(path, static_path).replace(os.sep, "/")
+            if os.path.isfile(path) and rel not in found and not rel.startswith(BUNDLE_DIR + "/"):
+                found.append(rel)
+    return found
+
+def rebase_url(url, prefix):
+    """url relative to a CSS source as seen from a bundle, prefix leads from the bundle to the source's directory"""
+    if not url or ABSOLUTE_URL.match(url):
+        return url
+    path, rest = re.match(r"([^?#]*)(.*)", url, re.DOTALL).groups()
+    return posixpath.normpath(posixpath.join(prefix, path)) + rest
+
+def rebase_css(text, prefix):
+    """CSS text with its relative url() and @import references rebased with rebase_url()"""
+    def replace(match):
+        if match.group(3) is not None:
+            quote = match.group(4)
+            return f"{match.group(3)}{quote}{rebase_url(match.group(5), prefix)}{quote}"
+        quote = match.group(1)
+        return f"url({quote}{rebase_url(match.group(2), prefix)}{quote})"
+    return CSS_REFERENCE.sub(replace, text)
+
+def minify(kind, text):
+    """Minified text, or None when there is no minifier for kind"""
+    if kind == "js":
+        return rjsmin.jsmin(text) if rjsmin is not None else None
+    import sass
+    try:
+        return sass.compile(string=text, output_style="compressed")
+    except sass.CompileError as cE:
+        plog.LOG.warning(f"Could not minify CSS, keeping it as is: {cE}")
+        return None
+
+def assemble(name, kind, static_path, sources):
+    """Bundle text and source map of the sources of bundle name"""
+    bundle_dir = posixpath.join(BUNDLE_DIR, posixpath.dirname(name))
+    relative = posixpath.relpath(".", bundle_dir)
+    parts = []
+    lines = []
+    for index, rel in enumerate(sources):
+        with open(os.path.join(static_path, *rel.split("/")), "r", encoding="utf-8") as f:
+            text = f.read()
+        if kind == "css":
+            text = rebase_css(text, posixpath.relpath(posixpath.dirname(rel) or ".", bundle_dir))
+        minified = minify(kind, text)
+        if minified is not None:
+            # File level mapping, every line of minified code maps to the start of its file
+            text = minified.strip()
+            lines.extend((index, 0) for n in range(text.count("\n") + 1))
+        else:
+            text = text.rstrip("\n")
+            lines.extend((index, n) for n in range(text.count("\n") + 1))
+        parts.append(text)
+
+    map_name = f"{os.path.basename(name)}.map"
+    # The semicolon keeps a script without a trailing one from running into the next
+    body = ("\n;" if kind == "js" else "\n").join(parts)
+    if kind == "js":
+        body += f"\n//# sourceMappingURL={map_name}\n"
+    else:
+        body += f"\n/*# sourceMappingURL={map_name} */\n"
+    lines.append(None)
+    smap = source_map(os.path.basename(name), [f"{relative}/{rel}" for rel in sources], lines)
+    return body, json.dumps(smap, separators=(",", ":"))
+
+def build(static_path, bundles, **kwargs):
+    """
+    Write the bundles whose sources changed, returns the number written.
+
+    :Parameters:
+        - cachefile: source stamps of the last build, see cache_path() if unset
+    """
+    global js_unminified_logged
+    if not bundles:
+        return 0
+    cachefile = kwargs.get("cachefile") or cache_path(static_path, CACHE_NAME)
+    try:
+        with open(cachefile, "r") as cf:
+            cache = json.load(cf)
+        if cache.get("version") != CACHE_VERSION:
+            cache = {}
+    except (IOError, ValueError):
+        cache = {}
+    stamps = cache.get("bundles", {})
+    minifiers = {"js": rjsmin is not None, "css": True}
+    if rjsmin is None and not js_unminified_logged and \
+            any(bundle_kind(name) == "js" for name in bundles):
+        js_unminified_logged = True
+        plog.LOG.warning("rjsmin is not installed, JS bundles are not minified")
+
+    built = 0
+    fresh = {}
+    for name, patterns in sorted(bundles.items()):
+        kind = bundle_kind(name)
+        if kind is None:
+            plog.LOG.error(f"Bundle {name} is neither .js nor .css, skipped")
+            continue
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        sources = expand(static_path, patterns)
+        stamp = [minifiers[kind]]
+        for rel in sources:
+            st = os.stat(os.path.join(static_path, *rel.split("/")))
+            stamp.append([rel, st.st_mtime_ns, st.st_size])
+        output = os.path.join(static_path, BUNDLE_DIR, *name.split("/"))
+        fresh[name] = stamp
+        if stamps.get(name) == stamp and os.path.exists(output) and os.path.exists(output + ".map"):
+            continue
+        try:
+            body, smap = assemble(name, kind, static_path, sources)
+        except (IOError, UnicodeDecodeError) as E:
+            plog.LOG.error(f"Failed to build bundle {name}: {E}")
+            fresh.pop(name)
+            continue
+        write_file(output, body.encode("utf-8"))
+        write_file(output + ".map", smap.encode("utf-8"))
+        built += 1
+
+    write_file(cachefile, json.dumps({"version": CACHE_VERSION, "bundles": fresh}).encode("utf-8"))
+    plog.LOG.info(f"Bundles: {built} built, {len(fresh) - built} unchanged")
+    return built
+
+
+def bundle_url(handler, name):
+    """Fingerprinted URL of a bundle, a template helper"""
+    return handler.static_url(f"{BUNDLE_DIR}/{name}")
+
+def bundle_tag(handler, name):
+    """<script> or <link> element loading a bundle, a template helper"""
+    url = tornado.escape.xhtml_escape(bundle_url(handler, name))
+    if bundle_kind(name) == "js":
+        return f'<script src="{url}" defer></script>'
+    return f'<link rel="stylesheet" href="{url}">'
+
+UI_METHODS = {"bundle_url": bundle_url, "bundle_tag": bundle_tag}
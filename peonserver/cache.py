@@ -0,0 +1,272 @@
+"""
+Response and value caching with single-flight request coalescing.
+
+ResponseCache keeps computed values for `ttl` seconds in an LRU. Concurrent
+lookups of a key that is being computed wait for that one computation instead
+of starting their own, and an entry that expired less than `stale` seconds ago
+is still returned while a single background task recomputes it, so an expiry
+never turns into a thundering herd.
+
+Route handlers opt in per method:
+
+    class Products(tornado.web.RequestHandler):
+
+        @cached_response(ttl=30, stale=300)
+        async def get(self):
+            ...
+
+A miss replays the request through the application into a capture
+connection and keeps the finished response, which is then written to every
+waiting request, and replayed again for background refreshes. Responses are
+cached per handler, method and URI unless a `key(handler)` function says
+otherwise, so pages that depend on the user need a key that includes it. Only
+200 responses without Set-Cookie or a private/no-store Cache-Control are kept.
+
+Plain coroutine functions can be cached by their arguments with @cached().
+"""
+import asyncio
+import functools
+import collections
+
+import tornado.httputil
+
+import peonserver.log as plog
+
+DEFAULT_TTL = 60.0  # seconds
+MAX_ENTRIES = 1024
+
+# Hop-by-hop and per-response headers that are not replayed from the cache
+SKIP_HEADERS = ("Connection", "Keep-Alive", "Transfer-Encoding", "Content-Length", "Date", "Server")
+# Conditional and encoding headers would change what the replayed handler writes
+REPLAY_SKIP_HEADERS = ("Accept-Encoding", "If-None-Match", "If-Modified-Since", "Range", "If-Range")
+
+
+class Entry():
+    __slots__ = ("value", "expires", "stale_until")
+
+    def __init__(self, value, expires, stale_until):
+        self.value = value
+        self.expires = expires
+        self.stale_until = stale_until
+
+
+class ResponseCache():
+    """TTL and LRU cache whose lookups of a missing key share one computation"""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.inflight = {}  # key -> asyncio.Task computing it
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, key, compute, ttl=DEFAULT_TTL, stale=0.0, store=None):
+        """
+        Cached value for key, computed with `await compute()` when missing.
+
+        :Parameters:
+            - ttl: seconds the value is fresh
+            - stale: further seconds an expired value is returned while it is recomputed in the background
+            - store: store(value) -> bool, values it rejects are handed to current waiters but not kept
+        """
+        now = asyncio.get_running_loop().time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if now < entry.expires:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry.value
+            if now < entry.stale_until:
+                self.stale_hits += 1
+                self.entries.move_to_end(key)
+                if key not in self.inflight:
+                    self.start(key, compute, ttl, stale, store).add_done_callback(self.log_refresh)
+                return entry.value
+            del self.entries[key]
+
+        task = self.inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = self.start(key, compute, ttl, stale, store)
+        # A waiter giving up must not cancel the computation the others wait for
+        return await asyncio.shield(task)
+
+    def start(self, key, compute, ttl, stale, store):
+        task = asyncio.ensure_future(self.fill(key, compute, ttl, stale, store))
+        self.inflight[key] = task
+        return task
+
+    async def fill(self, key, compute, ttl, stale, store):
+        try:
+            value = await compute()
+            if store is None or store(value):
+                self.set(key, value, ttl, stale)
+            return value
+        finally:
+            self.inflight.pop(key, None)
+
+    def log_refresh(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            plog.LOG.error(f"Background cache refresh failed: {task.exception()}")
+
+    def set(self, key, value, ttl=DEFAULT_TTL, stale=0.0):
+        expires = asyncio.get_running_loop().time() + ttl
+        self.entries[key] = Entry(value, expires, expires + stale)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+CACHE = ResponseCache()
+
+
+def cached(ttl=DEFAULT_TTL, stale=0.0, key=None, cache=None):
+    """
+    Cache the result of a coroutine function by its arguments.
+
+    :Parameters:
+        - key: key(*args, **kwargs) -> hashable, defaults to the arguments themselves
+        - cache: ResponseCache to use, CACHE if unset
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            k = key(*args, **kwargs) if key else (args, tuple(sorted(kwargs.items())))
+            return await (cache or CACHE).get((func, k), lambda: func(*args, **kwargs), ttl, stale)
+        return wrapper
+    return decorator
+
+
+class CapturedResponse():
+    __slots__ = ("status", "reason", "headers", "body", "request")
+
+    def __init__(self, status, reason, headers, body, request):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.request = request  # the request it was replayed for
+
+    @property
+    def shareable(self):
+        return "Set-Cookie" not in self.headers
+
+    @property
+    def storable(self):
+        cache_control = self.headers.get("Cache-Control", "").lower()
+        return self.status == 200 and self.shareable \
+            and "no-store" not in cache_control and "private" not in cache_control
+
+    def write_to(self, handler):
+        handler.set_status(self.status, self.reason)
+        for name in set(self.headers.keys()):
+            if name not in SKIP_HEADERS:
+                handler.clear_header(name)
+        for name, value in self.headers.get_all():
+            if name not in SKIP_HEADERS:
+                handler.add_header(name, value)
+        if self.status == 200 and "Etag" in self.headers and handler.check_etag_header():
+            handler.set_status(304)
+            handler.finish()
+            return
+        handler.finish(self.body)
+
+
+class CaptureConnection(tornado.httputil.HTTPConnection):
+    """Connection for replayed requests, collecting the response instead of sending it"""
+
+    def __init__(self, context):
+        self.context = context
+        self.start_line = None
+        self.headers = None
+        self.chunks = []
+        self.finished = asyncio.get_running_loop().create_future()
+
+    def set_close_callback(self, callback):
+        pass
+
+    def write_headers(self, start_line, headers, chunk=None):
+        self.start_line = start_line
+        self.headers = headers
+        return self.write(chunk)
+
+    def write(self, chunk):
+        if chunk:
+            self.chunks.append(chunk)
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+    def finish(self):
+        if not self.finished.done():
+            self.finished.set_result(None)
+
+
+async def replay(handler):
+    """Run a copy of handler's request through its application, returns the CapturedResponse"""
+    original = handler.request
+    headers = tornado.httputil.HTTPHeaders()
+    for name, value in original.headers.get_all():
+        if name not in REPLAY_SKIP_HEADERS:
+            headers.add(name, value)
+    connection = CaptureConnection(getattr(original.connection, "context", None))
+    request = tornado.httputil.HTTPServerRequest(
+        method=original.method, uri=original.uri, version=original.version, headers=headers,
+        host=original.host, connection=connection)
+    request.remote_ip = original.remote_ip
+    request.protocol = original.protocol
+    # Skips admission control, the caching decorators, access logging and metrics for this request
+    request.peonserver_internal = True
+
+    delegate = handler.application.find_handler(request)
+    if original.body:
+        delegate.data_received(original.body)
+    delegate.finish()
+    await connection.finished
+    start_line = connection.start_line
+    return CapturedResponse(start_line.code, start_line.reason, connection.headers,
+                            b"".join(connection.chunks), original)
+
+
+def cached_response(ttl=DEFAULT_TTL, stale=0.0, key=None, cache=None):
+    """
+    Cache the responses of a RequestHandler GET method, plain or coroutine.
+
+    :Parameters:
+        - ttl: seconds a response is fresh
+        - stale: further seconds an expired response is served while it is refreshed in the background
+        - key: key(handler) -> hashable, defaults to the handler class, method and URI
+        - cache: ResponseCache to use, CACHE if unset
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            request = self.request
+            if getattr(request, "peonserver_internal", False) or request.method not in ("GET", "HEAD"):
+                result = method(self, *args, **kwargs)
+                if result is not None:
+                    await result
+                return
+
+            k = (type(self), request.method, request.uri) if key is None else key(self)
+            response = await (cache or CACHE).get(k, lambda: replay(self), ttl, stale,
+                                                  store=lambda r: r.storable)
+            if response.shareable or response.request is request:
+                response.write_to(self)
+                return
+            # Personalised response computed for someone else, run the handler for this one
+            result = method(self, *args, **kwargs)
+            if result is not None:
+                await result
+        return wrapper
+    return decorator
@@ -2,15 +2,17 @@
 
 import sys, os, time, atexit
 import logging
-from signal import SIGTERM
+from signal import SIGTERM, SIGHUP, SIGKILL
 import asyncio
 import typing
 
-LOOP = asyncio.get_event_loop()
 DEFAULT_LOG_PATH = '/tmp/peonserver.dameon.log'
 PIDPATH = os.getcwd()
 PIDNAME = "daemon.pid"
 PID = os.path.join(PIDPATH, PIDNAME)
+DEFAULT_STOP_TIMEOUT = 35.0  # seconds before a daemon that does not stop is killed
+KILL_TIMEOUT = 5.0
+POLL_INTERVAL = 0.1  # seconds, only used without pidfd_open
 
 """
 TODO:
@@ -29,8 +31,14 @@ class Daemon():
     going wrong when the daemon suddenly stops or the process dies and daemon exits.
 
     Set stderr to /dev/null (has to be a file object)
+
+    Subclasses whose process hands itself over to a successor on SIGHUP (and
+    then rewrites the pidfile) set reloadable = True, restart() reloads those.
     """
 
+    reloadable = False
+    RELOAD_TIMEOUT = 120  # seconds for a reload to start the successor and drain
+
     def __init__(self, **kwargs):
         """
         :Parameters:
@@ -41,6 +49,8 @@ class Daemon():
             - stderr: path or logfile if unset
             - silent: default is False
             - pidpath + pidfile: defaults to "/var/run/" + "{pidname}.pid"
+            - stop_timeout: seconds stop() waits for the daemon to exit before killing it,
+              default DEFAULT_STOP_TIMEOUT
         """
         self.log = kwargs.get("logger", logging.getLogger('daemon '))
         self.logfile = kwargs.get("logfile", DEFAULT_LOG_PATH)
@@ -51,6 +61,7 @@ class Daemon():
         self.pidfile = os.path.join(kwargs.get("pidpath", f"{__name__}.pid"),
                                     kwargs.get("pidname", os.path.join(PIDPATH, PIDNAME)))
         self.port = kwargs.get("port", 8085)
+        self.stop_timeout = kwargs.get("stop_timeout", DEFAULT_STOP_TIMEOUT)
         logging.basicConfig(level=kwargs.get("loglevel", logging.DEBUG),
             filename=self.logfile,
             filemode='a',
@@ -59,17 +70,21 @@ class Daemon():
         )
 
 
-    async def daemonize(self):
+    def daemonize(self):
         """un
         do the UNIX double-fork magic, see Stevens' "Advanced
         Programming in the UNIX Environment" for details (ISBN 0201563177)
         http://www.erlenstar.demon.co.uk/unix/faq_2.html#SEC16
+
+        Call it before any event loop runs, the daemon starts its own once
+        it is detached, see run_loop().
         """
         try:
             pid = os.fork()
             if pid > 0:
-                # exit first parent
-                sys.exit(0)
+                # exit first parent, leaving the atexit handlers to the daemon
+                sys.stdout.flush()
+                os._exit(0)
         except OSError as osE:
             self.log.error(str(osE))
             sys.stderr.write("fork #1 failed: %d (%s)\n" % (osE.errno, osE.strerror))
@@ -84,7 +99,7 @@ class Daemon():
             pid = os.fork()
             if pid > 0:
                 # exit from second parent
-                sys.exit(0)
+                os._exit(0)
         except OSError as osE:
             self.log.error(str(osE))
             sys.stderr.write("fork #2 failed: %d (%s)\n" % (osE.errno, osE.strerror))
@@ -109,9 +124,17 @@ class Daemon():
 
     def delpid(self):
         """On an exit signal/handle, call this function which removes pid file"""
-        if os.path.exists(self.pidfile):
+        # After a reload the pidfile belongs to the successor
+        if os.path.exists(self.pidfile) and self.getpid() in (None, os.getpid()):
             os.remove(self.pidfile)
 
+    def getpid(self):
+        try:
+            with open(self.pidfile, 'r') as pf:
+                return int(pf.read().strip())
+        except (IOError, ValueError):
+            return None
+
     async def status(self):
         print("Daemon Status:", end="")
         if os.path.exists(self.pidfile):
@@ -122,7 +145,11 @@ class Daemon():
         print(f"\tLogfile: {os.path.normpath(self.logfile)}")
         print(f"\tPort: {self.port}")
 
-    async def start(self):
+    def run_loop(self, main):
+        """Run coroutine main on a new event loop, subclasses may pick the loop implementation"""
+        return asyncio.run(main)
+
+    def start(self):
         """
         Start the daemon
         """
@@ -141,8 +168,8 @@ class Daemon():
             sys.exit(1)
 
         # Start the daemon
-        result = await self.daemonize()
-        LOOP.run_until_complete(self.run())
+        result = self.daemonize()
+        self.run_loop(self.run())
 
     async def stop(self):
         """
@@ -161,26 +188,57 @@ class Daemon():
             sys.stderr.write(message % self.pidfile)
             return # not an error in a restart
 
-        # Try killing the daemon process
+        # Ask the daemon to stop once and wait for it to finish its shutdown
         try:
-            while True:
-                os.kill(pid, SIGTERM)
-                time.sleep(0.2)
+            os.kill(pid, SIGTERM)
+        except ProcessLookupError:
+            pass
         except OSError as osE:
-            err = str(osE)
-            if err.find("No such process") > 0:
-                if os.path.exists(self.pidfile):
-                    os.remove(self.pidfile)
-            else:
-                print(str(osE))
-                sys.exit(1)
-
-    async def restart(self):
+            print(str(osE))
+            sys.exit(1)
+        if not await wait_exit(pid, self.stop_timeout):
+            message = "Daemon %d did not stop within %gs, killing it\n"
+            sys.stderr.write(message % (pid, self.stop_timeout))
+            self.log.error(message % (pid, self.stop_timeout))
+            kill(pid)
+            await wait_exit(pid, KILL_TIMEOUT)
+        # A daemon killed outright leaves its pid file behind
+        if self.getpid() == pid:
+            os.remove(self.pidfile)
+
+    async def reload(self):
+        """
+        Ask a reloadable daemon to hand over to a successor, returns True once the
+        pidfile names the successor and the old process has exited
         """
-        Restart the daemon
+        pid = self.getpid()
+        if not pid:
+            sys.stderr.write("pidfile %s does not exist. Daemon not running?\n" % self.pidfile)
+            return False
+        try:
+            os.kill(pid, SIGHUP)
+        except ProcessLookupError:
+            sys.stderr.write("Daemon process %d is not running\n" % pid)
+            return False
+
+        if not await wait_exit(pid, self.RELOAD_TIMEOUT):
+            sys.stderr.write("Reload did not finish in %d seconds, see the log\n" % self.RELOAD_TIMEOUT)
+            return False
+        new_pid = self.getpid()
+        if new_pid and new_pid != pid:
+            print(f"Reloaded, daemon is now running as {new_pid}")
+            return True
+        sys.stderr.write("Daemon exited during the reload\n")
+        return False
+
+    def restart(self):
+        """
+        Restart the daemon, without dropping requests if it is reloadable
         """
-        await self.stop()
-        await self.start()
+        if self.reloadable and self.getpid() and self.run_loop(self.reload()):
+            return
+        self.run_loop(self.stop())
+        self.start()
 
 
     async def run(self):
@@ -191,6 +249,53 @@ class Daemon():
         await asyncio.sleep(2)
         self.log.info("default daemon run()")
 
+
+async def wait_exit(pid, timeout):
+    """
+    Wait up to timeout seconds for a process that is not our child to exit,
+    returns True once it did. Waits on a pidfd where the platform has them.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        fd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return True
+    except (AttributeError, OSError):
+        fd = None
+
+    if fd is not None:
+        exited = loop.create_future()
+        loop.add_reader(fd, lambda: exited.done() or exited.set_result(True))
+        try:
+            await asyncio.wait_for(exited, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        await asyncio.sleep(POLL_INTERVAL)
+    return False
+
+def kill(pid):
+    """SIGKILL pid along with its workers, the process group daemonize() gave it"""
+    try:
+        pgid = os.getpgid(pid)
+        if pgid != os.getpgrp():
+            os.killpg(pgid, SIGKILL)
+        else:
+            os.kill(pid, SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
 class TestDaemon(Daemon):
 
     async def sleep(self):
@@ -214,7 +319,10 @@ def stop():
 def main():
     daemon = TestDaemon(pidname=PIDNAME, pidpath=PIDPATH, silent=True)
     print(daemon)
-    asyncio.run(daemon.start() if not os.path.exists(PID) else daemon.restart())
+    if not os.path.exists(PID):
+        daemon.start()
+    else:
+        daemon.restart()
 
 if __name__ == "__main__":
     main()
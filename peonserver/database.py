@@ -0,0 +1,258 @@
+"""
+Pooled database access for route handlers.
+
+POOL keeps up to `size` SQLite connections open for the whole life of the
+process instead of each handler opening its own. Every connection runs its
+queries on a thread of its own, so handlers await them without blocking the
+event loop, and keeps its compiled statements in sqlite3's statement cache
+(`statement_cache` per connection), so a query repeated by many requests is
+only prepared once per connection.
+
+    db = self.settings["database"]
+    rows = await db.fetchall("SELECT id, name FROM users WHERE team = ?", (team,))
+
+    async with db.connection() as conn:
+        async with conn.transaction():
+            await conn.execute("UPDATE accounts SET balance = balance - ? WHERE id = ?", (amount, a))
+            await conn.execute("UPDATE accounts SET balance = balance + ? WHERE id = ?", (amount, b))
+
+When every connection is in use, callers wait up to `timeout` seconds for
+one and then get PoolTimeout, answered with 503 unless the handler catches
+it. Pool usage and query counts are part of --metrics.
+"""
+import os
+import time
+import sqlite3
+import asyncio
+import contextlib
+import concurrent.futures
+
+import tornado.web
+
+import peonserver.log as plog
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_TIMEOUT = 5.0  # seconds to wait for a free connection
+DEFAULT_STATEMENT_CACHE = 256  # compiled statements kept per connection
+BUSY_TIMEOUT = 5.0  # seconds SQLite waits on a lock held by another connection or process
+MEMORY = ":memory:"
+
+# Optional website globals.py names and the make_app keyword arguments they fill in
+WEBSITE_SETTINGS = {
+    "DATABASE": "database",
+    "DATABASE_POOL_SIZE": "database_pool_size",
+    "DATABASE_TIMEOUT": "database_timeout",
+}
+
+
+class PoolTimeout(tornado.web.HTTPError):
+    """No connection became free in time"""
+
+    def __init__(self, timeout):
+        super().__init__(503, f"No database connection free within {timeout:g}s")
+
+
+class Connection():
+    """One SQLite connection and the thread running its queries"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.generation = pool.generation
+        self.connection = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="database")
+
+    def connect(self):
+        if self.connection is None:
+            path = self.pool.path
+            if path != MEMORY:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None,
+                                         cached_statements=self.pool.statement_cache)
+            connection.row_factory = sqlite3.Row
+            if path != MEMORY:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            self.connection = connection
+        return self.connection
+
+    async def run(self, function, *args):
+        started = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            self.pool.queries += 1
+            self.pool.query_seconds += time.monotonic() - started
+
+    def _execute(self, sql, params):
+        cursor = self.connect().execute(sql, params)
+        return cursor.rowcount, cursor.lastrowid
+
+    def _executemany(self, sql, rows):
+        return self.connect().executemany(sql, rows).rowcount
+
+    def _fetchall(self, sql, params):
+        return self.connect().execute(sql, params).fetchall()
+
+    def _fetchone(self, sql, params):
+        return self.connect().execute(sql, params).fetchone()
+
+    async def execute(self, sql, params=()):
+        """Run a statement, returns (rowcount, lastrowid)"""
+        return await self.run(self._execute, sql, params)
+
+    async def executemany(self, sql, rows):
+        """Run a statement for every parameter tuple of rows, returns the rowcount"""
+        return await self.run(self._executemany, sql, list(rows))
+
+    async def fetchall(self, sql, params=()):
+        """Rows of a query as sqlite3.Row, indexable by position and column name"""
+        return await self.run(self._fetchall, sql, params)
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(self._fetchone, sql, params)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """BEGIN, then COMMIT, or ROLLBACK when the block raises"""
+        await self.execute("BEGIN")
+        try:
+            yield self
+        except BaseException:
+            await self.execute("ROLLBACK")
+            raise
+        await self.execute("COMMIT")
+
+    def _close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def close(self):
+        self.executor.submit(self._close).result()
+        self.executor.shutdown(wait=True)
+
+
+class Pool():
+    """
+    A bounded pool of connections to one database.
+
+    Usage: POOL.configure("/path/db.sqlite3") once per process, then use
+    connection() or the query shortcuts, which borrow a connection for a
+    single statement.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.idle = []
+        self.connections = 0
+        self.generation = 0
+        self.waiters = None
+        self.configure()
+
+    def configure(self, path=None, **kwargs):
+        """
+        :Parameters:
+            - path: SQLite database file, MEMORY for one in-memory database, None disables the pool
+            - size: connections kept open at most, default DEFAULT_POOL_SIZE (1 for MEMORY)
+            - timeout: seconds to wait for a free connection, default DEFAULT_TIMEOUT
+            - statement_cache: compiled statements per connection, default DEFAULT_STATEMENT_CACHE
+        """
+        self.close()
+        self.path = path
+        # Every connection to :memory: would be a database of its own
+        self.size = 1 if path == MEMORY else int(kwargs.get("size") or DEFAULT_POOL_SIZE)
+        self.timeout = kwargs.get("timeout") or DEFAULT_TIMEOUT
+        self.statement_cache = kwargs.get("statement_cache") or DEFAULT_STATEMENT_CACHE
+        self.in_use = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+        if path is not None:
+            plog.LOG.info(f"Database {path} with up to {self.size} connection(s)")
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    async def acquire(self):
+        if not self.enabled:
+            raise RuntimeError("No database is configured, see DATABASE in the website globals.py")
+        if self.waiters is None:
+            # Created on first use, on the loop serving this process
+            self.waiters = asyncio.Condition()
+        started = time.monotonic()
+        async with self.waiters:
+            if not self.idle and self.connections >= self.size:
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(
+                        self.waiters.wait_for(lambda: self.idle or self.connections < self.size), self.timeout)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    raise PoolTimeout(self.timeout)
+                finally:
+                    self.waiting -= 1
+            if self.idle:
+                connection = self.idle.pop()
+            else:
+                connection = Connection(self)
+                self.connections += 1
+            self.in_use += 1
+        self.acquired += 1
+        self.wait_seconds += time.monotonic() - started
+        return connection
+
+    async def release(self, connection):
+        if connection.generation != self.generation:
+            # The pool was closed or reconfigured while it was in use
+            connection.close()
+            return
+        if connection.connection is not None and connection.connection.in_transaction:
+            # Left open by a handler, do not hand it to the next one
+            await connection.execute("ROLLBACK")
+        async with self.waiters:
+            self.in_use -= 1
+            self.idle.append(connection)
+            # Waiters check for themselves, one of them may have just timed out
+            self.waiters.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        """Borrow a connection for several statements or a transaction"""
+        connection = await self.acquire()
+        try:
+            yield connection
+        finally:
+            await self.release(connection)
+
+    async def execute(self, sql, params=()):
+        async with self.connection() as connection:
+            return await connection.execute(sql, params)
+
+    async def executemany(self, sql, rows):
+        async with self.connection() as connection:
+            return await connection.executemany(sql, rows)
+
+    async def fetchall(self, sql, params=()):
+        async with self.connection() as connection:
+            return await connection.fetchall(sql, params)
+
+    async def fetchone(self, sql, params=()):
+        async with self.connection() as connection:
+            return await connection.fetchone(sql, params)
+
+    def close(self):
+        """Close the idle connections, those in use are closed when they are returned"""
+        for connection in self.idle:
+            connection.close()
+        self.idle = []
+        self.connections = 0
+        self.generation += 1
+        self.waiters = None
+
+
+POOL = Pool()
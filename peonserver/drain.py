@@ -0,0 +1,94 @@
+"""
+Connection draining for graceful stops and reloads.
+
+DrainingHTTPServer is tornado's HTTPServer keeping track of which
+connections are in the middle of a request. drain() stops accepting, closes
+idle keep-alive connections right away and every other connection as soon as
+its response is finished, and only cuts off the requests still running when
+the deadline passes.
+"""
+import asyncio
+
+import tornado.httputil
+import tornado.httpserver
+
+import peonserver.log as plog
+
+DEFAULT_DRAIN_TIMEOUT = 30.0  # seconds
+SHUTDOWN_GRACE = 5.0  # seconds on top of the drain timeout for the rest of a shutdown
+
+
+class BusyDelegate(tornado.httputil.HTTPMessageDelegate):
+    """Marks its connection busy from the request headers until the next request starts"""
+
+    def __init__(self, server, server_conn, delegate):
+        self.server = server
+        self.server_conn = server_conn
+        self.delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        self.server.busy.add(self.server_conn)
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        return self.delegate.finish()
+
+    def on_connection_close(self):
+        return self.delegate.on_connection_close()
+
+
+class DrainingHTTPServer(tornado.httpserver.HTTPServer):
+
+    def initialize(self, *args, **kwargs):
+        super().initialize(*args, **kwargs)
+        self.connections = set()
+        self.busy = set()
+        self.draining = False
+        self.idle = None
+
+    def start_request(self, server_conn, request_conn):
+        # Called when a connection opens and again once each response is finished
+        self.connections.add(server_conn)
+        self.busy.discard(server_conn)
+        if self.draining:
+            asyncio.ensure_future(server_conn.close())
+            self.check_idle()
+        return BusyDelegate(self, server_conn, super().start_request(server_conn, request_conn))
+
+    def on_close(self, server_conn):
+        super().on_close(server_conn)
+        self.connections.discard(server_conn)
+        self.busy.discard(server_conn)
+        self.check_idle()
+
+    def check_idle(self):
+        if self.idle is not None and not self.busy:
+            self.idle.set()
+
+    @property
+    def in_flight(self):
+        return len(self.busy)
+
+    def abort(self):
+        """Stop waiting for in-flight requests in a running drain()"""
+        if self.idle is not None:
+            self.idle.set()
+
+    async def drain(self, timeout=DEFAULT_DRAIN_TIMEOUT):
+        """Stop accepting and wait up to timeout seconds for in-flight requests, then close everything"""
+        self.stop()
+        self.draining = True
+        self.idle = asyncio.Event()
+        for conn in list(self.connections - self.busy):
+            asyncio.ensure_future(conn.close())
+        self.check_idle()
+        if self.busy:
+            plog.LOG.info(f"Draining {len(self.busy)} in-flight request(s) for up to {timeout:g}s")
+            try:
+                await asyncio.wait_for(self.idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                plog.LOG.warning(f"Drain deadline passed, closing {len(self.busy)} unfinished request(s)")
+        await self.close_all_connections()
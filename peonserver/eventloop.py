@@ -0,0 +1,123 @@
+"""
+Event loop bootstrap and blocked loop watchdog.
+
+run() replaces asyncio.run() for every loop PeonServer starts, the server,
+each forked worker and the daemon commands, with the loop implementation
+picked by --loop: uvloop when it is installed ("auto", the default) or the
+standard asyncio loop.
+
+A Watchdog finds the code stalling a loop. The loop bumps a heartbeat
+several times per threshold and a watchdog thread checks on it: when the
+heartbeat is more than `threshold` seconds late, the thread logs the stack of
+the loop's thread at that moment, which is the callback or coroutine step
+blocking it, and once the loop runs again how long it was blocked for.
+"""
+import os
+import sys
+import time
+import asyncio
+import threading
+import traceback
+
+import peonserver.log as plog
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+AUTO = "auto"
+ASYNCIO = "asyncio"
+UVLOOP = "uvloop"
+LOOPS = (AUTO, ASYNCIO, UVLOOP)
+ASYNCIO_EVENTS = os.path.join("asyncio", "events.py")  # where Handle._run calls each callback
+MAX_HEARTBEAT = 0.25  # seconds between heartbeats at most, shorter for low thresholds
+
+
+def loop_factory(name=AUTO):
+    """Event loop constructor for a --loop choice, None for asyncio's default"""
+    if name in (None, AUTO):
+        return uvloop.new_event_loop if uvloop is not None else None
+    if name == UVLOOP:
+        if uvloop is None:
+            raise RuntimeError("--loop uvloop needs the uvloop package")
+        return uvloop.new_event_loop
+    if name == ASYNCIO:
+        return None
+    raise ValueError(f"Unknown event loop {name}, choose one of {', '.join(LOOPS)}")
+
+def run(main, name=AUTO, debug=None):
+    """asyncio.run(main) on a new loop of the chosen implementation"""
+    with asyncio.Runner(debug=debug, loop_factory=loop_factory(name)) as runner:
+        return runner.run(main)
+
+def describe(loop):
+    return f"{type(loop).__module__}.{type(loop).__name__}"
+
+
+def blocking_frames(frame):
+    """Stack of frame from the callback the loop is running, without the loop's own frames"""
+    frames = traceback.extract_stack(frame)
+    for i in range(len(frames) - 1, -1, -1):
+        if frames[i].name == "_run" and frames[i].filename.endswith(ASYNCIO_EVENTS):
+            return frames[i + 1:]
+    return frames
+
+
+class Watchdog():
+    """
+    Logs where an event loop is blocked for longer than threshold seconds.
+
+    Usage: watchdog = Watchdog(0.5).start() on the loop to watch, watchdog.stop()
+    before that loop is closed.
+    """
+
+    def __init__(self, threshold, logger=None):
+        self.threshold = float(threshold)
+        self.interval = min(self.threshold / 2, MAX_HEARTBEAT)
+        self.log = logger or plog.LOG
+        self.loop = None
+        self.thread = None
+        self.thread_id = None
+        self.handle = None
+        self.stopped = threading.Event()
+        self.beat = 0.0
+        self.reported = False
+        self.stalls = 0
+
+    def start(self, loop=None):
+        self.loop = loop or asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self.stopped.clear()
+        self.heartbeat()
+        self.thread = threading.Thread(target=self.watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+        self.log.info(f"Watching {describe(self.loop)} for callbacks blocking it over {self.threshold:g}s")
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def heartbeat(self):
+        now = time.monotonic()
+        if self.reported:
+            self.reported = False
+            self.log.warning(f"Event loop was blocked for {now - self.beat - self.interval:.3f}s")
+        self.beat = now
+        self.handle = self.loop.call_later(self.interval, self.heartbeat)
+
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            late = time.monotonic() - self.beat - self.interval
+            if late > self.threshold and not self.reported:
+                self.reported = True
+                self.stalls += 1
+                frame = sys._current_frames().get(self.thread_id)
+                stack = "".join(traceback.format_list(blocking_frames(frame))) if frame is not None else "(no stack)\n"
+                self.log.warning(f"Event loop blocked for more than {self.threshold:g}s, at:\n{stack.rstrip()}")
@@ -0,0 +1,154 @@
+"""
+Listening socket handoff for zero-downtime reloads.
+
+On SIGHUP the process owning the listening sockets (the single server process,
+or the supervisor of the workers) starts a successor: the same command line in
+the original working directory, with the socket descriptors passed to it and
+named in PEONSERVER_LISTEN_FDS. The successor serves those sockets instead of
+binding the port, so connections keep queueing on the same socket throughout.
+
+Readiness is reported through a pipe named in PEONSERVER_READY_FD: the
+successor first writes how many serving processes it starts, then each of
+them writes one byte once its HTTP server accepts. Only when all of them have
+done so does the old process stop accepting and drain its in-flight requests.
+If the successor fails to get ready it is terminated and nothing changes.
+"""
+import os
+import sys
+import time
+import select
+import socket
+import subprocess
+
+import peonserver.log as plog
+
+LISTEN_FDS_ENV = "PEONSERVER_LISTEN_FDS"
+READY_FD_ENV = "PEONSERVER_READY_FD"
+READY_TIMEOUT = 60.0  # seconds for a successor to build its apps and accept
+
+CWD = os.getcwd()  # daemonizing changes to /, the successor runs where we were started
+PIDFILE = None  # set by the daemon, rewritten with the successor's pid once it took over
+
+_ready_fd = None
+
+
+def is_successor():
+    """True if this process was started by a reload and inherits its sockets"""
+    return LISTEN_FDS_ENV in os.environ
+
+def inherited_sockets():
+    """Listening sockets passed by the process we replace, or None"""
+    global _ready_fd
+    fds = os.environ.pop(LISTEN_FDS_ENV, None)
+    ready = os.environ.pop(READY_FD_ENV, None)
+    if not fds:
+        return None
+    _ready_fd = int(ready) if ready else None
+    sockets = []
+    for fd in fds.split(","):
+        sock = socket.socket(fileno=int(fd))
+        sock.setblocking(False)
+        sockets.append(sock)
+    plog.LOG.info(f"Serving {len(sockets)} inherited listening socket(s)")
+    return sockets
+
+def announce(count):
+    """Tell the process we replace how many serving processes will report ready"""
+    if _ready_fd is not None:
+        os.write(_ready_fd, f"{count}\n".encode())
+
+def ready():
+    """Report this serving process as accepting, once per process"""
+    global _ready_fd
+    if _ready_fd is not None:
+        try:
+            os.write(_ready_fd, b".")
+            os.close(_ready_fd)
+        except OSError:
+            pass
+        _ready_fd = None
+
+def close_ready():
+    """Forget the ready pipe in a supervisor once its workers were forked"""
+    global _ready_fd
+    if _ready_fd is not None:
+        os.close(_ready_fd)
+        _ready_fd = None
+
+
+def successor_command():
+    argv = getattr(sys, "orig_argv", None) or [sys.executable] + sys.argv
+    # A daemon started by `restart` must not restart itself again
+    return [sys.executable] + ["start" if a == "restart" else a for a in argv[1:]]
+
+def wait_ready(fd, process, timeout):
+    expected = None
+    received = b""
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            plog.LOG.error(f"Successor {process.pid} did not get ready within {timeout:g}s")
+            return False
+        readable, _, _ = select.select([fd], [], [], remaining)
+        if not readable:
+            continue
+        chunk = os.read(fd, 64)
+        if not chunk:
+            plog.LOG.error(f"Successor {process.pid} exited before getting ready")
+            return False
+        received += chunk
+        if expected is None and b"\n" in received:
+            head, received = received.split(b"\n", 1)
+            expected = int(head)
+        if expected is not None and received.count(b".") >= expected:
+            return True
+
+def write_pidfile(pid):
+    tmp = f"{PIDFILE}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(f"{pid}\n")
+    os.replace(tmp, PIDFILE)
+
+def replace(sockets, timeout=READY_TIMEOUT):
+    """
+    Start a successor serving sockets and block until it accepts on them.
+
+    Returns True once the successor took over, the caller should then stop
+    accepting and drain. Returns False if it failed, the caller keeps serving.
+    """
+    read_fd, write_fd = os.pipe()
+    fds = [s.fileno() for s in sockets]
+    env = dict(os.environ)
+    env[LISTEN_FDS_ENV] = ",".join(str(fd) for fd in fds)
+    env[READY_FD_ENV] = str(write_fd)
+    command = successor_command()
+    plog.LOG.info(f"Reloading, starting successor: {' '.join(command)}")
+    try:
+        process = subprocess.Popen(command, cwd=CWD, env=env, pass_fds=fds + [write_fd])
+    except OSError as E:
+        plog.LOG.error(f"Could not start successor: {E}")
+        os.close(read_fd)
+        os.close(write_fd)
+        return False
+    os.close(write_fd)
+    try:
+        took_over = wait_ready(read_fd, process, timeout)
+    finally:
+        os.close(read_fd)
+
+    if not took_over:
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        return False
+
+    plog.LOG.info(f"Successor {process.pid} is accepting, handing over")
+    if PIDFILE:
+        try:
+            write_pidfile(process.pid)
+        except OSError as E:
+            plog.LOG.error(f"Could not write pid file {PIDFILE}: {E}")
+    return True
@@ -0,0 +1,199 @@
+"""
+In-process reloading for --debug.
+
+Instead of tornado.autoreload re-executing the whole process on every change,
+make_app subscribes a HotReloader to its file watcher. Changes are collected
+for a moment and then applied to the running application:
+
+- sass sources: the sass build recompiles only the entrypoints importing them
+- static files: bundles including them are written again, the static build
+  refingerprints the changed files and the
+  application switches to the new manifest (the static cache and page cache
+  drop their entries through their own subscriptions)
+- route modules: only the changed module is imported again, lazily loaded
+  modules on their next request
+- templates: see templates.TemplateReloader
+
+Anything else, such as a changed globals.py, a new route module or the
+peonserver sources, restarts the process. With a SIGHUP handler installed
+(see server.serve) that is a reload handing the listening sockets over, so
+no requests are dropped, otherwise the process executes itself again.
+"""
+import os
+import sys
+import signal
+import asyncio
+import traceback
+
+import tornado.ioloop
+
+import peonserver.log as plog
+import peonserver.sassbuild as sassbuild
+import peonserver.staticbuild as staticbuild
+from peonserver import bundles
+from peonserver import routing
+from peonserver.watch import OVERFLOW
+
+RELOAD_DELAY = 0.1  # seconds, editors write files in several steps
+IGNORED_SUFFIXES = (".tmp", ".pyc", ".swp", "~")
+
+
+def within(path, root):
+    return root is not None and (path + os.sep).startswith(root.rstrip(os.sep) + os.sep)
+
+def restart():
+    """Restart the process, through the socket handoff when serve() listens for SIGHUP"""
+    handler = signal.getsignal(signal.SIGHUP)
+    if handler not in (signal.SIG_DFL, signal.SIG_IGN, None):
+        os.kill(os.getpid(), signal.SIGHUP)
+    else:
+        reexec()
+
+def reexec():
+    """Replace the process with a new run of the same command line"""
+    plog.stop_queue()  # records still queued would be lost
+    spec = getattr(sys.modules["__main__"], "__spec__", None)
+    if spec is not None:
+        argv = [sys.executable, "-m", spec.name] + sys.argv[1:]  # started with python -m
+    else:
+        argv = [sys.executable] + sys.argv
+    os.execv(sys.executable, argv)
+
+
+class HotReloader():
+    """Watcher subscriber applying source changes to one running application"""
+
+    def __init__(self, application, **kwargs):
+        """
+        :Parameters:
+            - static_path: served static directory, its sass sources are rebuilt too
+            - build_path: static build output, changes there are ignored
+            - template_path: handled by templates.TemplateReloader, ignored here
+            - route_path: directory of the route modules
+            - prefix: package qualifying the route module names, see routing.load_routes
+            - lazy: LazyRouteModule list from routing.load_routes
+            - on_load: on_load(ROUTES) for every route module imported again
+            - bundles: BUNDLES of the website, see peonserver.bundles
+            - source_paths: directories restarting the process when a python file below them changes
+            - watch_paths: directories or files restarting the process when anything below them
+              changes that is not handled otherwise
+        """
+        self.application = application
+        self.static_path = kwargs.get("static_path")
+        self.sass_path = sassbuild.find_sass_dir(self.static_path) if self.static_path else None
+        self.build_path = kwargs.get("build_path")
+        self.template_path = kwargs.get("template_path")
+        self.route_path = kwargs.get("route_path")
+        self.prefix = kwargs.get("prefix")
+        self.lazy = {module.name: module for module in kwargs.get("lazy", [])}
+        self.on_load = kwargs.get("on_load")
+        self.bundles = kwargs.get("bundles")
+        self.source_paths = [os.path.abspath(p) for p in kwargs.get("source_paths", [])]
+        self.watch_paths = [os.path.abspath(p) for p in kwargs.get("watch_paths", [])]
+        self.changed = set()
+        self.pending = False
+        self.building = None
+        self.restarting = False
+
+    def __call__(self, path):
+        if self.restarting:
+            return
+        if path is not OVERFLOW:
+            if os.path.basename(path).startswith(".") or path.endswith(IGNORED_SUFFIXES) \
+                    or "__pycache__" in path.split(os.sep) or within(path, self.build_path):
+                return
+        self.changed.add(path)
+        if not self.pending:
+            self.pending = True
+            tornado.ioloop.IOLoop.current().call_later(RELOAD_DELAY, self.apply)
+
+    def apply(self):
+        self.pending = False
+        changed, self.changed = self.changed, set()
+        if OVERFLOW in changed:
+            plog.LOG.warning("File change events were lost, restarting")
+            return self.restart()
+
+        sass = False
+        static = False
+        for path in sorted(changed):
+            if within(path, self.sass_path):
+                sass = True
+            elif within(path, self.static_path):
+                static = True
+            elif within(path, self.route_path):
+                if path.endswith(".py") and not self.reload_route(path):
+                    return self.restart()
+            elif within(path, self.template_path):
+                continue
+            elif path.endswith(".py") and any(within(path, p) for p in self.source_paths) or \
+                    os.path.exists(path) and any(within(path, p) for p in self.watch_paths):
+                plog.LOG.info(f"{path} changed, restarting")
+                return self.restart()
+        if sass or static:
+            self.build(sass)
+
+    def restart(self):
+        self.restarting = True
+        restart()
+
+    def reload_route(self, path):
+        """Import the changed route module again, False if that needs a restart"""
+        name = os.path.splitext(os.path.basename(path))[0]
+        if self.prefix:
+            name = f"{self.prefix}.{name}"
+        module = self.lazy.get(name)
+        try:
+            if module is not None:
+                if module.patterns != self.read_patterns(path, module.patterns):
+                    plog.LOG.info(f"URL patterns of route module {name} changed, restarting")
+                    return False
+                module.reload()
+                plog.LOG.info(f"Route module {name} will be imported again on its next request")
+                return True
+            if name not in sys.modules or not os.path.exists(path):
+                plog.LOG.info(f"Route module {name} was added or removed, restarting")
+                return False
+            if not routing.reload_module(self.application, name, self.on_load):
+                plog.LOG.info(f"Rules of route module {name} cannot be replaced in place, restarting")
+                return False
+            plog.LOG.info(f"Reloaded route module {name}")
+        except Exception as E:
+            # Keep the old routes until the module is fixed
+            plog.LOG.error(f"Failed to reload route module {name}: {E}")
+            plog.LOG.error(traceback.format_exc())
+        return True
+
+    def read_patterns(self, path, patterns):
+        """URL patterns the changed module declares, patterns itself when they were declared in globals.py"""
+        if self.application.settings.get("ROUTE_MANIFEST"):
+            return patterns
+        try:
+            with open(path, 'rb') as f:
+                return routing.static_patterns(f.read(), path)
+        except (IOError, OSError):
+            return None
+
+    def build(self, sass):
+        if self.building is not None and not self.building.done():
+            # Build again once the running build is done
+            self.building.add_done_callback(lambda f: self.build(sass))
+            return
+        self.building = asyncio.ensure_future(self.rebuild(sass))
+
+    async def rebuild(self, sass):
+        loop = asyncio.get_running_loop()
+        try:
+            if sass:
+                await loop.run_in_executor(None, sassbuild.build, self.static_path)
+            await loop.run_in_executor(None, bundles.build, self.static_path, self.bundles)
+            manifest = await loop.run_in_executor(None, staticbuild.build, self.static_path)
+        except Exception as E:
+            plog.LOG.error(f"Static rebuild failed: {E}")
+            plog.LOG.error(traceback.format_exc())
+            return
+        self.application.settings["static_manifest"] = manifest
+        pages = self.application.settings.get("page_cache")
+        if pages is not None:
+            # Pages rendered during the build may link to the old fingerprints
+            pages.clear()
@@ -0,0 +1,259 @@
+"""
+CPU-bound and periodic background jobs.
+
+A handler resizing an image or rendering a report holds the event loop, and
+every other request of the process, for as long as the work takes. JOBS runs
+such work in a pool of separate processes instead, so it uses other cores
+and the loop keeps serving:
+
+    thumbnail = await jobs.JOBS.run_cpu(make_thumbnail, path, width=200)
+
+The function and its arguments are pickled to the pool, so the function must
+be defined at module level, in a route module or any other importable one.
+At most `cpu_workers` calls run at once and up to `max_queue` more wait for
+a free process, further calls are answered with 503. Work that should go on
+after the response is sent is started with background(), which keeps track
+of it and cancels it when the server stops.
+
+Periodic jobs replace cron entries for the website. They are declared in
+globals.py, or registered with JOBS.every() by a route module, and run in one
+process only, the first worker:
+
+    PERIODIC_JOBS = {
+        "prune uploads": (3600, prune_uploads),
+    }
+
+Coroutine functions are awaited on the loop, other functions run in the
+process pool. A job is started again `seconds` after its last run ended, so
+runs of a slow job never overlap.
+"""
+import os
+import time
+import signal
+import asyncio
+import threading
+import functools
+import multiprocessing
+import concurrent.futures
+import concurrent.futures.process
+
+import tornado.web
+
+import peonserver.log as plog
+import peonserver.workers as pworkers
+
+DEFAULT_MAX_QUEUE = 256
+START_METHOD = "forkserver"  # pool processes do not inherit the threads and sockets of a worker
+ORPHAN_CHECK = 1.0  # seconds between pool process checks for a dead worker
+
+# Optional website globals.py names and the make_app keyword arguments they fill in
+WEBSITE_SETTINGS = {
+    "CPU_WORKERS": "cpu_workers",
+    "CPU_QUEUE": "cpu_queue",
+    "PERIODIC_JOBS": "periodic_jobs",
+}
+
+
+def init_process(worker_pid, started=None):
+    if started is not None:
+        started.put(os.getpid())
+    # Ctrl-C and service managers signal the whole process group, stopping the pool is up to the worker
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    threading.Thread(target=exit_orphaned, args=(worker_pid,), name="orphan-check", daemon=True).start()
+
+def exit_orphaned(worker_pid):
+    # A worker killed before it stopped its pool must not leave the pool behind
+    while True:
+        time.sleep(ORPHAN_CHECK)
+        try:
+            os.kill(worker_pid, 0)
+        except ProcessLookupError:
+            os._exit(1)
+        except PermissionError:
+            pass
+
+def describe(function):
+    return getattr(function, "__qualname__", None) or repr(function)
+
+
+class JobRunner():
+    """
+    A process pool for CPU-bound calls and a scheduler for periodic jobs.
+
+    Usage: JOBS.configure(cpu_workers=2) once per process and start() on its
+    loop, then await run_cpu() from handlers. unschedule() and await close()
+    when the server stops.
+    """
+
+    def __init__(self):
+        self.executor = None
+        self.started = None  # pids of the pool processes, reported by init_process
+        self.periodic = {}
+        self.tasks = set()
+        self.configure()
+
+    def configure(self, **kwargs):
+        """
+        :Parameters:
+            - cpu_workers: processes of the pool, defaults to the CPUs divided among the HTTP workers
+            - max_queue: calls waiting for a free process before 503, default DEFAULT_MAX_QUEUE
+            - share: number of HTTP worker processes each getting a pool, default 1
+            - periodic: {name: (seconds, function)} of periodic jobs
+            - schedule: run the periodic jobs in this process, by default only in the first worker
+        """
+        self.unschedule()
+        self.shutdown_executor()
+        self.cpu_workers = int(kwargs.get("cpu_workers") or max(1, pworkers.cpu_count() // (kwargs.get("share") or 1)))
+        max_queue = kwargs.get("max_queue")
+        self.max_queue = DEFAULT_MAX_QUEUE if max_queue is None else max_queue
+        schedule = kwargs.get("schedule")
+        self.schedule = pworkers.WORKER_ID in (None, 0) if schedule is None else schedule
+        self.slots = None
+        self.loop = None
+        self.periodic = {}
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.periodic_runs = 0
+        self.periodic_failures = 0
+        for name, (seconds, function) in (kwargs.get("periodic") or {}).items():
+            self.every(seconds, function, name=name)
+
+    def get_executor(self):
+        if self.executor is None:
+            # Created on first use, every worker gets a pool of its own
+            context = multiprocessing.get_context(START_METHOD)
+            self.started = context.SimpleQueue()
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.cpu_workers, mp_context=context,
+                initializer=init_process, initargs=(os.getpid(), self.started))
+            plog.LOG.info(f"Started {self.cpu_workers} CPU job process(es)")
+        return self.executor
+
+    async def run_cpu(self, function, *args, **kwargs):
+        """function(*args, **kwargs) in a pool process once one is free, returns its result"""
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.cpu_workers)
+        if self.slots.locked():
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                plog.LOG.warning(f"{self.waiting} CPU jobs waiting, refusing more")
+                raise tornado.web.HTTPError(503)
+            self.waiting += 1
+            try:
+                await self.slots.acquire()
+            finally:
+                self.waiting -= 1
+        else:
+            await self.slots.acquire()
+        self.running += 1
+        executor = self.get_executor()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                executor, functools.partial(function, *args, **kwargs))
+        except concurrent.futures.process.BrokenProcessPool:
+            # A pool process died (killed, out of memory), the next call gets a new pool
+            self.failed += 1
+            if self.executor is executor:
+                plog.LOG.error(f"CPU job process died running {describe(function)}, restarting the pool")
+                self.executor = None
+                executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.running -= 1
+            self.slots.release()
+        self.completed += 1
+        return result
+
+    def background(self, awaitable, name=None):
+        """Run awaitable after the response, errors are logged and it is cancelled on shutdown"""
+        task = asyncio.ensure_future(awaitable)
+        self.tasks.add(task)
+
+        def done(task):
+            self.tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                plog.LOG.error(f"Background job {name or task.get_name()} failed: {task.exception()!r}")
+        task.add_done_callback(done)
+        return task
+
+    def every(self, seconds, function, name=None):
+        """Run function every seconds, started now if this process is already scheduling"""
+        name = name or describe(function)
+        self.unschedule(name)
+        self.periodic[name] = [float(seconds), function, None]
+        if self.loop is not None and self.schedule:
+            self.periodic[name][2] = asyncio.ensure_future(self.repeat(name, float(seconds), function))
+
+    def start(self):
+        """Start the periodic jobs on the running loop"""
+        self.loop = asyncio.get_running_loop()
+        if not self.schedule:
+            return
+        for name, job in self.periodic.items():
+            if job[2] is None:
+                job[2] = asyncio.ensure_future(self.repeat(name, job[0], job[1]))
+        if self.periodic:
+            plog.LOG.info(f"Scheduled {len(self.periodic)} periodic job(s): {', '.join(self.periodic)}")
+
+    async def repeat(self, name, seconds, function):
+        while True:
+            await asyncio.sleep(seconds)
+            self.periodic_runs += 1
+            try:
+                if asyncio.iscoroutinefunction(function):
+                    await function()
+                else:
+                    await self.run_cpu(function)
+            except asyncio.CancelledError:
+                raise
+            except Exception as E:
+                self.periodic_failures += 1
+                plog.LOG.error(f"Periodic job {name} failed: {E!r}")
+
+    def unschedule(self, name=None):
+        """Cancel the periodic job name, or all of them, running ones are interrupted"""
+        for job_name, job in list(self.periodic.items()):
+            if name in (None, job_name) and job[2] is not None:
+                job[2].cancel()
+                job[2] = None
+        if name is not None:
+            self.periodic.pop(name, None)
+
+    async def close(self):
+        """Cancel the periodic and background jobs and stop the pool processes"""
+        self.unschedule()
+        tasks, self.tasks = list(self.tasks), set()
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            plog.LOG.info(f"Cancelled {len(tasks)} background job(s)")
+        self.shutdown_executor()
+        self.loop = None
+
+    def shutdown_executor(self):
+        executor, self.executor = self.executor, None
+        if executor is None:
+            return
+        pids = set()
+        while not self.started.empty():
+            pids.add(self.started.get())
+        # Processes still busy are jobs nobody waits for anymore, stop them rather than the shutdown
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in multiprocessing.active_children():
+            if process.pid in pids:
+                process.kill()
+        # Lets the pool close its queues now, forked workers leave with os._exit and skip their cleanup
+        executor.shutdown(wait=True)
+        self.started.close()
+        self.started = None
+
+
+JOBS = JobRunner()
@@ -0,0 +1,114 @@
+"""
+Listening addresses and HTTP server settings.
+
+By default the server listens on `--port` on every interface. Behind a
+local reverse proxy it can listen on a unix domain socket instead, which
+skips the TCP loopback stack, and/or on a list of addresses:
+
+    --unix-socket /run/peonserver.sock --bind 127.0.0.1 --bind [::1]:8086
+
+The HTTPServer settings (timeouts, buffer and body sizes, keep-alive,
+X-Real-Ip/X-Forwarded-For handling) come from the command line or the
+website globals.py, the command line taking precedence.
+"""
+import os
+import socket
+
+import tornado.netutil
+
+import peonserver.log as plog
+
+DEFAULT_BACKLOG = socket.SOMAXCONN  # the kernel may cap it lower, see net.core.somaxconn
+DEFAULT_SOCKET_MODE = 0o600  # only the server's user may connect, see --unix-socket-mode
+
+# Optional website globals.py names and the keyword arguments they fill in
+BIND_SETTINGS = {
+    "BIND": "bind",
+    "UNIX_SOCKET": "unix_socket",
+    "UNIX_SOCKET_MODE": "unix_socket_mode",
+    "BACKLOG": "backlog",
+}
+SERVER_SETTINGS = {
+    "XHEADERS": "xheaders",
+    "NO_KEEP_ALIVE": "no_keep_alive",
+    "IDLE_TIMEOUT": "idle_connection_timeout",
+    "BODY_TIMEOUT": "body_timeout",
+    "MAX_BUFFER_SIZE": "max_buffer_size",
+    "MAX_BODY_SIZE": "max_body_size",
+}
+WEBSITE_SETTINGS = dict(BIND_SETTINGS, **SERVER_SETTINGS)
+
+
+def resolve(names, kwargs, website):
+    """Options named in names from kwargs, falling back to the website globals"""
+    options = {}
+    for name, option in names.items():
+        value = kwargs.get(option)
+        if value is None:
+            value = website.get(name)
+        if value is not None:
+            options[option] = value
+    return options
+
+def parse_address(value, port):
+    """(host, port) of "host", "host:port", "[v6]" or "[v6]:port", host "" meaning every interface"""
+    value = str(value).strip()
+    if value.startswith("["):
+        host, _, rest = value[1:].partition("]")
+        return host, int(rest[1:]) if rest.startswith(":") else int(port)
+    if value.count(":") == 1:
+        host, _, number = value.partition(":")
+        return host, int(number)
+    # A bare IPv6 address or a host name
+    return value, int(port)
+
+def bind(port, **kwargs):
+    """
+    Bind the listening sockets.
+
+    :Parameters:
+        - bind: addresses to listen on, each "host", "host:port" or "[v6]:port"
+        - unix_socket: path of a unix domain socket to listen on
+        - unix_socket_mode: permissions of the socket file, default DEFAULT_SOCKET_MODE
+        - backlog: connections waiting to be accepted, default DEFAULT_BACKLOG
+
+    Without bind and unix_socket the port is bound on every interface.
+    """
+    backlog = int(kwargs.get("backlog") or DEFAULT_BACKLOG)
+    addresses = kwargs.get("bind") or []
+    if isinstance(addresses, str):
+        addresses = [addresses]
+    unix_socket = kwargs.get("unix_socket")
+    if not addresses and not unix_socket:
+        addresses = [""]
+
+    sockets = []
+    for value in addresses:
+        host, number = parse_address(value, port)
+        sockets.extend(tornado.netutil.bind_sockets(number, host or None, backlog=backlog))
+    if unix_socket:
+        mode = kwargs.get("unix_socket_mode", DEFAULT_SOCKET_MODE)
+        if isinstance(mode, str):
+            mode = int(mode, 8)
+        # A socket file left by a previous run is replaced
+        sockets.append(tornado.netutil.bind_unix_socket(os.path.abspath(unix_socket), mode=mode, backlog=backlog))
+    plog.LOG.info(f"Listening on {', '.join(describe(s) for s in sockets)}")
+    return sockets
+
+def describe(sock):
+    if sock.family == socket.AF_UNIX:
+        return f"unix:{sock.getsockname()}"
+    host, number = sock.getsockname()[:2]
+    return f"[{host}]:{number}" if sock.family == socket.AF_INET6 else f"{host}:{number}"
+
+def body_limit(kwargs, website):
+    """Request body size limit of the server, None for tornado's default"""
+    options = resolve(SERVER_SETTINGS, kwargs, website)
+    return options.get("max_body_size") or options.get("max_buffer_size")
+
+def server_options(kwargs, website):
+    """HTTPServer keyword arguments"""
+    options = resolve(SERVER_SETTINGS, kwargs, website)
+    for option in ("xheaders", "no_keep_alive"):
+        options[option] = bool(options.get(option))
+    return options
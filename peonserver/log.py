@@ -1,16 +1,30 @@
+import os
+import json
 import time
+import queue
+import atexit
+import random
 import logging
 import logging.handlers
+import multiprocessing
 
 LOG = logging.getLogger('peonserver ')  # init to a default value first
+ACCESS_LOG = logging.getLogger("tornado.access")
+FORMAT = '%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s'
+LISTENER = None  # QueueListener writing records for every handler on the root logger
+_listening = False
+WORKER_QUEUE = None  # multiprocessing queue forked workers send their records through, see share_with_workers()
+WORKER_LISTENER = None  # QueueListener writing the workers' records in the process that forked them
+_forwarding = False  # this process is a worker sending its records to WORKER_QUEUE
 
 def set_logger(logfile=None, level=logging.DEBUG, name="peonserver") -> None:
+    global LOG
     if logfile is None:
         # level does not set correctly when done this way, so set it after too.
         logging.basicConfig(level=level,
                             filename=logfile,
                             filemode='a' if logfile else None,
-                            format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+                            format=FORMAT,
                             datefmt='%H:%M:%S'
         )
         LOG = logging.getLogger(f'{name} ')
@@ -18,14 +32,126 @@ def set_logger(logfile=None, level=logging.DEBUG, name="peonserver") -> None:
     else:
         handler = logging.handlers.RotatingFileHandler(
             logfile, maxBytes=1000000*5, backupCount=5)  # 5 MB
-        formatter = logging.Formatter(
-            '%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-            '%H:%M:%S')
+        formatter = logging.Formatter(FORMAT, '%H:%M:%S')
         formatter.converter = time.gmtime
         handler.setFormatter(formatter)
         LOG = logging.getLogger(f'{name} ')
-        LOG.addHandler(handler)
+        # On the root logger so tornado's own loggers end up in the file too
+        logging.getLogger().addHandler(handler)
 
     LOG.setLevel(level)
+    start_queue()
 
+def start_queue() -> None:
+    """
+    Move the root logger's handlers behind a queue so that formatting, writing and
+    rotating happen on a background thread instead of the event loop.
+    """
+    global LISTENER, _listening
+    root = logging.getLogger()
+    handlers = [h for h in root.handlers if not isinstance(h, logging.handlers.QueueHandler)]
+    if LISTENER is not None:
+        handlers = list(LISTENER.handlers) + handlers
+        stop_queue()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
 
+    q = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(q))
+    LISTENER = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    LISTENER.start()
+    _listening = True
+
+def share_with_workers() -> None:
+    """
+    Have the processes forked from now on send their records to this process,
+    which writes them with its own handlers. Otherwise every worker would
+    rotate the logfile on its own and lose records to the others' renames.
+    """
+    global WORKER_QUEUE, WORKER_LISTENER
+    if LISTENER is None or WORKER_QUEUE is not None:
+        return
+    WORKER_QUEUE = multiprocessing.Queue()
+    WORKER_LISTENER = logging.handlers.QueueListener(WORKER_QUEUE, *LISTENER.handlers, respect_handler_level=True)
+    WORKER_LISTENER.start()
+
+def stop_queue() -> None:
+    """Write out everything still queued and stop the listener thread"""
+    global _listening, _forwarding, WORKER_LISTENER
+    if LISTENER is not None and _listening:
+        _listening = False
+        LISTENER.stop()
+    if _forwarding:
+        # Wait until the records are handed to the pipe, workers leave with os._exit
+        _forwarding = False
+        WORKER_QUEUE.close()
+        WORKER_QUEUE.join_thread()
+    elif WORKER_LISTENER is not None:
+        WORKER_LISTENER.stop()
+        WORKER_LISTENER = None
+
+def shutdown() -> None:
+    stop_queue()
+    logging.shutdown()
+
+def _restart_queue_in_child() -> None:
+    # The listener thread does not survive a fork, give the child its own.
+    global LISTENER, _listening, _forwarding, WORKER_LISTENER
+    if LISTENER is None or not _listening:
+        return
+    if WORKER_QUEUE is not None:
+        # A worker, its records are written by the process that forked it
+        WORKER_LISTENER = None
+        _listening = False
+        _forwarding = True
+        for h in logging.getLogger().handlers:
+            if isinstance(h, logging.handlers.QueueHandler):
+                h.queue = WORKER_QUEUE
+        return
+    q = queue.SimpleQueue()
+    for h in logging.getLogger().handlers:
+        if isinstance(h, logging.handlers.QueueHandler):
+            h.queue = q
+    LISTENER = logging.handlers.QueueListener(q, *LISTENER.handlers, respect_handler_level=True)
+    LISTENER.start()
+
+atexit.register(stop_queue)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_queue_in_child)
+
+
+def access_logger(fmt="text", sample=1.0):
+    """
+    Application `log_function` setting replacing tornado's access log line.
+
+    :Parameters:
+        - fmt: "text" for tornado's usual line, "json" for one compact JSON object per request
+        - sample: fraction of successful requests to log, errors (status >= 400) are always logged
+    """
+    def log_request(handler):
+        if getattr(handler.request, "peonserver_internal", False):
+            return  # replayed by peonserver.cache, the request it was replayed for is logged
+        status = handler.get_status()
+        if status < 400 and sample < 1.0 and random.random() >= sample:
+            return
+        if status < 400:
+            log_method = ACCESS_LOG.info
+        elif status < 500:
+            log_method = ACCESS_LOG.warning
+        else:
+            log_method = ACCESS_LOG.error
+        request = handler.request
+        latency = 1000.0 * request.request_time()
+        if fmt == "json":
+            log_method(json.dumps({
+                "ts": round(time.time(), 3),
+                "method": request.method,
+                "path": request.path,
+                "status": status,
+                "ms": round(latency, 3),
+                "ip": request.remote_ip,
+                "handler": type(handler).__name__,
+            }, separators=(",", ":")))
+        else:
+            log_method("%d %s %s (%s) %.2fms", status, request.method, request.uri, request.remote_ip, latency)
+    return log_request
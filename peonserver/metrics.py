@@ -0,0 +1,304 @@
+"""
+Opt-in metrics in the Prometheus text exposition format.
+
+install() hooks an application so that every request is counted per route
+(the URL pattern it was registered with in make_app, including website
+ROUTES), with latency and response size histograms and an in-flight gauge.
+Event loop lag is sampled with a timer, and open connections, process RSS
+and static cache hits are read when /metrics is scraped.
+
+All collection is a few dictionary updates per request. Each process keeps its
+own numbers; with --workers every worker reports a `worker` label and a
+scrape reaches whichever worker accepts the connection.
+"""
+import os
+import bisect
+import asyncio
+
+import tornado.web
+
+import peonserver.log as plog
+import peonserver.workers as pworkers
+from peonserver import static
+from peonserver import admission
+from peonserver import cache
+from peonserver import database
+from peonserver import jobs
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+LAG_INTERVAL = 0.5  # seconds between event loop lag samples
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+
+class Counter():
+    kind = "counter"
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, labels=(), amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self, const):
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(self.labels, labels, const)} {value}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name, doc, labels=(), function=None):
+        super().__init__(name, doc, labels)
+        self.function = function  # read on every scrape when set
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def samples(self, const):
+        if self.function is not None:
+            self.values[()] = self.function()
+        yield from super().samples(const)
+
+
+class CounterFunction(Gauge):
+    """Counter whose value is kept elsewhere and read on every scrape"""
+    kind = "counter"
+
+
+class Histogram():
+    kind = "histogram"
+
+    def __init__(self, name, doc, buckets, labels=()):
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self.values = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, labels=()):
+        data = self.values.get(labels)
+        if data is None:
+            data = self.values[labels] = [0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            data[index] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def samples(self, const):
+        for labels, data in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                le = list(const) + [("le", bound)]
+                yield f"{self.name}_bucket{format_labels(self.labels, labels, le)} {cumulative}"
+            le = list(const) + [("le", "+Inf")]
+            yield f"{self.name}_bucket{format_labels(self.labels, labels, le)} {data[-1]}"
+            yield f"{self.name}_sum{format_labels(self.labels, labels, const)} {data[-2]}"
+            yield f"{self.name}_count{format_labels(self.labels, labels, const)} {data[-1]}"
+
+
+def resident_memory():
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # peak, not current
+
+
+class Registry():
+
+    def __init__(self):
+        self.routes = {}  # handler class -> route label
+        self.server = None
+        self.in_flight = 0
+        self.lag_handle = None
+        self.requests = Counter("peonserver_requests_total", "Requests handled",
+                                ("route", "method", "status"))
+        self.latency = Histogram("peonserver_request_duration_seconds", "Request latency",
+                                 LATENCY_BUCKETS, ("route",))
+        self.sizes = Histogram("peonserver_response_size_bytes", "Response body size",
+                               SIZE_BUCKETS, ("route",))
+        self.lag = Histogram("peonserver_event_loop_lag_seconds", "Event loop timer lateness",
+                             LAG_BUCKETS)
+        self.metrics = [
+            self.requests, self.latency, self.sizes,
+            Gauge("peonserver_requests_in_flight", "Requests being handled", function=lambda: self.in_flight),
+            self.lag,
+            Gauge("peonserver_open_connections", "Open HTTP connections", function=self.open_connections),
+            Gauge("process_resident_memory_bytes", "Resident memory size", function=resident_memory),
+            Gauge("peonserver_static_cache_bytes", "Static file bytes in memory", function=lambda: static.CACHE.size),
+            CounterFunction("peonserver_static_cache_hits_total", "Static cache hits",
+                            function=lambda: static.CACHE.hits),
+            CounterFunction("peonserver_static_cache_misses_total", "Static cache misses",
+                            function=lambda: static.CACHE.misses),
+            CounterFunction("peonserver_response_cache_hits_total", "Response cache fresh hits",
+                            function=lambda: cache.CACHE.hits),
+            CounterFunction("peonserver_response_cache_stale_hits_total", "Response cache stale hits",
+                            function=lambda: cache.CACHE.stale_hits),
+            CounterFunction("peonserver_response_cache_misses_total", "Response cache misses",
+                            function=lambda: cache.CACHE.misses),
+            CounterFunction("peonserver_response_cache_coalesced_total", "Requests that waited for another's computation",
+                            function=lambda: cache.CACHE.coalesced),
+            Gauge("peonserver_admission_queued", "Requests waiting for admission",
+                  function=lambda: admission.CONTROL.queued),
+            CounterFunction("peonserver_admission_overloaded_total", "Requests refused with 503 when over capacity",
+                            function=lambda: admission.CONTROL.overloaded),
+            CounterFunction("peonserver_admission_rate_limited_total", "Requests refused with 429 by the rate limit",
+                            function=lambda: admission.CONTROL.rate_limited),
+            Gauge("peonserver_database_connections", "Open database connections",
+                  function=lambda: database.POOL.connections),
+            Gauge("peonserver_database_connections_in_use", "Database connections lent to handlers",
+                  function=lambda: database.POOL.in_use),
+            Gauge("peonserver_database_waiting", "Handlers waiting for a database connection",
+                  function=lambda: database.POOL.waiting),
+            CounterFunction("peonserver_database_acquired_total", "Database connections lent",
+                            function=lambda: database.POOL.acquired),
+            CounterFunction("peonserver_database_timeouts_total", "Waits for a database connection that timed out",
+                            function=lambda: database.POOL.timeouts),
+            CounterFunction("peonserver_database_wait_seconds_total", "Time spent waiting for database connections",
+                            function=lambda: database.POOL.wait_seconds),
+            CounterFunction("peonserver_database_queries_total", "Database statements run",
+                            function=lambda: database.POOL.queries),
+            CounterFunction("peonserver_database_query_seconds_total", "Time spent running database statements",
+                            function=lambda: database.POOL.query_seconds),
+            Gauge("peonserver_cpu_jobs_running", "CPU jobs running in the process pool",
+                  function=lambda: jobs.JOBS.running),
+            Gauge("peonserver_cpu_jobs_waiting", "CPU jobs waiting for a pool process",
+                  function=lambda: jobs.JOBS.waiting),
+            CounterFunction("peonserver_cpu_jobs_completed_total", "CPU jobs completed",
+                            function=lambda: jobs.JOBS.completed),
+            CounterFunction("peonserver_cpu_jobs_failed_total", "CPU jobs that raised or whose process died",
+                            function=lambda: jobs.JOBS.failed),
+            CounterFunction("peonserver_cpu_jobs_rejected_total", "CPU jobs refused with 503 when the queue was full",
+                            function=lambda: jobs.JOBS.rejected),
+            Gauge("peonserver_background_jobs", "Background jobs running", function=lambda: len(jobs.JOBS.tasks)),
+            CounterFunction("peonserver_periodic_job_runs_total", "Periodic job runs",
+                            function=lambda: jobs.JOBS.periodic_runs),
+            CounterFunction("peonserver_periodic_job_failures_total", "Periodic job runs that failed",
+                            function=lambda: jobs.JOBS.periodic_failures),
+        ]
+
+    def register_routes(self, handlers):
+        """Label requests with the URL pattern their handler class was first registered for"""
+        for spec in handlers:
+            if isinstance(spec, (tuple, list)):
+                pattern, handler_class = spec[0], spec[1]
+            else:  # tornado.web.url / URLSpec
+                pattern, handler_class = spec.regex.pattern, spec.handler_class
+            if isinstance(handler_class, type):
+                self.routes.setdefault(handler_class, pattern)
+
+    def open_connections(self):
+        if self.server is None:
+            return 0
+        return len(self.server.connections)
+
+    def finished(self, handler, size):
+        self.in_flight = max(self.in_flight - 1, 0)
+        request = handler.request
+        route = self.routes.get(type(handler), type(handler).__name__)
+        self.requests.inc((route, request.method, handler.get_status()))
+        self.latency.observe(request.request_time(), (route,))
+        self.sizes.observe(size, (route,))
+
+    def render(self):
+        const = [] if pworkers.WORKER_ID is None else [("worker", pworkers.WORKER_ID)]
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.doc}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples(const))
+        return "\n".join(lines) + "\n"
+
+    def sample_lag(self, expected=None):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if expected is not None:
+            self.lag.observe(max(now - expected, 0.0))
+        self.lag_handle = loop.call_later(LAG_INTERVAL, self.sample_lag, now + LAG_INTERVAL)
+
+
+REGISTRY = Registry()
+
+
+class MetricsTransform(tornado.web.OutputTransform):
+    """Counts a request as in flight from the start and measures its response body"""
+
+    def __init__(self, request):
+        super().__init__(request)
+        self.size = 0
+        self.counting = True
+        if getattr(request, "peonserver_internal", False):
+            return  # replayed by peonserver.cache, the request it was replayed for is counted
+        request.peonserver_metrics = self
+        REGISTRY.in_flight += 1
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        length = headers.get("Content-Length")
+        if length and length.isdigit():
+            # Also covers bodies written past the transforms, like mapped static files
+            self.size = int(length)
+            self.counting = False
+        else:
+            self.size = len(chunk)
+        return status_code, headers, chunk
+
+    def transform_chunk(self, chunk, finishing):
+        if self.counting:
+            self.size += len(chunk)
+        return chunk
+
+
+def log_function(previous=None):
+    """Wraps the application's log_function to record each finished request"""
+    previous = previous or plog.access_logger()
+
+    def log_request(handler):
+        if not getattr(handler.request, "peonserver_internal", False):
+            transform = getattr(handler.request, "peonserver_metrics", None)
+            REGISTRY.finished(handler, transform.size if transform is not None else 0)
+        previous(handler)
+    return log_request
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.set_header("Cache-Control", "no-store")
+        self.finish(REGISTRY.render())
+
+
+def install(app, handlers):
+    """Start collecting metrics for app, whose routes are handlers"""
+    REGISTRY.register_routes(handlers)
+    app.add_transform(MetricsTransform)
+    app.settings["log_function"] = log_function(app.settings.get("log_function"))
+    try:
+        if REGISTRY.lag_handle is None:
+            REGISTRY.sample_lag()
+    except RuntimeError:
+        plog.LOG.warning("No running event loop, event loop lag will not be measured")
+    plog.LOG.info("Metrics enabled at /metrics")
+    return app
+
+def watch_server(server):
+    """Report the open connections of server, a peonserver.drain.DrainingHTTPServer"""
+    REGISTRY.server = server
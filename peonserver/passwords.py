@@ -0,0 +1,158 @@
+"""
+Password hashing off the event loop.
+
+bcrypt is slow on purpose, a single hash takes tens to hundreds of
+milliseconds, and calling it from a handler stalls every other request of
+the process for that long. HASHER runs the hashes on a small thread pool
+instead (bcrypt releases the GIL while it works) and handlers await them:
+
+    hashed = await passwords.HASHER.hash(password)
+    if await passwords.HASHER.verify(password, hashed): ...
+
+At most `max_concurrent` hashes run at once, so a burst of logins cannot
+take every CPU away from serving pages. Up to `max_queue` more wait for a
+slot, further calls are answered with 503. Unless a cost is configured the
+bcrypt cost factor is chosen on first use, the highest one hashing within
+`target` seconds on this machine. Hashes made with a lower cost still
+verify, needs_rehash() tells when to store a new one after a login.
+bcrypt itself is only imported once a password is hashed or checked.
+"""
+import os
+import math
+import time
+import asyncio
+import concurrent.futures
+
+import tornado.web
+
+import peonserver.log as plog
+
+DEFAULT_TARGET = 0.25  # seconds a hash should take
+MIN_COST = 10
+MAX_COST = 16
+CALIBRATION_COST = 8
+DEFAULT_MAX_QUEUE = 64
+
+# Optional website globals.py names and the make_app keyword arguments they fill in
+WEBSITE_SETTINGS = {
+    "PASSWORD_COST": "password_cost",
+    "PASSWORD_TIME": "password_time",
+}
+
+
+def encode(password):
+    return password.encode("utf-8") if isinstance(password, str) else password
+
+def hash_cost(hashed):
+    """Cost factor of a bcrypt hash, $2b$12$... is 12"""
+    try:
+        return int(encode(hashed).split(b"$")[2])
+    except (IndexError, ValueError):
+        return 0
+
+
+class PasswordHasher():
+    """
+    bcrypt on a bounded thread pool.
+
+    Usage: HASHER.configure(cost=12) once per process, then await hash() and
+    verify() from handlers.
+    """
+
+    def __init__(self):
+        self.executor = None
+        self.configure()
+
+    def configure(self, **kwargs):
+        """
+        :Parameters:
+            - cost: bcrypt cost factor, chosen on first use when not given
+            - target: seconds a hash should take when choosing the cost, default DEFAULT_TARGET
+            - max_concurrent: hashes running at once, defaults to half the CPUs
+            - max_queue: calls waiting for a slot before 503, default DEFAULT_MAX_QUEUE
+        """
+        self.cost = kwargs.get("cost")
+        self.target = kwargs.get("target") or DEFAULT_TARGET
+        self.max_concurrent = kwargs.get("max_concurrent") or max(1, (os.cpu_count() or 1) // 2)
+        self.max_queue = kwargs.get("max_queue", DEFAULT_MAX_QUEUE)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.executor = None
+        self.slots = None
+        self.calibrating = None
+        self.waiting = 0
+
+    async def run(self, function, *args):
+        """Call function(*args) on the pool once a slot is free"""
+        if self.executor is None:
+            # Created on first use, forked workers get their own threads
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_concurrent, thread_name_prefix="bcrypt")
+            self.slots = asyncio.Semaphore(self.max_concurrent)
+        if self.slots.locked():
+            if self.waiting >= self.max_queue:
+                plog.LOG.warning(f"{self.waiting} password hashes waiting, refusing more")
+                raise tornado.web.HTTPError(503)
+            self.waiting += 1
+            try:
+                await self.slots.acquire()
+            finally:
+                self.waiting -= 1
+        else:
+            await self.slots.acquire()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            self.slots.release()
+
+    async def get_cost(self):
+        """Configured cost, or the highest one meeting the target time on this machine"""
+        if self.cost is None:
+            if self.calibrating is None:
+                self.calibrating = asyncio.ensure_future(self.run(self.calibrate))
+            calibrating = self.calibrating
+            try:
+                self.cost = await asyncio.shield(calibrating)
+            except Exception:
+                # Calibrate again on the next call instead of failing every one with this error
+                if self.calibrating is calibrating:
+                    self.calibrating = None
+                raise
+        return self.cost
+
+    def calibrate(self):
+        import bcrypt
+        # Every cost step doubles the work, time a cheap hash and extrapolate
+        salt = bcrypt.gensalt(CALIBRATION_COST)
+        bcrypt.hashpw(b"calibration", salt)
+        start = time.perf_counter()
+        bcrypt.hashpw(b"calibration", salt)
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        cost = CALIBRATION_COST + int(math.floor(math.log2(self.target / elapsed)))
+        cost = min(max(cost, MIN_COST), MAX_COST)
+        plog.LOG.info(f"bcrypt cost {cost}, about {elapsed * 2 ** (cost - CALIBRATION_COST):.3f}s per hash")
+        return cost
+
+    async def hash(self, password):
+        """bcrypt hash of password as a str"""
+        import bcrypt
+        salt = bcrypt.gensalt(await self.get_cost())
+        hashed = await self.run(bcrypt.hashpw, encode(password), salt)
+        return hashed.decode("ascii")
+
+    async def verify(self, password, hashed):
+        """True if password matches hashed, False also for a malformed hash"""
+        if not hashed:
+            return False
+        import bcrypt
+        try:
+            return await self.run(bcrypt.checkpw, encode(password), encode(hashed))
+        except ValueError:
+            return False
+
+    async def needs_rehash(self, hashed):
+        """True when hashed was made with a lower cost than new hashes get"""
+        return hash_cost(hashed) < await self.get_cost()
+
+
+HASHER = PasswordHasher()
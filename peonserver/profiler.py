@@ -0,0 +1,294 @@
+"""
+On-demand sampling profiler for a running server.
+
+A sampler thread reads the event loop thread's stack every `interval`
+seconds (5ms by default) and counts identical stacks, which costs the loop
+next to nothing and needs no restart. The result is in the collapsed stack
+format, one "outer;...;inner count" line per stack, which flamegraph.pl,
+speedscope and most flame graph viewers read directly.
+
+There are three ways to start a profile:
+
+  - GET /_profile?seconds=10 with `Authorization: Bearer <PROFILE_TOKEN>`
+    profiles the process answering the request and returns the stacks
+  - `X-Profile: <PROFILE_TOKEN>` on any request profiles just that request,
+    only counting samples taken while its handler runs, and the response
+    names the file the stacks are written to in `X-Profile-Output`
+  - SIGUSR2, or `peonserver profile` for the daemon, profiles every serving
+    process for --profile-seconds and writes one file per process
+
+The endpoint and the header only exist when a PROFILE_TOKEN is configured,
+in the website globals.py or the PEONSERVER_PROFILE_TOKEN environment
+variable. Files go to --profile-path, the temporary directory by default.
+"""
+import os
+import sys
+import hmac
+import time
+import asyncio
+import tempfile
+import threading
+import collections
+
+import tornado.web
+
+import peonserver.log as plog
+
+PROFILE_URL = r"/_profile"
+HEADER = "X-Profile"
+OUTPUT_HEADER = "X-Profile-Output"
+TOKEN_ENV = "PEONSERVER_PROFILE_TOKEN"
+DEFAULT_INTERVAL = 0.005  # seconds between samples
+DEFAULT_SECONDS = 30.0
+MAX_SECONDS = 600.0  # also ends the profile of a request whose end is never logged
+SWITCH_DIVISOR = 10  # GIL switch interval while sampling, as a fraction of the sample interval
+CONTENT_TYPE = "text/plain; charset=utf-8"
+
+# Optional website globals.py names and the make_app keyword arguments they fill in
+WEBSITE_SETTINGS = {
+    "PROFILE_TOKEN": "profile_token",
+    "PROFILE_PATH": "profile_path",
+    "PROFILE_SECONDS": "profile_seconds",
+}
+
+# The GIL switch interval is process-wide, the first running sampler lowers it and the last one restores it
+SWITCH_LOCK = threading.Lock()
+switch_state = {"samplers": 0, "saved": None}
+
+
+def lower_switch_interval(interval):
+    with SWITCH_LOCK:
+        if switch_state["samplers"] == 0:
+            switch_state["saved"] = sys.getswitchinterval()
+        switch_state["samplers"] += 1
+        sys.setswitchinterval(min(sys.getswitchinterval(), interval / SWITCH_DIVISOR))
+
+def restore_switch_interval():
+    with SWITCH_LOCK:
+        switch_state["samplers"] -= 1
+        if switch_state["samplers"] == 0:
+            sys.setswitchinterval(switch_state["saved"])
+            switch_state["saved"] = None
+
+
+class Sampler():
+    """
+    Counts the stacks of one thread, sampled from a thread of its own.
+
+    Usage: sampler = Sampler(threading.get_ident()).start(), then
+    sampler.stop().collapsed(). With accept, only samples for which accept()
+    returns True are counted.
+    """
+
+    def __init__(self, thread_id, interval=DEFAULT_INTERVAL, accept=None):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.accept = accept
+        self.stacks = collections.Counter()
+        self.labels = {}  # code object -> frame label
+        self.samples = 0
+        self.started = None
+        self.elapsed = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.started = time.monotonic()
+        # The sampler waits for the GIL, a shorter switch interval keeps it from
+        # sampling CPU bound code less often than an idle loop
+        lower_switch_interval(self.interval)
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+            restore_switch_interval()
+            self.elapsed = time.monotonic() - self.started
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if time.monotonic() - self.started > MAX_SECONDS:
+                break
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None or (self.accept is not None and not self.accept()):
+                continue
+            self.samples += 1
+            self.stacks[self.collapse(frame)] += 1
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+        return label
+
+    def collapse(self, frame):
+        stack = []
+        while frame is not None:
+            stack.append(self.label(frame.f_code))
+            frame = frame.f_back
+        stack.reverse()
+        return ";".join(stack)
+
+    def collapsed(self):
+        """Counted stacks in the collapsed format, most frequent first"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def task_filter(loop, request):
+    """accept() for a Sampler counting only while the task running request's handler is on the loop"""
+    found = []
+
+    def accept():
+        task = asyncio.current_task(loop)
+        if task is None:
+            return False
+        if found:
+            return task is found[0]
+        # The handler's task is the one running RequestHandler._execute for request
+        frame = getattr(task.get_coro(), "cr_frame", None)
+        handler = frame.f_locals.get("self") if frame is not None else None
+        if getattr(handler, "request", None) is request:
+            found.append(task)
+            return True
+        return False
+    return accept
+
+
+class Profiler():
+    """
+    Profiles of this process, one at a time.
+
+    Usage: PROFILER.configure(token=...) once per process, then await
+    profile(seconds) or use the handler, transform and signal below.
+    """
+
+    def __init__(self):
+        self.configure()
+
+    def configure(self, **kwargs):
+        """
+        :Parameters:
+            - token: secret enabling the endpoint and request header, none by default
+            - path: directory for profile files, the temporary directory by default
+            - seconds: length of a profile started by a signal, default DEFAULT_SECONDS
+            - interval: seconds between samples, default DEFAULT_INTERVAL
+        """
+        self.token = kwargs.get("token") or os.environ.get(TOKEN_ENV) or None
+        self.path = kwargs.get("path") or tempfile.gettempdir()
+        self.seconds = float(kwargs.get("seconds") or DEFAULT_SECONDS)
+        self.interval = kwargs.get("interval") or DEFAULT_INTERVAL
+        self.running = None
+
+    @property
+    def enabled(self):
+        return bool(self.token)
+
+    def authorized(self, value):
+        if not self.token or not value:
+            return False
+        if value.startswith("Bearer "):
+            value = value[len("Bearer "):]
+        return hmac.compare_digest(value.strip().encode(), self.token.encode())
+
+    def output_path(self, kind):
+        return os.path.join(self.path, f"peonserver-profile-{kind}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+
+    async def profile(self, seconds, interval=None):
+        """Sample the event loop thread for seconds, returns the stopped Sampler"""
+        if self.running is not None:
+            raise RuntimeError("A profile is already running")
+        seconds = min(max(float(seconds), 0.0), MAX_SECONDS)
+        self.running = Sampler(threading.get_ident(), interval or self.interval).start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            sampler, self.running = self.running.stop(), None
+        plog.LOG.info(f"Profiled for {sampler.elapsed:.1f}s, {sampler.samples} samples")
+        return sampler
+
+    async def profile_to_file(self, seconds=None):
+        try:
+            sampler = await self.profile(seconds or self.seconds)
+        except RuntimeError as E:
+            plog.LOG.warning(str(E))
+            return None
+        path = self.output_path("process")
+        await asyncio.get_running_loop().run_in_executor(None, write, path, sampler.collapsed())
+        plog.LOG.info(f"Profile written to {path}")
+        return path
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+    """GET ?seconds=10&interval=0.001 returns the collapsed stacks of this process"""
+
+    async def get(self):
+        if not PROFILER.authorized(self.request.headers.get("Authorization", "")):
+            raise tornado.web.HTTPError(403)
+        try:
+            seconds = float(self.get_argument("seconds", "10"))
+            interval = float(self.get_argument("interval", str(PROFILER.interval)))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        if PROFILER.running is not None:
+            raise tornado.web.HTTPError(409, "A profile is already running")
+        sampler = await PROFILER.profile(seconds, max(interval, 0.001))
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.set_header("Cache-Control", "no-store")
+        self.finish(sampler.collapsed())
+
+
+class ProfileTransform(tornado.web.OutputTransform):
+    """Starts a profile of the request when it carries the profile header"""
+
+    def __init__(self, request):
+        super().__init__(request)
+        self.path = None
+        if PROFILER.authorized(request.headers.get(HEADER, "")):
+            loop = asyncio.get_running_loop()
+            self.path = PROFILER.output_path("request")
+            request.peonserver_profile = (Sampler(threading.get_ident(), PROFILER.interval,
+                                                  task_filter(loop, request)).start(), self.path)
+
+    def transform_first_chunk(self, status_code, headers, chunk, finishing):
+        if self.path is not None:
+            headers[OUTPUT_HEADER] = self.path
+        return status_code, headers, chunk
+
+
+def log_function(previous=None):
+    """Wraps the application's log_function to finish the profile of a profiled request"""
+    previous = previous or plog.access_logger()
+
+    def log_request(handler):
+        profile = getattr(handler.request, "peonserver_profile", None)
+        if profile is not None:
+            handler.request.peonserver_profile = None
+            sampler, path = profile
+            sampler.stop()
+            asyncio.get_running_loop().run_in_executor(None, write, path, sampler.collapsed())
+            plog.LOG.info(f"Profiled {handler.request.method} {handler.request.uri}, "
+                          f"{sampler.samples} samples written to {path}")
+        previous(handler)
+    return log_request
+
+
+def install(app):
+    """Profile requests of app carrying the profile header"""
+    app.add_transform(ProfileTransform)
+    app.settings["log_function"] = log_function(app.settings.get("log_function"))
+    plog.LOG.info(f"Profiling enabled at {PROFILE_URL}")
+    return app
+
+
+PROFILER = Profiler()
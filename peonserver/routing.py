@@ -0,0 +1,271 @@
+"""
+Route module discovery and lazy loading.
+
+Every `.py` module in the routes directory exports ROUTES. Instead of
+importing them all at startup, make_app builds a route manifest listing the
+URL patterns of each module and registers a LazyRouteModule for those
+patterns, which imports the module the first time one of them is requested.
+
+The manifest is either declared in the website globals.py:
+
+    ROUTE_MANIFEST = [
+        (r"/api/users/.*", "users"),
+        (r"/api/orders/.*", "orders"),
+    ]
+
+or generated by reading each module's source (without importing it) for a
+literal ROUTES list, cached in `.peonserver-cache/routes.json` next to the
+routes directory by file size and modification time. Modules whose ROUTES
+cannot be read that way, or that name their routes for reverse_url, are
+imported at startup as before.
+"""
+import os
+import sys
+import ast
+import json
+import time
+import importlib
+import traceback
+
+import tornado.web
+import tornado.routing
+
+import peonserver.log as plog
+
+CACHE_NAME = "routes.json"
+CACHE_VERSION = 1
+URL_FUNCTIONS = ("url", "URLSpec")
+
+
+def route_modules(route_path):
+    """Route module names in route_path, in a stable order"""
+    names = []
+    for r in sorted(os.listdir(route_path)):
+        # Skip hidden files, require python modules and do not allow __init__ or __main__
+        if not r.startswith(".") and r.endswith(".py") and not r.startswith("__"):
+            names.append(r[:-len(".py")])
+    return names
+
+def literal_pattern(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    return None
+
+def route_pattern(node):
+    """URL pattern of one ROUTES entry, None unless it is a plain unnamed path rule"""
+    if isinstance(node, (ast.Tuple, ast.List)) and 2 <= len(node.elts) <= 3:
+        return literal_pattern(node.elts[0])
+    if isinstance(node, ast.Call) and node.args and not any(k.arg == "name" for k in node.keywords):
+        func = node.func
+        name = func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", None)
+        if name in URL_FUNCTIONS and len(node.args) <= 3:
+            return literal_pattern(node.args[0])
+    return None
+
+def static_patterns(source, filename="<routes>"):
+    """
+    Patterns of a module's ROUTES read from its source, or None when they can
+    only be known by importing it: ROUTES is not a single literal list, it is
+    changed after the assignment or an entry is not a plain path rule.
+    """
+    try:
+        tree = ast.parse(source, filename)
+    except SyntaxError:
+        return None
+    assignments = []
+    references = 0
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == "ROUTES":
+            references += 1
+        if isinstance(node, ast.Assign) and any(getattr(t, "id", None) == "ROUTES" for t in node.targets):
+            assignments.append(node)
+    if len(assignments) != 1 or references != 1 or not isinstance(assignments[0].value, (ast.List, ast.Tuple)):
+        return None
+    patterns = [route_pattern(e) for e in assignments[0].value.elts]
+    if not patterns or None in patterns:
+        return None
+    return patterns
+
+
+class RouteManifest():
+    """Generated manifest of route module patterns, see static_patterns"""
+
+    def __init__(self, route_path):
+        self.route_path = route_path
+        self.cachefile = os.path.join(os.path.dirname(os.path.abspath(route_path)), ".peonserver-cache",
+                                      CACHE_NAME)
+        self.modules = {}  # module file name -> {"mtime", "size", "patterns"}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cachefile, 'r') as f:
+                data = json.load(f)
+            if data.get("version") == CACHE_VERSION:
+                self.modules = data.get("modules", {})
+        except (IOError, OSError, ValueError):
+            self.modules = {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.cachefile), exist_ok=True)
+        tmp = f"{self.cachefile}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({"version": CACHE_VERSION, "modules": self.modules}, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.cachefile)
+
+    def scan(self):
+        """[(module name, patterns or None)] for every route module"""
+        found = []
+        changed = False
+        modules = {}
+        for name in route_modules(self.route_path):
+            filename = f"{name}.py"
+            path = os.path.join(self.route_path, filename)
+            st = os.stat(path)
+            entry = self.modules.get(filename)
+            if entry is None or entry["mtime"] != st.st_mtime_ns or entry["size"] != st.st_size:
+                with open(path, 'rb') as f:
+                    entry = {"mtime": st.st_mtime_ns, "size": st.st_size,
+                             "patterns": static_patterns(f.read(), path)}
+                changed = True
+            modules[filename] = entry
+            found.append((name, entry["patterns"]))
+        if changed or modules.keys() != self.modules.keys():
+            self.modules = modules
+            try:
+                self.save()
+            except (IOError, OSError) as E:
+                plog.LOG.warning(f"Could not write route manifest {self.cachefile}: {E}")
+        return found
+
+def declared_manifest(declared):
+    """[(module name, patterns)] from a ROUTE_MANIFEST list of (pattern, module) or {pattern: module}"""
+    items = declared.items() if isinstance(declared, dict) else declared
+    modules = {}
+    for pattern, module in items:
+        modules.setdefault(module, []).append(pattern)
+    return list(modules.items())
+
+
+class HandlerRouter(tornado.routing.RuleRouter):
+    """Rules of one route module, routing to its RequestHandler classes like the application does"""
+
+    def __init__(self, application, rules=None):
+        self.application = application
+        super().__init__(rules)
+
+    def get_target_delegate(self, target, request, **target_params):
+        if isinstance(target, type) and issubclass(target, tornado.web.RequestHandler):
+            return self.application.get_handler_delegate(request, target, **target_params)
+        return super().get_target_delegate(target, request, **target_params)
+
+
+class LazyRouteModule(tornado.routing.Router):
+    """Route target that imports its module on the first request and routes into its ROUTES"""
+
+    def __init__(self, name, package=None, on_load=None, patterns=None):
+        self.name = name
+        self.package = package
+        self.on_load = on_load  # on_load(ROUTES) once imported
+        self.patterns = patterns or []  # registered with the application, see load_routes
+        self.application = None  # set by install() once the application exists
+        self.router = None
+        self.stale = False
+
+    def reload(self):
+        """Import the module again on its next request, after its source changed"""
+        self.router = None
+        self.stale = True
+
+    def load(self):
+        if self.router is None:
+            start = time.perf_counter()
+            mod = importlib.import_module(self.name, self.package)
+            if self.stale:
+                mod = importlib.reload(mod)
+                self.stale = False
+            self.router = HandlerRouter(self.application, mod.ROUTES)
+            if self.on_load is not None:
+                self.on_load(mod.ROUTES)
+            plog.LOG.info(f"Loaded route module {self.name} in {(time.perf_counter() - start) * 1000.0:.1f}ms")
+        return self.router
+
+    def find_handler(self, request, **kwargs):
+        try:
+            router = self.load()
+        except Exception as E:
+            # Try again on the next request, the module may be fixed by then
+            plog.LOG.error(f"Failed to import route module {self.name}: {E}")
+            plog.LOG.error(traceback.format_exc())
+            return self.application.get_handler_delegate(request, tornado.web.ErrorHandler,
+                                                         {"status_code": 500})
+        return router.find_handler(request)
+
+
+def load_routes(route_path, package=None, **kwargs):
+    """
+    Handlers for every route module in route_path, in module order.
+
+    :Parameters:
+        - lazy: import modules on their first request where possible, default True
+        - declared: ROUTE_MANIFEST from the website globals.py, replaces the generated manifest
+        - on_load: on_load(ROUTES) for every module once it is imported
+        - prefix: package the module names are qualified with, for modules not importable by their own name
+
+    Returns (handlers, lazy modules), pass the application to install() once created.
+    """
+    on_load = kwargs.get("on_load")
+    declared = kwargs.get("declared")
+    if not kwargs.get("lazy", True):
+        manifest = [(name, None) for name in route_modules(route_path)]
+    elif declared:
+        manifest = declared_manifest(declared)
+    else:
+        manifest = RouteManifest(route_path).scan()
+    if kwargs.get("prefix"):
+        manifest = [(f"{kwargs['prefix']}.{name}", patterns) for name, patterns in manifest]
+
+    handlers = []
+    lazy = []
+    for name, patterns in manifest:
+        if patterns is None:
+            mod = importlib.import_module(name, package)
+            handlers.extend(mod.ROUTES)
+            if on_load is not None:
+                on_load(mod.ROUTES)
+            continue
+        module = LazyRouteModule(name, package, on_load, patterns)
+        lazy.append(module)
+        handlers.extend((pattern, module) for pattern in patterns)
+    plog.LOG.info(f"Route modules: {len(manifest) - len(lazy)} imported, {len(lazy)} deferred to their first request")
+    return handlers, lazy
+
+def install(application, lazy):
+    for module in lazy:
+        module.application = application
+
+def reload_module(application, name, on_load=None):
+    """
+    Import an eagerly loaded route module again and put its new rules in place
+    of the old ones. Returns False, changing nothing, when its rules are not
+    found next to each other in the application's router.
+    """
+    mod = sys.modules.get(name)
+    router = application.wildcard_router
+    owned = [i for i, rule in enumerate(router.rules) if getattr(rule.target, "__module__", None) == name]
+    if mod is None or not owned or owned != list(range(owned[0], owned[-1] + 1)):
+        return False
+
+    mod = importlib.reload(mod)
+    start, end = owned[0], owned[-1] + 1
+    for rule in router.rules[start:end]:
+        if rule.name:
+            router.named_rules.pop(rule.name, None)
+    count = len(router.rules)
+    router.add_rules(mod.ROUTES)
+    fresh = router.rules[count:]
+    del router.rules[count:]
+    router.rules[start:end] = fresh
+    if on_load is not None:
+        on_load(mod.ROUTES)
+    return True
@@ -0,0 +1,263 @@
+"""
+Incremental sass compilation.
+
+Every non-partial ``.scss``/``.sass`` file under the sass directory is an
+entrypoint compiled to the same relative path under ``css/``. The imports of
+each entrypoint are followed to build its dependency tree, and a digest of the
+contents of that tree is kept in an on-disk cache. Only entrypoints whose
+digest changed (or whose output went missing) are recompiled, independent
+entrypoints in parallel on a process pool. libsass is only imported when
+something has to be compiled.
+"""
+import os
+import re
+import json
+import hashlib
+import traceback
+import concurrent.futures
+
+import peonserver.log as plog
+import peonserver.workers as pworkers
+
+CACHE_DIR = ".peonserver-cache"
+CACHE_NAME = "sass.json"
+CACHE_VERSION = 1
+SASS_EXTENSIONS = (".scss", ".sass")
+OUTPUT_STYLE = "nested"
+
+_sass_version = None
+
+IMPORT_RE = re.compile(r'@(?:import|use|forward)\s+([^;]+);')
+STRING_RE = re.compile(r'''["']([^"']+)["']''')
+COMMENT_RE = re.compile(r'/\*.*?\*/|//[^\n]*', re.S)
+
+
+def find_sass_dir(static_path):
+    """The sass source directory of a static path, `sass/` or `scss/`, or None"""
+    for name in ("sass", "scss"):
+        sassdir = os.path.join(static_path, name)
+        if os.path.isdir(sassdir):
+            return sassdir
+    return None
+
+def cache_path(static_path, name=CACHE_NAME):
+    """Build caches sit next to the static directory so they are never served"""
+    return os.path.join(os.path.dirname(os.path.normpath(static_path)), CACHE_DIR, name)
+
+def parse_imports(source):
+    """Import targets named by @import, @use and @forward rules"""
+    targets = []
+    for rule in IMPORT_RE.findall(COMMENT_RE.sub("", source)):
+        for target in STRING_RE.findall(rule):
+            if target.startswith(("http://", "https://", "//", "url(")) or target.endswith(".css"):
+                continue
+            if target.startswith("sass:"):  # built-in modules
+                continue
+            targets.append(target)
+    return targets
+
+def resolve_import(target, basedir, include_paths):
+    """Path of the file an import target refers to, or None if it cannot be found"""
+    head, tail = os.path.split(target)
+    stems = [tail] if tail.endswith(SASS_EXTENSIONS) else \
+        [tail + ext for ext in SASS_EXTENSIONS] + [f"_{tail}{ext}" for ext in SASS_EXTENSIONS]
+    indexes = [os.path.join(tail, f"{prefix}index{ext}")
+               for prefix in ("_", "") for ext in SASS_EXTENSIONS]
+    for base in [basedir] + list(include_paths):
+        for name in stems + indexes:
+            path = os.path.normpath(os.path.join(base, head, name))
+            if os.path.isfile(path):
+                return path
+    return None
+
+def is_entrypoint(filename):
+    return filename.endswith(SASS_EXTENSIONS) and not filename.startswith(("_", "."))
+
+def find_entrypoints(sassdir):
+    entries = []
+    for root, dirs, files in os.walk(sassdir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for f in sorted(files):
+            if is_entrypoint(f):
+                entries.append(os.path.join(root, f))
+    return entries
+
+
+class SassBuilder():
+    """
+    Compile the entrypoints of one sass directory, skipping any whose dependency
+    tree is unchanged since the last build.
+    """
+
+    def __init__(self, static_path, **kwargs):
+        """
+        :Parameters:
+            - sassdir: sass sources, `static/sass` or `static/scss` if unset
+            - cssdir: output directory, `static/css` if unset
+            - cachefile: digest cache, see cache_path() if unset
+            - output_style: libsass output style, default OUTPUT_STYLE
+            - max_workers: compile processes, cpu_count() if unset
+        """
+        self.static_path = static_path
+        self.sassdir = kwargs.get("sassdir") or find_sass_dir(static_path)
+        self.cssdir = kwargs.get("cssdir") or os.path.join(static_path, "css")
+        self.cachefile = kwargs.get("cachefile") or cache_path(static_path)
+        self.output_style = kwargs.get("output_style", OUTPUT_STYLE)
+        self.max_workers = kwargs.get("max_workers") or pworkers.cpu_count()
+        self.include_paths = [self.sassdir] if self.sassdir else []
+        self.files = {}     # path -> [mtime_ns, size, sha256] so unchanged files are not re-read
+        self.entries = {}   # entrypoint relpath -> tree digest of the last successful compile
+        self.graph = {}     # path -> direct dependency paths, rebuilt for every build
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.cachefile, 'r') as cf:
+                cache = json.load(cf)
+        except (IOError, ValueError):
+            return
+        if cache.get("version") != CACHE_VERSION:
+            return
+        self.files = cache.get("files", {})
+        self.entries = cache.get("entries", {})
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.cachefile), exist_ok=True)
+        tmp = f"{self.cachefile}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as cf:
+            json.dump({"version": CACHE_VERSION, "files": self.files, "entries": self.entries}, cf)
+        os.replace(tmp, self.cachefile)
+
+    def file_digest(self, path):
+        st = os.stat(path)
+        known = self.files.get(path)
+        if known and known[0] == st.st_mtime_ns and known[1] == st.st_size:
+            return known[2]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self.files[path] = [st.st_mtime_ns, st.st_size, digest]
+        return digest
+
+    def dependencies(self, path):
+        if path not in self.graph:
+            try:
+                with open(path, 'r', encoding="utf-8") as f:
+                    targets = parse_imports(f.read())
+            except (IOError, UnicodeDecodeError):
+                targets = []
+            deps = []
+            for target in targets:
+                dep = resolve_import(target, os.path.dirname(path), self.include_paths)
+                if dep is None:
+                    plog.LOG.debug(f"Could not resolve sass import {target} in {path}")
+                else:
+                    deps.append(dep)
+            self.graph[path] = deps
+        return self.graph[path]
+
+    def tree(self, entry):
+        """The entrypoint and every file it transitively imports"""
+        seen = []
+        stack = [entry]
+        while stack:
+            path = stack.pop()
+            if path in seen:
+                continue
+            seen.append(path)
+            stack.extend(self.dependencies(path))
+        return seen
+
+    def tree_digest(self, entry):
+        h = hashlib.sha256(f"{sass_version()}:{self.output_style}".encode())
+        for path in sorted(self.tree(entry)):
+            h.update(os.path.relpath(path, self.sassdir).encode())
+            h.update(self.file_digest(path).encode())
+        return h.hexdigest()
+
+    def output_for(self, entry):
+        rel = os.path.splitext(os.path.relpath(entry, self.sassdir))[0] + ".css"
+        return os.path.join(self.cssdir, rel)
+
+    def dirty(self):
+        """(entrypoint, output, digest) for every entrypoint that needs compiling"""
+        self.graph = {}
+        found = []
+        for entry in find_entrypoints(self.sassdir):
+            rel = os.path.relpath(entry, self.sassdir)
+            output = self.output_for(entry)
+            digest = self.tree_digest(entry)
+            if self.entries.get(rel) == digest and os.path.exists(output):
+                continue
+            found.append((entry, output, digest))
+        return found
+
+    def build(self):
+        """Compile changed entrypoints, returns the list of css files written"""
+        if not self.sassdir:
+            return []
+
+        todo = self.dirty()
+        if not todo:
+            plog.LOG.info(f"Sass in {self.sassdir} is up to date")
+            return []
+
+        results = []
+        jobs = [(entry, output, self.include_paths, self.output_style) for entry, output, digest in todo]
+        if len(jobs) == 1 or self.max_workers < 2:
+            results = [compile_entry(*job) for job in jobs]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(jobs), self.max_workers)) as pool:
+                results = list(pool.map(compile_entry, *zip(*jobs)))
+
+        written = []
+        for (entry, output, digest), error in zip(todo, results):
+            rel = os.path.relpath(entry, self.sassdir)
+            if error:
+                plog.LOG.error(f"Failed to compile scss file {rel}: {error}")
+                self.entries.pop(rel, None)
+                continue
+            plog.LOG.info(f"Compiled scss file {rel}")
+            self.entries[rel] = digest
+            written.append(output)
+
+        # Forget files that no longer exist so the cache does not grow forever
+        for path in [p for p in self.files if not os.path.exists(p)]:
+            del self.files[path]
+        try:
+            self.save()
+        except (IOError, OSError) as E:
+            plog.LOG.warning(f"Could not write sass cache {self.cachefile}: {E}")
+        return written
+
+
+def sass_version():
+    """Installed libsass version without importing it"""
+    global _sass_version
+    if _sass_version is None:
+        try:
+            import importlib.metadata
+            _sass_version = importlib.metadata.version("libsass")
+        except Exception:
+            import sass
+            _sass_version = sass.__version__
+    return _sass_version
+
+def compile_entry(entry, output, include_paths, output_style):
+    """Compile one entrypoint to its css file, returns an error string or None"""
+    import sass
+    try:
+        css = sass.compile(filename=entry, include_paths=list(include_paths), output_style=output_style)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        tmp = f"{output}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding="utf-8") as f:
+            f.write(css)
+        os.replace(tmp, output)
+    except sass.CompileError as cE:
+        return str(cE)
+    except Exception as E:
+        return f"{E}\n{traceback.format_exc()}"
+    return None
+
+def build(static_path, **kwargs):
+    """Incrementally compile the sass sources of static_path, see SassBuilder"""
+    return SassBuilder(static_path, **kwargs).build()
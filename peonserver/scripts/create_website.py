@@ -20,10 +20,70 @@ WATCH_PATHS = [
     TMPL_PATH,
     ROUTE_PATH
 ]
+
+# JS and CSS bundles written to static/bundles, link them with {% raw bundle_tag("site.js") %}
+# BUNDLES = {
+#     "site.js": ["js/*.js"],
+#     "site.css": ["css/site.css"],
+# }
+
+# Route modules are imported on their first request. Their URL patterns are read
+# from each module's ROUTES, or can be declared here as (pattern, module name):
+# ROUTE_MANIFEST = [(r"/api/.*", "api")]
+
+# Admission control, command line options take precedence
+# MAX_IN_FLIGHT = 100           # requests handled at once
+# ROUTE_LIMITS = {r"/api/.*": 20}  # per route pattern, 0 exempts a route
+# QUEUE_TIMEOUT = 1.0           # seconds a request waits for a slot before a 503
+# MAX_QUEUE = 128               # requests allowed to wait
+# RATE_LIMIT = 50               # requests per second per client address before a 429
+# RATE_BURST = 100
+
+# Server-side sessions, defaults to .peonserver-data/sessions.sqlite3 next to the static directory
+# SESSION_DB = "memory"         # or the path of a SQLite database, "memory" is not shared by workers
+# SESSION_TTL = 14 * 24 * 3600  # seconds a session lives without being used
+
+# bcrypt password hashing, see peonserver.passwords
+# PASSWORD_COST = 12            # fixed cost factor instead of measuring one at startup
+# PASSWORD_TIME = 0.25          # seconds a measured cost factor should take per hash
+
+# Database for route handlers, self.settings["database"], see peonserver.database
+# DATABASE = "/var/lib/peonserver/site.sqlite3"
+# DATABASE_POOL_SIZE = 4        # connections per process
+# DATABASE_TIMEOUT = 5          # seconds to wait for a free connection before a 503
+
+# CPU-bound and periodic jobs, see peonserver.jobs
+# CPU_WORKERS = 2               # processes per worker for jobs.JOBS.run_cpu()
+# CPU_QUEUE = 256               # jobs waiting for a process before a 503
+# PERIODIC_JOBS = {"prune uploads": (3600, prune_uploads)}  # seconds between runs and the function
+
+# Further websites served by this server, picked by the Host header, see peonserver.vhosts
+# SITES = {
+#     "blog.example.com": "/srv/sites/blog",
+#     "shop.example.com, *.shop.example.com": "/srv/sites/shop",
+# }
+
+# Listening and HTTP server settings, command line options take precedence
+# BIND = ["127.0.0.1", "[::1]:8086"]  # addresses instead of every interface
+# UNIX_SOCKET = "/run/peonserver/peonserver.sock"
+# UNIX_SOCKET_MODE = 0o660
+# BACKLOG = 1024                # connections waiting to be accepted
+# XHEADERS = True               # client address from the reverse proxy's X-Real-Ip/X-Forwarded-For
+# NO_KEEP_ALIVE = False
+# IDLE_TIMEOUT = 75             # seconds an idle keep-alive connection stays open
+# BODY_TIMEOUT = 30             # seconds to receive a request body
+# MAX_BUFFER_SIZE = 10485760    # bytes of a request buffered in memory
+# MAX_BODY_SIZE = 10485760      # largest request body in bytes
+
+# Sampling profiler, see peonserver.profiler. The token enables /_profile and the X-Profile header
+# PROFILE_TOKEN = "a long random string"
+# PROFILE_PATH = "/var/tmp"      # directory for profile files
+# PROFILE_SECONDS = 30           # length of a profile started with `peonserver profile`
 """
 
-def main():
-    create_path = os.path.normpath(os.path.join(HERE, "..", "website"))
+def create_website(create_path=os.path.join(HERE, "..", "website")):
+    """Create the templated website structure at create_path, existing files are kept"""
+    create_path = os.path.normpath(create_path)
     os.makedirs(create_path, exist_ok=True)
     static_path = os.path.normpath(os.path.join(create_path, 'static'))
     for subdir in ['css', 'scss', 'js']:
@@ -50,5 +110,10 @@ def main():
         shutil.copyfile(os.path.join(HERE, "static", "index.html"), htmlfile)
         print(":: Copied default index.html file to new website")
 
+    return create_path
+
+def main():
+    create_website()
+
 if __name__ == "__main__":
     main()
@@ -1,19 +1,42 @@
 import os
 import sys
+import atexit
 import argparse
 import random
 import string
+import signal
 import asyncio
-import importlib
+import functools
 import logging
 import traceback
 import tornado
 import tornado.web
 from tornado.log import enable_pretty_logging
-import sass
 
 from peonserver import app
 from peonserver import daemon
+import peonserver.workers as pworkers
+import peonserver.sassbuild as sassbuild
+import peonserver.staticbuild as staticbuild
+from peonserver import static
+from peonserver import watch
+from peonserver import templates
+from peonserver import metrics
+from peonserver import admission
+from peonserver import routing
+from peonserver import startup
+from peonserver import drain
+from peonserver import handoff
+from peonserver import hotreload
+from peonserver import sessions
+from peonserver import passwords
+from peonserver import listen
+from peonserver import eventloop
+from peonserver import profiler
+from peonserver import bundles
+from peonserver import database
+from peonserver import jobs
+from peonserver import vhosts
 from peonserver import HERE
 import peonserver.log as plog
 
@@ -32,16 +55,14 @@ COMMON_WATCH_PATHS = [
 
 
 def compile_sass_files(static_path=STATIC_PATH):
-    sassdir = os.path.join(static_path, 'sass')
-    if not os.path.exists(sassdir):
-        sassdir = os.path.join(static_path, 'scss')
+    """Compile the scss entrypoints whose sources changed since the last build"""
+    return sassbuild.build(static_path)
 
-    if os.path.exists(sassdir):
-        files = os.listdir(sassdir)
-        for f in files:
-            plog.LOG.info(f"Compiling scss file {f}")
-            if f.endswith(".scss"):
-                sass.compile(dirname=(sassdir, os.path.join(static_path, "css")))
+def build_static(static_path=STATIC_PATH, bundle_sources=None):
+    """Compile sass, write the bundles, then fingerprint and precompress the static files, returns the manifest"""
+    compile_sass_files(static_path)
+    bundles.build(static_path, bundle_sources)
+    return staticbuild.build(static_path)
 
 def get_cookie_key(cookiefile=os.path.join(HERE, "cookie.secret"), keylength=80):
     cookiekey = ""
@@ -61,31 +82,49 @@ def get_cookie_key(cookiefile=os.path.join(HERE, "cookie.secret"), keylength=80)
 
     return cookiekey
 
-def find_website(path=os.path.join(HERE, "..", "website")):
+def find_website(path=os.path.join(HERE, "..", "website"), package=None):
+    """
+    Settings of the user website at path, imported as the `website` package,
+    or as package for a site hosted besides it, see peonserver.vhosts
+    """
     websitekw = {}
     if path is None or not os.path.exists(path):
         plog.LOG.info(f"Optional user content website path `{'None' if path is None else os.path.normpath(path)}` does not exist.")
         plog.LOG.info("Use `create-website` script to generate a templated website structure")
         return websitekw
 
-    plog.LOG.info(f"Found user website at {path}, adding to sys.path.")
-    sys.path.insert(0, os.path.join(path, ".."))
     try:
-        import website.globals
+        if package is None:
+            plog.LOG.info(f"Found user website at {path}, adding to sys.path.")
+            sys.path.insert(0, os.path.join(path, ".."))
+            import website.globals
+            site_globals = website.globals
+        else:
+            plog.LOG.info(f"Found hosted site at {path}, importing it as {package}")
+            site_globals = vhosts.import_site(path, package)
         #LEFT OFF FIXME: If attrs not found, ignore but warn unless critical
-        plog.LOG.info(f"Found website <{website.globals.WEBSITE}>")
+        plog.LOG.info(f"Found website <{site_globals.WEBSITE}>")
         websitekw['WATCH_PATHS'] = []
-        for wp in website.globals.WATCH_PATHS:
+        for wp in site_globals.WATCH_PATHS:
             found = os.path.exists(wp)
             plog.LOG.debug(f"\t\t: {'Ignoring missing' if not found else 'Found'} watch path {wp}")
             if found:
                 websitekw['WATCH_PATHS'].append(wp)
 
-        websitekw['STATIC_PATH'] = website.globals.STATIC_PATH
+        websitekw['STATIC_PATH'] = site_globals.STATIC_PATH
         plog.LOG.debug(f"\t:: STATIC_PATH found {websitekw['STATIC_PATH']}")
-        websitekw['WEBSITE'] = website.globals.WEBSITE
-        websitekw["TMPL_PATH"] = os.path.join(website.globals.HERE, "html")
-        websitekw["ROUTE_PATH"] = website.globals.ROUTE_PATH
+        websitekw['WEBSITE'] = site_globals.WEBSITE
+        websitekw["TMPL_PATH"] = os.path.join(site_globals.HERE, "html")
+        websitekw["ROUTE_PATH"] = site_globals.ROUTE_PATH
+        websitekw["WEBSITE_PATH"] = site_globals.HERE
+        websitekw["WEBSITE_PACKAGE"] = package
+        # Optional settings, command line options take precedence
+        for name in list(admission.WEBSITE_SETTINGS) + list(sessions.WEBSITE_SETTINGS) + \
+                list(passwords.WEBSITE_SETTINGS) + list(listen.WEBSITE_SETTINGS) + \
+                list(profiler.WEBSITE_SETTINGS) + list(database.WEBSITE_SETTINGS) + \
+                list(jobs.WEBSITE_SETTINGS) + list(vhosts.WEBSITE_SETTINGS) + ["ROUTE_MANIFEST", "BUNDLES"]:
+            if hasattr(site_globals, name):
+                websitekw[name] = getattr(site_globals, name)
     except ImportError as iE:
         plog.LOG.error(str(iE))
         plog.LOG.error(traceback.format_exc())
@@ -95,102 +134,385 @@ def find_website(path=os.path.join(HERE, "..", "website")):
     return websitekw
 
 def make_app(debug=False, **kwargs):
+    """
+    The application serving the website, or with hosted sites a
+    vhosts.VirtualHosts routing each request to the application of its site
+    """
     plog.LOG.setLevel(logging.DEBUG if debug else logging.INFO)
-    print(kwargs)
-    plog.LOG.info(debug)
+    plog.LOG.debug(f"make_app options: {kwargs}")
+    profile = startup.StartupProfile(kwargs.get("profile_startup", False))
 
-    autoreload = kwargs.get("autoreload", kwargs.get("debug", False) )
     website = kwargs.get("website")
-    userwebsite = find_website(path=website)
+    with profile.phase("find website"):
+        userwebsite = find_website(path=website)
+    with profile.phase("file watcher"):
+        watcher = watch.make_watcher()
+
+    # Keep hot static files in memory, kept fresh by file change notifications
+    cache_size = kwargs.get("static_cache_size")
+    if cache_size is None or cache_size > 0:
+        if cache_size is not None:
+            static.CACHE.max_size = int(cache_size) * 1024 * 1024
+        static.CACHE.enable(watcher)
+
+    # Settings of every site's application, the same objects for all of them
+    shared = {
+        "cookie_secret": kwargs.get("cookie_secret") or get_cookie_key(),
+        "file_watcher": watcher,
+        "page_cache": templates.PageCache() if kwargs.get("page_cache") else None,
+        "metrics": bool(kwargs.get("metrics")),
+        # For handlers checking a body's size before reading it, see uploads.StreamingHandler
+        "max_body_size": listen.body_limit(kwargs, userwebsite),
+    }
+
+    # Server-side sessions, shared by the workers through the database file
+    session_db = kwargs.get("session_db") or userwebsite.get("SESSION_DB")
+    if not session_db:
+        static_path = userwebsite.get("STATIC_PATH") or STATIC_PATH
+        session_db = sessions.default_path(static_path)
+    shared["session_store"] = sessions.make_store(
+        session_db, ttl=kwargs.get("session_ttl") or userwebsite.get("SESSION_TTL"))
+    passwords.HASHER.configure(cost=kwargs.get("password_cost") or userwebsite.get("PASSWORD_COST"),
+                               target=kwargs.get("password_time") or userwebsite.get("PASSWORD_TIME"))
+
+    # Pooled connections to the website's own database, for handlers to await queries on
+    database.POOL.configure(kwargs.get("database") or userwebsite.get("DATABASE"),
+                            size=kwargs.get("database_pool_size") or userwebsite.get("DATABASE_POOL_SIZE"),
+                            timeout=kwargs.get("database_timeout") or userwebsite.get("DATABASE_TIMEOUT"))
+    shared["database"] = database.POOL if database.POOL.enabled else None
+
+    # CPU-bound work and periodic jobs, the CPUs are shared by the HTTP workers
+    jobs.JOBS.configure(cpu_workers=kwargs.get("cpu_workers") or userwebsite.get("CPU_WORKERS"),
+                        max_queue=kwargs.get("cpu_queue") if kwargs.get("cpu_queue") is not None
+                        else userwebsite.get("CPU_QUEUE"),
+                        share=kwargs.get("http_workers"), periodic=userwebsite.get("PERIODIC_JOBS"))
+
+    profiler.PROFILER.configure(token=kwargs.get("profile_token") or userwebsite.get("PROFILE_TOKEN"),
+                                path=kwargs.get("profile_path") or userwebsite.get("PROFILE_PATH"),
+                                seconds=kwargs.get("profile_seconds") or userwebsite.get("PROFILE_SECONDS"))
+
+    limits = {}
+    for name, option in admission.WEBSITE_SETTINGS.items():
+        value = kwargs.get(option)
+        limits[option] = value if value is not None else userwebsite.get(name)
+    admission.CONTROL.configure(**limits)
+    if admission.CONTROL.enabled:
+        if shared["metrics"]:
+            # Keep scrapes working while overloaded
+            admission.CONTROL.route_limits.setdefault(r"/metrics", 0)
+        if profiler.PROFILER.enabled:
+            admission.CONTROL.route_limits.setdefault(profiler.PROFILE_URL, 0)
+
+    loaders = {}
+    application = make_site(userwebsite, shared, loaders, debug=debug, profile=profile, **kwargs)
+
+    # Further websites by Host header, each application made on its first request
+    hosted = []
+    for hosts, sitekw in hosted_sites(userwebsite, kwargs.get("sites")):
+        if kwargs.get("build_static", True):
+            with profile.phase(f"static build {hosts[0]}"):
+                build_static(sitekw["STATIC_PATH"], sitekw.get("BUNDLES"))
+        factory = functools.partial(make_site, sitekw, shared, loaders, debug=debug,
+                                    **dict(kwargs, build_static=False))
+        hosted.append((hosts, vhosts.LazySite(", ".join(hosts), factory, application)))
+    if hosted:
+        application = vhosts.VirtualHosts(application, hosted)
+
+    if profile.enabled:
+        plog.LOG.info(profile.report())
+    else:
+        plog.LOG.debug(profile.report())
+    return application
+
+def hosted_sites(userwebsite, sites=None):
+    """[(host names, find_website() settings)] of the sites hosted besides userwebsite, see peonserver.vhosts"""
+    hosted = []
+    taken = set()
+    for hosts, path in vhosts.resolve(sites or userwebsite.get("SITES")):
+        sitekw = find_website(path=path, package=vhosts.package_name(path, taken))
+        if not sitekw.get("STATIC_PATH"):
+            plog.LOG.error(f"Site {', '.join(hosts)} at {path} has no usable globals.py, skipped")
+            continue
+        hosted.append((hosts, sitekw))
+    return hosted
+
+def make_site(userwebsite, shared, loaders, debug=False, profile=None, **kwargs):
+    """
+    Application of one website, userwebsite as returned by find_website().
+    shared holds the settings every site gets, loaders the template loaders by
+    template directory, also shared by the sites.
+    """
+    profile = profile or startup.StartupProfile(False)
+    hot_reload = kwargs.get("autoreload", debug)
+    package = userwebsite.get("WEBSITE_PACKAGE")
     settings = {
         "static_path": userwebsite.get("STATIC_PATH") or STATIC_PATH,
-        "cookie_secret": get_cookie_key(),
         "login_url": "/admin",
         "xsrf_cookies": True,
         "WEBSITE": "Default PeonServer Webpage",
         "ROUTE_PATH": ROUTE_PATH,
+        # Templates and static files are kept fresh by the file watcher, also in debug mode
+        "compiled_template_cache": True,
+        "static_hash_cache": True,
+        "ui_methods": bundles.UI_METHODS,
     }
-
+    settings.update(shared)
     settings.update(userwebsite)
-    COMMON_WATCH_PATHS.extend([
+    common_paths = COMMON_WATCH_PATHS + [
         os.path.join(settings['static_path'], 'index.html'),
         TMPL_PATH,
         ROUTE_PATH,
         os.path.join(settings['static_path'], 'scss'),
         os.path.join(settings['static_path'], 'js'),
         os.path.join(settings['static_path'], 'css')
-    ])
-    COMMON_WATCH_PATHS.extend(userwebsite.get("WATCH_PATHS", []))
+    ] + userwebsite.get("WATCH_PATHS", [])
 
-    if autoreload:
-        # Remove duplicates
-        for _dir in set(COMMON_WATCH_PATHS):
-            plog.LOG.debug(f"Watching in directory path {_dir}")
-
-            if not os.path.isfile(_dir):
-                if not os.path.exists(_dir):
-                    plog.LOG.warn(f"Watch directory {_dir} does not exist, skipping...")
-                    continue
-                files = os.listdir(_dir)
-
-            else:
-                files = [_dir]
-
-            for f in files:
-                if f.startswith("."):
-                    continue
-                plog.LOG.info(f"Watching file {f}")
-                tornado.autoreload.watch(os.path.join(settings['static_path'], _dir, f))
+    # compile sass and build static assets, forked workers get this done once by the supervisor
+    with profile.phase("static build"):
+        if kwargs.get("build_static", True):
+            settings["static_manifest"] = build_static(settings['static_path'], userwebsite.get("BUNDLES"))
+        else:
+            settings["static_manifest"] = staticbuild.load_manifest(settings['static_path'])
 
-    # compile sass
-    compile_sass_files(settings['static_path'])
+    template_path = userwebsite.get("TMPL_PATH", TMPL_PATH)
+    index_template = os.path.join(settings['static_path'], 'index.html')
+    routes = userwebsite.get("ROUTE_PATH", ROUTE_PATH)
+    watch_paths = [settings['static_path'], settings['static_manifest'].build_path, template_path]
+    if hot_reload:
+        # Python sources are only watched to reload them in place, see hotreload
+        watch_paths.extend([routes, HERE] + sorted(set(common_paths)))
+        if userwebsite.get("WEBSITE_PATH"):
+            watch_paths.append(userwebsite["WEBSITE_PATH"])
+    watcher = settings["file_watcher"]
+    with profile.phase("file watcher"):
+        for path in watch_paths:
+            if os.path.exists(path):
+                watcher.add(path)
+
+    # Compile templates now rather than on first request, sites with the same templates share them
+    with profile.phase("templates"):
+        loader = loaders.get(os.path.abspath(template_path))
+        if loader is None:
+            loader = loaders[os.path.abspath(template_path)] = templates.make_loader(template_path, settings)
+        settings["template_loader"] = loader
+        templates.warm(loader, [index_template])
+    watcher.subscribe(templates.TemplateReloader(loader, settings["page_cache"],
+                                                 roots=[template_path, settings['static_path']],
+                                                 extra=[index_template]))
+
+    def routes_loaded(routes):
+        # Lazily imported route modules still get their metrics and admission labels
+        metrics.REGISTRY.register_routes(routes)
+        admission.CONTROL.register_routes(routes)
 
     plog.LOG.debug(f'ROUTE PATH {settings.get("ROUTE_PATH")}')
     plog.LOG.debug( f'Custom route dir: {userwebsite.get("ROUTE_PATH")}' )
-    routes = userwebsite.get("ROUTE_PATH", ROUTE_PATH)
-    mod = None
     plog.LOG.debug(f'routes found: {routes}')
-    sys.path.insert(0, settings['ROUTE_PATH'])
-    foundroutes = []
-    for r in os.listdir(routes):
-        print(r)
-        # Skip hidden files, require python modules and do not allow __init__ or __main__
-        if not r.startswith(".") and r.endswith(".py") and not r.startswith("__"):
-            mod = importlib.import_module(r.replace(".py", ""), 'peonserver.routes' if not userwebsite.get("ROUTE_PATH") else 'website.routes')
-            foundroutes.extend(mod.ROUTES)
-
-    return tornado.web.Application([
-            (r"/", app.MainHandler),
-            (r"/static/(.*)", tornado.web.StaticFileHandler, {"path": settings['static_path']}),
-        ] + foundroutes,
-        template_path=userwebsite.get("TMPL_PATH", TMPL_PATH),
-        debug=kwargs.get("debug", False),
-        autoreload=autoreload,
-        **settings
-    )
+    if package is None:
+        sys.path.insert(0, settings['ROUTE_PATH'])
+        route_package = 'peonserver.routes' if not userwebsite.get("ROUTE_PATH") else 'website.routes'
+        prefix = None
+    else:
+        # Route modules of hosted sites are kept apart by importing them from a package of each site
+        route_package = prefix = f"{package}.routes"
+        vhosts.import_package(prefix, routes)
+    with profile.phase("routes"):
+        foundroutes, lazyroutes = routing.load_routes(
+            routes, route_package, prefix=prefix,
+            lazy=not kwargs.get("eager_routes", False), declared=userwebsite.get("ROUTE_MANIFEST"),
+            on_load=routes_loaded)
+
+    handlers = [
+        (r"/", app.MainHandler),
+        (r"/static/(.*)", static.StaticHandler, {"path": settings['static_path']}),
+    ]
+    # Process wide endpoints are served by the default website only
+    if settings["metrics"] and package is None:
+        handlers.append((r"/metrics", metrics.MetricsHandler))
+    if profiler.PROFILER.enabled and package is None:
+        handlers.append((profiler.PROFILE_URL, profiler.ProfileHandler))
+    handlers.extend(foundroutes)
+
+    with profile.phase("application"):
+        application = tornado.web.Application(handlers,
+            template_path=template_path,
+            static_handler_class=static.StaticHandler,
+            log_function=plog.access_logger(kwargs.get("access_log_format", "text"),
+                                            kwargs.get("access_log_sample", 1.0)),
+            debug=debug,
+            autoreload=False,
+            **settings
+        )
+        routing.install(application, lazyroutes)
+        if hot_reload:
+            watcher.subscribe(hotreload.HotReloader(
+                application, static_path=settings['static_path'],
+                build_path=settings['static_manifest'].build_path, template_path=template_path,
+                route_path=routes, prefix=prefix, lazy=lazyroutes, on_load=routes_loaded,
+                bundles=userwebsite.get("BUNDLES"),
+                source_paths=[p for p in (HERE, userwebsite.get("WEBSITE_PATH")) if p],
+                watch_paths=userwebsite.get("WATCH_PATHS", [])))
+            plog.LOG.info(f"Hot reloading changes under {len(watch_paths)} watched path(s)")
+        if settings["metrics"]:
+            metrics.install(application, handlers)
+        if profiler.PROFILER.enabled:
+            profiler.install(application)
+        if admission.CONTROL.enabled:
+            admission.install(application, handlers)
+    return application
+
+async def serve(sockets, debug=False, website=None, reloadable=False, **kwargs):
+    """
+    Build the app on the current event loop and serve already bound sockets
+    until SIGTERM or SIGINT, then drain in-flight requests for up to
+    drain_timeout seconds, a second signal closes them right away. With
+    reloadable, SIGHUP hands the sockets to a successor process and drains.
+    """
+    app = make_app(debug=debug, website=website, **kwargs)
+    server = drain.DrainingHTTPServer(app, **listen.server_options(kwargs, app.settings))
+    server.add_sockets(sockets)
+    if app.settings.get("metrics"):
+        metrics.watch_server(server)
+    handoff.ready()
+    jobs.JOBS.start()
+
+    loop = asyncio.get_running_loop()
+    plog.LOG.debug(f"Serving on {eventloop.describe(loop)}")
+    watchdog = eventloop.Watchdog(kwargs["slow_callback"]).start() if kwargs.get("slow_callback") else None
+    stopping = asyncio.Event()
+
+    async def reload():
+        if await loop.run_in_executor(None, handoff.replace, sockets):
+            stopping.set()
+        else:
+            plog.LOG.error("Reload failed, still serving")
+
+    def stop():
+        if stopping.is_set():
+            plog.LOG.warning("Stopping again, closing in-flight requests")
+            server.abort()
+        stopping.set()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop)
+    if reloadable:
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(reload()))
+    loop.add_signal_handler(signal.SIGUSR2, lambda: asyncio.ensure_future(profiler.PROFILER.profile_to_file()))
+    await stopping.wait()
+    # The successor or another server runs the periodic jobs from now on
+    jobs.JOBS.unschedule()
+    if reloadable:
+        loop.remove_signal_handler(signal.SIGHUP)
+    loop.remove_signal_handler(signal.SIGUSR2)
+    await server.drain(kwargs.get("drain_timeout", drain.DEFAULT_DRAIN_TIMEOUT))
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.remove_signal_handler(signum)
+    app.settings["session_store"].close()
+    await jobs.JOBS.close()
+    database.POOL.close()
+    if watchdog is not None:
+        watchdog.stop()
+    plog.LOG.info("Server stopped")
+
+def run_server(port=8085, workers=1, debug=False, website=None, **kwargs):
+    """
+    Bind the port once, or take over the sockets of the process we replace on a
+    reload, and serve it either from this process or from a pool of forked
+    workers that each build their own app with make_app.
+
+    Must be awaited on the process's only running loop when workers == 1. With
+    more workers the calling process becomes the supervisor and blocks until all
+    workers are shut down. Other keyword arguments are passed on to make_app.
+    """
+    userwebsite = find_website(path=website)
+    sockets = handoff.inherited_sockets() or \
+        listen.bind(port, **listen.resolve(listen.BIND_SETTINGS, kwargs, userwebsite))
+    handoff.announce(workers)
+    if workers == 1:
+        return serve(sockets, debug=debug, website=website, reloadable=True, **kwargs)
+
+    # The cookie secret may be randomly generated, so all workers need to share one
+    # and static build output would otherwise be written by every worker at once.
+    cookie_secret = get_cookie_key()
+    build_static(userwebsite.get("STATIC_PATH") or STATIC_PATH, userwebsite.get("BUNDLES"))
+    for hosts, sitekw in hosted_sites(userwebsite, kwargs.get("sites")):
+        build_static(sitekw["STATIC_PATH"], sitekw.get("BUNDLES"))
+
+    def worker(worker_id):
+        # Forked children get a fresh event loop, the parent's is not usable here.
+        eventloop.run(serve(sockets, debug=debug, website=website,
+                            cookie_secret=cookie_secret, build_static=False, http_workers=workers, **kwargs),
+                      kwargs.get("event_loop"))
+
+    plog.share_with_workers()
+    shutdown_timeout = kwargs.get("drain_timeout", drain.DEFAULT_DRAIN_TIMEOUT) + drain.SHUTDOWN_GRACE
+    pworkers.WorkerPool(workers, reload=lambda: handoff.replace(sockets), started=handoff.close_ready,
+                        shutdown_timeout=shutdown_timeout).run(worker)
+
+def worker_count(value, debug=False):
+    """Resolve the --workers option, autoreload only works in a single process"""
+    value = int(value) if value else pworkers.cpu_count()
+    if value < 1:
+        value = pworkers.cpu_count()
+    if debug and value > 1:
+        plog.LOG.warning(f"Debug autoreloading is not compatible with {value} workers, using 1")
+        value = 1
+    return value
 
 class ServerDaemon(daemon.Daemon):
 
     website = None
     debug = False
+    workers = 1
+    options = {}  # make_app keyword arguments, see app_options()
+    loop = eventloop.AUTO  # --loop
+    reloadable = True
+
+    def run_loop(self, main):
+        return eventloop.run(main, self.loop)
+
+    def start(self):
+        if not handoff.is_successor():
+            return super().start()
+        # Started by a reload of the running daemon, which is already detached and
+        # points the pid file at us once we accept on the sockets it handed over.
+        atexit.register(self.delpid)
+        self.run_loop(self.run())
+
+    def profile(self):
+        """Ask the daemon to profile every serving process, returns False if it is not running"""
+        pid = self.getpid()
+        if not pid:
+            sys.stderr.write(f"pidfile {self.pidfile} does not exist. Daemon not running?\n")
+            return False
+        try:
+            os.kill(pid, signal.SIGUSR2)
+        except ProcessLookupError:
+            sys.stderr.write(f"Daemon process {pid} is not running\n")
+            return False
+        seconds = self.options.get("profile_seconds") or profiler.DEFAULT_SECONDS
+        print(f"Profiling for {seconds:g}s, see the log for the profile files")
+        return True
 
     async def run(self):
         self.log.info(f"Running {NAME}")
+        handoff.PIDFILE = self.pidfile
         try:
-            app = make_app(website=self.website)
-            plog.LOG.info(f"App created and hosted on localhost:{self.port}, Debugging {'enabled' if self.debug else 'disabled'}")
-            app.listen(self.port)
-            asyncio.run(await asyncio.Event().wait())
+            plog.LOG.info(f"App created and hosted on localhost:{self.port} with {self.workers} worker(s), Debugging {'enabled' if self.debug else 'disabled'}")
+            serving = run_server(port=self.port, workers=self.workers, debug=self.debug, website=self.website,
+                                 **self.options)
+            if serving is not None:
+                await serving
         except Exception as E:
             plog.LOG.error(str(E))
             plog.LOG.error(traceback.format_exc())
 
-async def run_tornado(debug=True, port=8085, website=None):
+async def run_tornado(debug=True, port=8085, website=None, workers=1, **kwargs):
     try:
-        app = make_app(debug=debug, website=website)
-        plog.LOG.info(f"App created and hosted on localhost:{port}, {'enabled' if debug else 'disabled'}")
-        app.listen(port)
-        asyncio.run(await asyncio.Event().wait())
+        plog.LOG.info(f"App created and hosted on localhost:{port} with {workers} worker(s), Debugging {'enabled' if debug else 'disabled'}")
+        serving = run_server(port=port, workers=workers, debug=debug, website=website, **kwargs)
+        if serving is not None:
+            await serving
     except Exception as E:
         plog.LOG.error(str(E))
         plog.LOG.error(traceback.format_exc())
@@ -198,7 +520,12 @@ async def run_tornado(debug=True, port=8085, website=None):
 def main(*args, **kwargs):
     p = parser()
     parser_args = p.parse_args()
-    run_daemon(parser_args, kwargs)
+    if parser_args.loop == eventloop.UVLOOP and eventloop.uvloop is None:
+        p.error("--loop uvloop needs the uvloop package")
+    try:
+        run_daemon(parser_args, **kwargs)
+    finally:
+        plog.shutdown()
 
 def parser():
     parser = argparse.ArgumentParser(prog=f"{NAME.lower()}", description=f"{NAME} webserver host")
@@ -209,23 +536,147 @@ def parser():
     parser.add_argument("--pid-name", default=PIDNAME, help="Name of the server pid file")
     parser.add_argument("--silent", default=False, help="Daemon should be silent")
     parser.add_argument("--debug", action="store_true", default=False, help="Enable debugging logs and autoreloading")
+    parser.add_argument("--workers", type=int, default=pworkers.cpu_count(),
+                        help="Number of forked worker processes sharing the port, defaults to the CPU count")
     parser.add_argument("--no-daemon", default=False, action="store_true",
                         help="Use the tornado event loop for running the website (useful for debugging)")
+    parser.add_argument("--static-cache-size", type=int, default=static.MAX_CACHE_SIZE // (1024 * 1024),
+                        help="Megabytes of small static files kept in memory, 0 disables the cache")
+    parser.add_argument("--page-cache", action="store_true", default=False,
+                        help="Cache pages rendered by handlers using render_cached(), answering 304 on matching ETags")
+    parser.add_argument("--access-log-format", choices=["text", "json"], default="text",
+                        help="Access log line format, json writes one compact object per request with its latency")
+    parser.add_argument("--access-log-sample", type=float, default=1.0,
+                        help="Fraction of successful requests written to the access log, errors are always logged")
+    parser.add_argument("--metrics", action="store_true", default=False,
+                        help="Serve Prometheus metrics at /metrics")
+    parser.add_argument("--drain-timeout", type=float, default=drain.DEFAULT_DRAIN_TIMEOUT,
+                        help="Seconds in-flight requests get to finish when stopping or reloading")
+    parser.add_argument("--session-db", default=None,
+                        help=f"SQLite database of the sessions, `{sessions.MEMORY}` keeps them in the process only")
+    parser.add_argument("--database", default=None, metavar="PATH",
+                        help="SQLite database handlers query through self.settings['database'] (website DATABASE)")
+    parser.add_argument("--database-pool-size", type=int, default=None,
+                        help=f"Database connections per process, default {database.DEFAULT_POOL_SIZE} "
+                             "(website DATABASE_POOL_SIZE)")
+    parser.add_argument("--database-timeout", type=float, default=None,
+                        help="Seconds to wait for a free database connection before a 503, default "
+                             f"{database.DEFAULT_TIMEOUT:g} (website DATABASE_TIMEOUT)")
+    parser.add_argument("--cpu-workers", type=int, default=None,
+                        help="Processes running CPU jobs per worker, defaults to the CPUs divided among the workers "
+                             "(website CPU_WORKERS)")
+    parser.add_argument("--cpu-queue", type=int, default=None,
+                        help=f"CPU jobs waiting for a process before a 503, default {jobs.DEFAULT_MAX_QUEUE} "
+                             "(website CPU_QUEUE)")
+    parser.add_argument("--site", action="append", default=None, type=vhosts.parse_site, metavar="HOSTS=PATH",
+                        help="Serve the website at PATH for the comma separated host names, * matching any "
+                             "subdomain, may be given more than once (website SITES)")
+    parser.add_argument("--eager-routes", action="store_true", default=False,
+                        help="Import every route module at startup instead of on its first request")
+    parser.add_argument("--profile-startup", action="store_true", default=False,
+                        help="Log how long each startup phase took and the slowest functions")
+    parser.add_argument("--max-in-flight", type=int, default=None,
+                        help="Requests handled at once before new ones wait, 0 for no limit (website MAX_IN_FLIGHT)")
+    parser.add_argument("--queue-timeout", type=float, default=None,
+                        help="Seconds a request waits for a free slot before a 503, default "
+                             f"{admission.DEFAULT_QUEUE_TIMEOUT:g} (website QUEUE_TIMEOUT)")
+    parser.add_argument("--max-queue", type=int, default=None,
+                        help=f"Requests allowed to wait at once, default {admission.DEFAULT_MAX_QUEUE} (website MAX_QUEUE)")
+    parser.add_argument("--rate-limit", type=float, default=None,
+                        help="Requests per second allowed per client address before a 429 (website RATE_LIMIT)")
+    parser.add_argument("--rate-burst", type=int, default=None,
+                        help="Requests a client may send at once, defaults to the rate limit (website RATE_BURST)")
+    parser.add_argument("--bind", action="append", default=None, metavar="ADDRESS",
+                        help="Address to listen on instead of every interface, host, host:port or [ipv6]:port, "
+                             "may be given more than once (website BIND)")
+    parser.add_argument("--unix-socket", default=None, metavar="PATH",
+                        help="Unix domain socket to listen on, for a local reverse proxy (website UNIX_SOCKET)")
+    parser.add_argument("--unix-socket-mode", default=None,
+                        help=f"Octal permissions of the unix socket, default {listen.DEFAULT_SOCKET_MODE:o} "
+                             "(website UNIX_SOCKET_MODE)")
+    parser.add_argument("--backlog", type=int, default=None,
+                        help=f"Connections waiting to be accepted, default {listen.DEFAULT_BACKLOG} (website BACKLOG)")
+    parser.add_argument("--xheaders", action="store_true", default=None,
+                        help="Take the client address and scheme from the proxy's X-Real-Ip/X-Forwarded-For "
+                             "and X-Scheme/X-Forwarded-Proto headers (website XHEADERS)")
+    parser.add_argument("--no-keep-alive", action="store_true", default=None,
+                        help="Close every connection after its response (website NO_KEEP_ALIVE)")
+    parser.add_argument("--idle-timeout", type=float, default=None,
+                        help="Seconds an idle keep-alive connection stays open, default 3600 (website IDLE_TIMEOUT)")
+    parser.add_argument("--body-timeout", type=float, default=None,
+                        help="Seconds a client has to send a request body (website BODY_TIMEOUT)")
+    parser.add_argument("--max-buffer-size", type=int, default=None,
+                        help="Bytes of a request buffered in memory, default 100MB (website MAX_BUFFER_SIZE)")
+    parser.add_argument("--max-body-size", type=int, default=None,
+                        help="Largest request body in bytes, defaults to the buffer size (website MAX_BODY_SIZE)")
+    parser.add_argument("--profile-seconds", type=float, default=None,
+                        help=f"Length of a profile started by SIGUSR2 or the profile action, default "
+                             f"{profiler.DEFAULT_SECONDS:g} (website PROFILE_SECONDS)")
+    parser.add_argument("--profile-path", default=None,
+                        help="Directory for profile files, the temporary directory by default (website PROFILE_PATH)")
+    parser.add_argument("--loop", choices=eventloop.LOOPS, default=eventloop.AUTO,
+                        help="Event loop implementation, auto uses uvloop when it is installed")
+    parser.add_argument("--slow-callback", type=float, default=0, metavar="SECONDS",
+                        help="Log the stack of code blocking the event loop for longer than this, 0 disables it")
     subparsers = parser.add_subparsers(help="daemon actions", dest="action")
     subparsers.required = False
     parser_start = subparsers.add_parser('start', help=f"Start the {NAME.lower()} daemon")
     parser_stop = subparsers.add_parser('stop', help=f"Stop the {NAME.lower()} daemon")
-    parser_restart = subparsers.add_parser('restart', help=f"Restart the {NAME.lower()} daemon")
+    parser_restart = subparsers.add_parser('restart', help=f"Restart the {NAME.lower()} daemon without dropping requests")
+    parser_reload = subparsers.add_parser('reload', help=f"Hand the {NAME.lower()} daemon's port to a freshly started one")
+    parser_profile = subparsers.add_parser('profile', help=f"Profile the running {NAME.lower()} daemon, see --profile-seconds")
     parser_status = subparsers.add_parser('status', help=f"Print out {NAME.lower()} daemon status")
     return parser
 
 
+def app_options(parser_args):
+    """make_app keyword arguments taken from the parsed command line"""
+    return {
+        "static_cache_size": parser_args.static_cache_size,
+        "page_cache": parser_args.page_cache,
+        "access_log_format": parser_args.access_log_format,
+        "access_log_sample": parser_args.access_log_sample,
+        "metrics": parser_args.metrics,
+        "drain_timeout": parser_args.drain_timeout,
+        "session_db": parser_args.session_db,
+        "database": parser_args.database,
+        "database_pool_size": parser_args.database_pool_size,
+        "database_timeout": parser_args.database_timeout,
+        "cpu_workers": parser_args.cpu_workers,
+        "cpu_queue": parser_args.cpu_queue,
+        "sites": parser_args.site,
+        "eager_routes": parser_args.eager_routes,
+        "profile_startup": parser_args.profile_startup,
+        "max_in_flight": parser_args.max_in_flight,
+        "queue_timeout": parser_args.queue_timeout,
+        "max_queue": parser_args.max_queue,
+        "rate_limit": parser_args.rate_limit,
+        "rate_burst": parser_args.rate_burst,
+        "bind": parser_args.bind,
+        "unix_socket": parser_args.unix_socket,
+        "unix_socket_mode": parser_args.unix_socket_mode,
+        "backlog": parser_args.backlog,
+        "xheaders": parser_args.xheaders,
+        "no_keep_alive": parser_args.no_keep_alive,
+        "idle_connection_timeout": parser_args.idle_timeout,
+        "body_timeout": parser_args.body_timeout,
+        "max_buffer_size": parser_args.max_buffer_size,
+        "max_body_size": parser_args.max_body_size,
+        "event_loop": parser_args.loop,
+        "slow_callback": parser_args.slow_callback,
+        "profile_seconds": parser_args.profile_seconds,
+        "profile_path": parser_args.profile_path,
+    }
+
 def run_daemon(parser_args, **kwargs):
     enable_pretty_logging()
     if parser_args.no_daemon:
         plog.set_logger(name=NAME)
         plog.LOG.info(f"Setting logfile to use stdout")
-        asyncio.run(run_tornado())
+        eventloop.run(run_tornado(debug=parser_args.debug, port=parser_args.port,
+                                  website=kwargs.get("website"),
+                                  workers=worker_count(parser_args.workers, parser_args.debug),
+                                  **app_options(parser_args)), parser_args.loop)
     else:
         if parser_args.logfile:
             plog.set_logger(parser_args.logfile, name=NAME)
@@ -238,19 +689,32 @@ def run_daemon(parser_args, **kwargs):
             pidpath=parser_args.pid_path,
             silent=parser_args.silent,
             logfile=parser_args.logfile,
-            port=parser_args.port)
+            port=parser_args.port,
+            # Leaves the supervisor time to kill its own workers first
+            stop_timeout=parser_args.drain_timeout + 2 * drain.SHUTDOWN_GRACE)
         daemon.website = kwargs.get("website")
-        daemon.debug = True
+        daemon.debug = parser_args.debug
+        daemon.workers = worker_count(parser_args.workers, parser_args.debug)
+        daemon.options = app_options(parser_args)
+        daemon.loop = parser_args.loop
         plog.LOG.info(f"Setting debug to {parser_args.debug}")
 
         if parser_args.action == "start":
-            asyncio.run(daemon.start())
+            daemon.start()
 
         elif parser_args.action == "stop":
             asyncio.run(daemon.stop())
 
         elif parser_args.action == "restart":
-            asyncio.run(daemon.restart())
+            daemon.restart()
+
+        elif parser_args.action == "reload":
+            if not asyncio.run(daemon.reload()):
+                sys.exit(1)
+
+        elif parser_args.action == "profile":
+            if not daemon.profile():
+                sys.exit(1)
 
         elif parser_args.action == "status":
             asyncio.run(daemon.status())
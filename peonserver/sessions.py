@@ -0,0 +1,228 @@
+"""
+Server-side sessions.
+
+The session cookie holds nothing but a random session id, the session data
+stays on the server in a backend, SQLite on local disk by default, so it
+survives restarts and is shared by every worker process using the same
+database. Verified sessions are kept in an in-memory LRU for `cache_ttl`
+seconds, so an authenticated request usually costs a dictionary lookup
+instead of decoding and verifying a signed cookie.
+
+Each process has its own LRU: a session deleted by one worker is still
+accepted by the others until their cached copy expires, at most `cache_ttl`
+seconds later.
+
+Handlers use it through app.AuthenticatedHandler, or directly:
+
+    store = self.settings["session_store"]
+    session = await store.get(self.get_cookie(store.cookie_name))
+"""
+import os
+import json
+import time
+import sqlite3
+import secrets
+import asyncio
+import collections
+import concurrent.futures
+
+import peonserver.log as plog
+
+COOKIE_NAME = "session"
+SESSION_TTL = 14 * 24 * 3600.0  # seconds a session lives without being used
+CACHE_TTL = 30.0  # seconds a verified session is trusted without asking the backend
+MAX_CACHED = 10000
+TOUCH_INTERVAL = 3600.0  # seconds between extending the expiry of a session in use
+PURGE_INTERVAL = 3600.0  # seconds between deleting expired sessions from the backend
+ID_BYTES = 24  # 32 characters in the cookie
+DB_NAME = "sessions.sqlite3"
+DATA_DIR = ".peonserver-data"  # kept state, unlike the build cache next to it this is never safe to delete
+MEMORY = "memory"  # session_db value keeping sessions in the process only
+
+WEBSITE_SETTINGS = {
+    "SESSION_DB": "session_db",
+    "SESSION_TTL": "session_ttl",
+}
+
+
+class Session():
+    __slots__ = ("id", "data", "expires", "touched", "verified")
+
+    def __init__(self, id, data=None, expires=0.0):
+        self.id = id
+        self.data = data if data is not None else {}
+        self.expires = expires
+        self.touched = 0.0   # when the backend last extended expires
+        self.verified = 0.0  # when the backend last confirmed the session
+
+
+class MemoryBackend():
+    """Sessions in this process only, lost on restart and not shared by workers"""
+
+    def __init__(self):
+        self.sessions = {}  # id -> (data, expires)
+
+    async def load(self, sid):
+        return self.sessions.get(sid)
+
+    async def save(self, sid, data, expires):
+        self.sessions[sid] = (data, expires)
+
+    async def touch(self, sid, expires):
+        if sid in self.sessions:
+            self.sessions[sid] = (self.sessions[sid][0], expires)
+
+    async def delete(self, sid):
+        self.sessions.pop(sid, None)
+
+    async def purge(self, now):
+        for sid in [s for s, (_, expires) in self.sessions.items() if expires <= now]:
+            del self.sessions[sid]
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend():
+    """
+    Sessions in a SQLite database, queried on a thread of their own so the
+    event loop never waits on the disk. Every process opens its own
+    connection, so forked workers can share one database file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sessions")
+
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5.0, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS sessions "
+                               "(id TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+            self.connection = connection
+        return self.connection
+
+    def execute(self, sql, params=()):
+        return self.connect().execute(sql, params).fetchone()
+
+    async def run(self, sql, params=()):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.execute, sql, params)
+
+    async def load(self, sid):
+        row = await self.run("SELECT data, expires FROM sessions WHERE id = ?", (sid,))
+        return (json.loads(row[0]), row[1]) if row else None
+
+    async def save(self, sid, data, expires):
+        await self.run("INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)",
+                       (sid, json.dumps(data, separators=(",", ":")), expires))
+
+    async def touch(self, sid, expires):
+        await self.run("UPDATE sessions SET expires = ? WHERE id = ?", (expires, sid))
+
+    async def delete(self, sid):
+        await self.run("DELETE FROM sessions WHERE id = ?", (sid,))
+
+    async def purge(self, now):
+        await self.run("DELETE FROM sessions WHERE expires <= ?", (now,))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class SessionStore():
+    """Sessions of one application, a verified LRU in front of a backend"""
+
+    def __init__(self, backend=None, **kwargs):
+        """
+        :Parameters:
+            - ttl: seconds a session lives without being used, default SESSION_TTL
+            - cache_ttl: seconds a cached session is trusted, default CACHE_TTL
+            - max_cached: sessions kept in memory, default MAX_CACHED
+            - cookie_name: default COOKIE_NAME
+        """
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = kwargs.get("ttl") or SESSION_TTL
+        self.cache_ttl = kwargs.get("cache_ttl", CACHE_TTL)
+        self.max_cached = kwargs.get("max_cached", MAX_CACHED)
+        self.cookie_name = kwargs.get("cookie_name", COOKIE_NAME)
+        self.cache = collections.OrderedDict()  # id -> Session
+        self.purged = time.time()
+        self.hits = 0
+        self.misses = 0
+
+    def remember(self, session):
+        self.cache[session.id] = session
+        self.cache.move_to_end(session.id)
+        while len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
+
+    async def get(self, sid):
+        """The live session with id sid, None for an unknown or expired id"""
+        if not sid:
+            return None
+        now = time.time()
+        session = self.cache.get(sid)
+        if session is not None and now - session.verified < self.cache_ttl and now < session.expires:
+            self.hits += 1
+            self.cache.move_to_end(sid)
+        else:
+            self.misses += 1
+            self.cache.pop(sid, None)
+            found = await self.backend.load(sid)
+            if found is None or found[1] <= now:
+                return None
+            session = Session(sid, found[0], found[1])
+            session.touched = session.verified = now
+            self.remember(session)
+
+        if now - session.touched > TOUCH_INTERVAL:
+            session.touched = now
+            session.expires = now + self.ttl
+            await self.backend.touch(sid, session.expires)
+        return session
+
+    async def create(self, data=None):
+        """Start and save a new session"""
+        now = time.time()
+        session = Session(secrets.token_urlsafe(ID_BYTES), data, now + self.ttl)
+        session.touched = session.verified = now
+        await self.backend.save(session.id, session.data, session.expires)
+        self.remember(session)
+        if now - self.purged > PURGE_INTERVAL:
+            self.purged = now
+            await self.backend.purge(now)
+        return session
+
+    async def save(self, session):
+        """Write changes of session.data to the backend"""
+        await self.backend.save(session.id, session.data, session.expires)
+        session.verified = time.time()
+        self.remember(session)
+
+    async def delete(self, sid):
+        self.cache.pop(sid, None)
+        await self.backend.delete(sid)
+
+    def close(self):
+        self.backend.close()
+
+
+def default_path(static_path):
+    """Session database of the website serving static_path, in DATA_DIR next to the static directory"""
+    return os.path.join(os.path.dirname(os.path.normpath(static_path)), DATA_DIR, DB_NAME)
+
+def make_store(path=None, **kwargs):
+    """SessionStore on the SQLite database at path, or in memory for MEMORY"""
+    if path == MEMORY:
+        return SessionStore(MemoryBackend(), **kwargs)
+    plog.LOG.debug(f"Sessions are kept in {path}")
+    return SessionStore(SQLiteBackend(path), **kwargs)
@@ -0,0 +1,64 @@
+"""
+Startup timing for --profile-startup.
+
+make_app times each of its phases with StartupProfile.phase(). With
+--profile-startup the phases are also run under cProfile, and report() lists
+the time spent before make_app (interpreter start and imports), every phase
+and the functions with the most cumulative time.
+"""
+import io
+import os
+import time
+import pstats
+import cProfile
+import contextlib
+
+TOP_FUNCTIONS = 25
+
+
+def process_age():
+    """Seconds since this process started, None where /proc is not available"""
+    try:
+        with open("/proc/self/stat", 'r') as f:
+            started = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", 'r') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - started / os.sysconf("SC_CLK_TCK")
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class StartupProfile():
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.before = process_age()
+        self.phases = []  # (name, seconds)
+        self.profiler = cProfile.Profile() if enabled else None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+        try:
+            yield
+        finally:
+            if self.profiler is not None:
+                self.profiler.disable()
+            self.phases.append((name, time.perf_counter() - start))
+
+    def report(self):
+        total = sum(seconds for _, seconds in self.phases)
+        lines = ["Startup profile:"]
+        if self.before is not None:
+            lines.append(f"  {'process start and imports':<28}{self.before * 1000.0:>10.1f}ms")
+        for name, seconds in self.phases:
+            share = seconds / total * 100.0 if total else 0.0
+            lines.append(f"  {name:<28}{seconds * 1000.0:>10.1f}ms {share:>5.1f}%")
+        lines.append(f"  {'make_app total':<28}{total * 1000.0:>10.1f}ms")
+        if self.profiler is not None:
+            out = io.StringIO()
+            pstats.Stats(self.profiler, stream=out).sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+            lines.append(out.getvalue().rstrip())
+        return "\n".join(lines)
@@ -0,0 +1,299 @@
+"""
+Static file serving backed by the build stage in ``peonserver.staticbuild``.
+
+Requests for fingerprinted names are served from the build directory as
+immutable, and compressible files are answered with their precompressed
+``.br``/``.gz`` variant when the client accepts it.
+
+Once a file watcher is attached to ``CACHE`` the metadata of every served
+file, and the contents of small ones, are kept in a size-bounded LRU that is
+invalidated by change notifications, so hot files are answered without any
+filesystem syscalls. Files too large for the cache are mapped into memory
+and handed to the connection as memoryview slices of the mapping, so their
+contents go to the socket without being read into Python bytes first.
+"""
+import os
+import mmap
+import hashlib
+import mimetypes
+import collections
+
+import tornado.web
+
+from peonserver.staticbuild import ENCODINGS
+from peonserver.watch import OVERFLOW
+
+MAX_CACHE_SIZE = 64 * 1024 * 1024      # bytes of file contents held in memory
+MAX_ENTRY_SIZE = 256 * 1024            # larger files are never held in memory
+MAX_ENTRIES = 10000                    # metadata only entries count towards this
+MAP_CHUNK_SIZE = 1024 * 1024           # bytes of a mapped file handed to the connection per flush
+
+
+class CacheEntry():
+    __slots__ = ("path", "size", "mtime_ns", "data", "modified", "version")
+
+    def __init__(self, path, size, mtime_ns, data=None):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.data = data
+        self.modified = None  # datetime for Last-Modified, filled in by the handler
+        self.version = None   # hash for ETag, filled in on first use
+
+
+class StaticCache():
+    """
+    LRU of static file entries keyed by absolute path.
+
+    Disabled until enable() is called by whatever keeps it up to date, see
+    peonserver.watch. While disabled load() still works but stores nothing.
+    """
+
+    def __init__(self, max_size=MAX_CACHE_SIZE, max_entry_size=MAX_ENTRY_SIZE, max_entries=MAX_ENTRIES):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+
+    def enable(self, watcher):
+        """Start caching, watcher must notify about every change under the served paths"""
+        watcher.subscribe(self.invalidate)
+        self.enabled = True
+
+    def lookup(self, path):
+        entry = self.entries.get(path)
+        if entry is not None:
+            self.entries.move_to_end(path)
+            self.hits += 1
+        return entry
+
+    def load(self, path):
+        """Stat (and read if small) path into a new entry, raises OSError if it is gone"""
+        self.misses += 1
+        st = os.stat(path)
+        data = None
+        if self.enabled and st.st_size <= self.max_entry_size:
+            with open(path, 'rb') as f:
+                data = f.read()
+        entry = CacheEntry(path, len(data) if data is not None else st.st_size, st.st_mtime_ns, data)
+        if self.enabled:
+            self.store(entry)
+        return entry
+
+    def store(self, entry):
+        self.discard(entry.path)
+        self.entries[entry.path] = entry
+        if entry.data is not None:
+            self.size += len(entry.data)
+        while self.entries and (self.size > self.max_size or len(self.entries) > self.max_entries):
+            path, old = self.entries.popitem(last=False)
+            if old.data is not None:
+                self.size -= len(old.data)
+
+    def discard(self, path):
+        old = self.entries.pop(path, None)
+        if old is not None and old.data is not None:
+            self.size -= len(old.data)
+
+    def invalidate(self, path):
+        """Forget path, everything below it when it is a directory, or everything on OVERFLOW"""
+        if path is OVERFLOW:
+            self.clear()
+            return
+        self.discard(path)
+        prefix = path.rstrip(os.sep) + os.sep
+        for child in [p for p in self.entries if p.startswith(prefix)]:
+            self.discard(child)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+CACHE = StaticCache()  # shared by every StaticHandler in the process
+
+
+def accepted_encodings(header):
+    """Map of content-coding -> q value from an Accept-Encoding header"""
+    accepted = {}
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+class StaticHandler(tornado.web.StaticFileHandler):
+    """
+    StaticFileHandler that knows about the static build manifest, which is
+    looked up in the `static_manifest` application setting.
+
+    Use it as the `static_handler_class` setting so that `static_url()` in
+    templates links to fingerprinted names.
+    """
+
+    def initialize(self, path, default_filename=None):
+        super().initialize(path, default_filename)
+        self.manifest = self.settings.get("static_manifest")
+        self.url_rel = None
+        self.logical = None
+        self.encoding = None
+        self.entry = None
+        self.mapped = None  # memoryview written by the next flush()
+
+    def parse_url_path(self, url_path):
+        self.url_rel = url_path
+        if self.manifest is not None:
+            self.logical = self.manifest.logical_path(url_path)
+            if self.logical is not None:
+                self.root = self.manifest.build_path
+        return super().parse_url_path(url_path)
+
+    def validate_absolute_path(self, root, absolute_path):
+        root = os.path.abspath(root)
+        entry = None
+        if (absolute_path + os.sep).startswith(root.rstrip(os.sep) + os.sep):
+            entry = CACHE.lookup(absolute_path)
+        if entry is None:
+            absolute_path = super().validate_absolute_path(root, absolute_path)
+            if absolute_path is None:
+                return None
+            entry = CACHE.load(absolute_path)
+        self.entry = entry
+
+        if self.manifest is None:
+            return absolute_path
+        encodings = self.manifest.encodings(self.url_rel)
+        if not encodings or "Range" in self.request.headers:
+            return absolute_path
+
+        if self.logical is None:
+            # The source may have changed since the last build, never serve a stale variant
+            built = self.manifest.files[self.url_rel]
+            if entry.mtime_ns != built["mtime_ns"] or entry.size != built["size"]:
+                return absolute_path
+
+        accepted = accepted_encodings(self.request.headers.get("Accept-Encoding", ""))
+        for encoding in ENCODINGS:
+            if encoding in encodings and accepted.get(encoding, accepted.get("*", 0)) > 0:
+                variant = self.manifest.variant_path(self.url_rel, encoding)
+                variant_entry = CACHE.lookup(variant)
+                if variant_entry is None and os.path.isfile(variant):
+                    variant_entry = CACHE.load(variant)
+                if variant_entry is not None:
+                    self.encoding = encoding
+                    self.entry = variant_entry
+                    return variant
+        return absolute_path
+
+    def get_modified_time(self):
+        if self.entry is None:
+            return super().get_modified_time()
+        if self.entry.modified is None:
+            self.entry.modified = super().get_modified_time()
+        return self.entry.modified
+
+    def get_content_size(self):
+        if self.entry is None:
+            return super().get_content_size()
+        return self.entry.size
+
+    def compute_etag(self):
+        if self.entry is None or not CACHE.enabled:
+            return super().compute_etag()
+        if self.entry.version is None:
+            self.entry.version = self.get_content_version(self.absolute_path)
+        return f'"{self.entry.version}"'
+
+    def get_content(self, abspath, start=None, end=None):
+        """
+        Instance method unlike StaticFileHandler.get_content, it answers from
+        the cached entry of this request. get_content_version is overridden
+        accordingly.
+        """
+        entry = self.entry
+        if entry is not None and entry.path == abspath and entry.data is not None:
+            return entry.data[start:end]
+        if entry is not None and entry.path == abspath and entry.size > CACHE.max_entry_size:
+            return self.map_content(abspath, start, end)
+        return super().get_content(abspath, start, end)
+
+    @staticmethod
+    def map_content(abspath, start=None, end=None):
+        """Slices of abspath mapped read only, from start up to end"""
+        with open(abspath, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            # Stays mapped while the connection still holds one of its views
+            view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        end = size if end is None else min(end, size)
+        for offset in range(start or 0, end, MAP_CHUNK_SIZE):
+            yield view[offset:min(offset + MAP_CHUNK_SIZE, end)]
+
+    def write(self, chunk):
+        if isinstance(chunk, memoryview):
+            # RequestHandler.write only takes bytes, the view is passed on by flush()
+            self.mapped = chunk
+            return
+        super().write(chunk)
+
+    def flush(self, include_footers=False):
+        if self.mapped is None:
+            return super().flush(include_footers)
+        view, self.mapped = self.mapped, None
+        return self.flush_mapped(view, super().flush(include_footers))
+
+    async def flush_mapped(self, view, flushed):
+        # Headers and anything written before go first
+        await flushed
+        await self.request.connection.write(view)
+
+    @classmethod
+    def get_content_version(cls, abspath):
+        entry = CACHE.lookup(abspath)
+        hasher = hashlib.sha512()
+        if entry is not None and entry.data is not None:
+            hasher.update(entry.data)
+        else:
+            with open(abspath, 'rb') as f:
+                for chunk in iter(lambda: f.read(64 * 1024), b""):
+                    hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def get_content_type(self):
+        if self.encoding is None:
+            return super().get_content_type()
+        mime_type, _ = mimetypes.guess_type(self.url_rel)
+        return mime_type or "application/octet-stream"
+
+    def set_extra_headers(self, path):
+        if self.manifest is not None and self.manifest.encodings(self.url_rel):
+            self.set_header("Vary", "Accept-Encoding")
+        if self.encoding is not None:
+            self.set_header("Content-Encoding", self.encoding)
+        if self.logical is not None:
+            self.set_header("Cache-Control", f"public, max-age={self.CACHE_MAX_AGE}, immutable")
+
+    @classmethod
+    def make_static_url(cls, settings, path, include_version=True):
+        manifest = settings.get("static_manifest")
+        if include_version and manifest is not None:
+            fingerprinted = manifest.url_path(path)
+            if fingerprinted is not None:
+                return settings.get("static_url_prefix", "/static/") + fingerprinted
+        return super().make_static_url(settings, path, include_version)
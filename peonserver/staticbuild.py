@@ -0,0 +1,194 @@
+"""
+Build stage for static assets.
+
+Every file under the static path gets a content-hash fingerprinted copy
+(``css/site.css`` -> ``css/site.0123456789ab.css``) and compressible files get
+``.gz`` and, when the optional ``brotli`` package is installed, ``.br``
+variants of both names. Everything is written to a build directory outside of
+the static path and described by a manifest, which ``peonserver.static``
+uses to serve the right variant without compressing anything per request.
+
+Only files whose size or mtime changed since the last build are processed.
+"""
+import os
+import json
+import gzip
+import hashlib
+
+import peonserver.log as plog
+from peonserver.sassbuild import cache_path
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BUILD_NAME = "static"
+MANIFEST_NAME = "static-manifest.json"
+MANIFEST_VERSION = 1
+FINGERPRINT_LENGTH = 12
+MIN_COMPRESS_SIZE = 256
+COMPRESSIBLE_EXTENSIONS = {
+    ".css", ".js", ".mjs", ".map", ".html", ".htm", ".svg", ".json", ".xml", ".txt", ".ico",
+    ".ttf", ".otf", ".eot", ".wasm",
+}
+SKIP_EXTENSIONS = (".scss", ".sass", ".tmp")  # build inputs, not assets
+ENCODINGS = {"br": ".br", "gzip": ".gz"}  # preferred first
+
+
+def fingerprint_name(rel, digest):
+    root, ext = os.path.splitext(rel)
+    return f"{root}.{digest[:FINGERPRINT_LENGTH]}{ext}"
+
+def is_compressible(path, size):
+    return size >= MIN_COMPRESS_SIZE and os.path.splitext(path)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+def compress(data, encoding):
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(data, quality=11)
+    return None
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class Manifest():
+    """
+    Maps static paths (relative to the static path, `/` separated) to their
+    fingerprinted name and the precompressed encodings built for them.
+    """
+
+    def __init__(self, static_path, build_path=None, files=None):
+        self.static_path = static_path
+        self.build_path = build_path or cache_path(static_path, BUILD_NAME)
+        self.files = files or {}
+        self.fingerprints = {entry["fingerprint"]: rel for rel, entry in self.files.items()}
+
+    def __contains__(self, rel):
+        return rel in self.files
+
+    def url_path(self, rel):
+        """The fingerprinted path to link to for rel, or None if rel was not built"""
+        entry = self.files.get(rel)
+        return entry["fingerprint"] if entry else None
+
+    def logical_path(self, rel):
+        """The original path of a fingerprinted path, or None if rel is not fingerprinted"""
+        return self.fingerprints.get(rel)
+
+    def encodings(self, rel):
+        """Precompressed encodings available for rel or its fingerprinted name"""
+        entry = self.files.get(self.fingerprints.get(rel, rel))
+        return entry["encodings"] if entry else []
+
+    def variant_path(self, rel, encoding=None):
+        """Build directory path of rel, or of its precompressed variant"""
+        path = os.path.join(self.build_path, *rel.split("/"))
+        return path + ENCODINGS[encoding] if encoding else path
+
+    @classmethod
+    def load(cls, static_path, manifestfile=None):
+        manifestfile = manifestfile or cache_path(static_path, MANIFEST_NAME)
+        try:
+            with open(manifestfile, 'r') as mf:
+                data = json.load(mf)
+        except (IOError, ValueError):
+            return cls(static_path)
+        if data.get("version") != MANIFEST_VERSION:
+            return cls(static_path)
+        return cls(static_path, data.get("build_path"), data.get("files"))
+
+    def save(self, manifestfile=None):
+        manifestfile = manifestfile or cache_path(self.static_path, MANIFEST_NAME)
+        data = {"version": MANIFEST_VERSION, "build_path": self.build_path, "files": self.files}
+        write_file(manifestfile, json.dumps(data, indent=1, sort_keys=True).encode("utf-8"))
+
+
+def list_static_files(static_path, build_path):
+    """Relative `/` separated paths of all servable files, hidden files excluded"""
+    build_path = os.path.normpath(build_path)
+    for root, dirs, files in os.walk(static_path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".")
+                         and os.path.normpath(os.path.join(root, d)) != build_path)
+        for f in sorted(files):
+            if f.startswith(".") or f.endswith(SKIP_EXTENSIONS):
+                continue
+            yield os.path.relpath(os.path.join(root, f), static_path).replace(os.sep, "/")
+
+def build(static_path, **kwargs):
+    """
+    Fingerprint and precompress the files of static_path, returns the Manifest.
+
+    :Parameters:
+        - build_path: output directory, see cache_path() if unset
+        - manifestfile: where the manifest is saved, see cache_path() if unset
+        - encodings: precompressed encodings to build, all of ENCODINGS if unset
+    """
+    manifestfile = kwargs.get("manifestfile")
+    previous = Manifest.load(static_path, manifestfile)
+    build_path = kwargs.get("build_path") or previous.build_path
+    encodings = [e for e in kwargs.get("encodings", ENCODINGS) if e != "br" or brotli is not None]
+    manifest = Manifest(static_path, build_path)
+    built = 0
+
+    for rel in list_static_files(static_path, build_path):
+        source = os.path.join(static_path, *rel.split("/"))
+        st = os.stat(source)
+        old = previous.files.get(rel)
+        if old and old["mtime_ns"] == st.st_mtime_ns and old["size"] == st.st_size \
+                and set(old["encodings"]) <= set(encodings) \
+                and os.path.exists(manifest.variant_path(old["fingerprint"])):
+            manifest.files[rel] = old
+            manifest.fingerprints[old["fingerprint"]] = rel
+            continue
+
+        with open(source, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        fingerprint = fingerprint_name(rel, digest)
+        entry = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "hash": digest,
+                 "fingerprint": fingerprint, "encodings": []}
+        write_file(manifest.variant_path(fingerprint), data)
+        if is_compressible(rel, len(data)):
+            for encoding in encodings:
+                compressed = compress(data, encoding)
+                # Not worth serving if it barely shrinks
+                if compressed is None or len(compressed) >= len(data) * 0.95:
+                    continue
+                write_file(manifest.variant_path(rel, encoding), compressed)
+                write_file(manifest.variant_path(fingerprint, encoding), compressed)
+                entry["encodings"].append(encoding)
+        manifest.files[rel] = entry
+        manifest.fingerprints[fingerprint] = rel
+        built += 1
+
+    removed = prune(manifest)
+    manifest.save(manifestfile)
+    plog.LOG.info(f"Static build: {built} file(s) built, {len(manifest.files) - built} unchanged, {removed} removed")
+    return manifest
+
+def prune(manifest):
+    """Delete build outputs that the manifest no longer refers to"""
+    keep = set()
+    for rel, entry in manifest.files.items():
+        for name in (rel, entry["fingerprint"]):
+            keep.add(manifest.variant_path(name))
+            keep.update(manifest.variant_path(name, e) for e in entry["encodings"])
+
+    removed = 0
+    for root, dirs, files in os.walk(manifest.build_path):
+        for f in files:
+            path = os.path.join(root, f)
+            if path not in keep:
+                os.remove(path)
+                removed += 1
+    return removed
+
+def load_manifest(static_path):
+    return Manifest.load(static_path)
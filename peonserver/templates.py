@@ -0,0 +1,231 @@
+"""
+Template loading, warming and rendered page caching.
+
+make_app creates one tornado template Loader per application (the
+`template_loader` setting) and compiles every template up front, so the
+first request to a page does not pay for it. Handlers that render the same
+output for the same arguments can use CachedPageMixin.render_cached() to keep
+the rendered page in a PageCache and answer conditional requests with 304
+without rendering at all. When a template changes only it and the templates
+including or extending it are recompiled, and the page cache is cleared
+whenever templates or static files change.
+"""
+import os
+import hashlib
+import collections
+
+import tornado.ioloop
+import tornado.template
+
+import peonserver.log as plog
+from peonserver.watch import OVERFLOW
+
+TEMPLATE_EXTENSIONS = (".html", ".htm", ".xml", ".txt")
+MAX_PAGES = 512
+REWARM_DELAY = 0.1  # seconds, editors write files in several steps
+
+
+class Loader(tornado.template.Loader):
+    """
+    tornado's Loader, also remembering the templates each template includes
+    or extends. Compiling a template loads those through load() with the
+    template's name as parent_path.
+    """
+
+    def __init__(self, root_directory, **kwargs):
+        super().__init__(root_directory, **kwargs)
+        self.dependencies = {}  # name -> names of the templates it includes or extends
+
+    def reset(self):
+        with self.lock:
+            super().reset()
+            self.dependencies.clear()
+
+    def load(self, name, parent_path=None):
+        template = super().load(name, parent_path)
+        if parent_path is not None:
+            self.dependencies.setdefault(parent_path, set()).add(template.name)
+        return template
+
+
+def make_loader(template_path, settings=None):
+    """Same loader tornado would create for template_path from the app settings"""
+    settings = settings or {}
+    kwargs = {}
+    if "autoescape" in settings:
+        kwargs["autoescape"] = settings["autoescape"]
+    if "template_whitespace" in settings:
+        kwargs["whitespace"] = settings["template_whitespace"]
+    return Loader(template_path, **kwargs)
+
+def find_templates(template_path):
+    names = []
+    for root, dirs, files in os.walk(template_path):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for f in files:
+            if f.endswith(TEMPLATE_EXTENSIONS) and not f.startswith("."):
+                names.append(os.path.relpath(os.path.join(root, f), template_path))
+    return sorted(names)
+
+def warm(loader, extra=None):
+    """Compile every template under the loader's root and the extra (absolute) template paths"""
+    names = find_templates(loader.root) + [p for p in extra or [] if os.path.isfile(p)]
+    compiled = 0
+    for name in names:
+        try:
+            loader.load(name)
+            compiled += 1
+        except Exception as E:
+            plog.LOG.error(f"Failed to compile template {name}: {E}")
+    plog.LOG.info(f"Compiled {compiled} of {len(names)} template(s)")
+    return compiled
+
+def recompile(loader, names):
+    """Replace the named templates, and every loaded template that includes or extends them, in the loader"""
+    stale = set(names)
+    with loader.lock:
+        found = True
+        while found:
+            found = False
+            for name in list(loader.templates):
+                if name not in stale and not stale.isdisjoint(loader.dependencies.get(name, ())):
+                    stale.add(name)
+                    found = True
+        for name in stale:
+            loader.templates.pop(name, None)
+            loader.dependencies.pop(name, None)
+
+    compiled = 0
+    for name in sorted(stale):
+        if not os.path.isfile(os.path.join(loader.root, name)):
+            continue  # deleted, templates still using it fail to compile below
+        try:
+            loader.load(name)
+            compiled += 1
+        except Exception as E:
+            plog.LOG.error(f"Failed to compile template {name}: {E}")
+    plog.LOG.info(f"Recompiled {compiled} of {len(stale)} changed template(s)")
+    return compiled
+
+
+class CachedPage():
+    __slots__ = ("body", "etag")
+
+    def __init__(self, body):
+        self.body = body
+        self.etag = f'"{hashlib.sha1(body).hexdigest()}"'
+
+
+class PageCache():
+    """LRU of rendered pages keyed by template and render arguments"""
+
+    def __init__(self, max_pages=MAX_PAGES):
+        self.max_pages = max_pages
+        self.pages = collections.OrderedDict()
+
+    @staticmethod
+    def key(template_path, template_name, kwargs):
+        """
+        Arguments are compared by value when hashable and by identity otherwise,
+        so mutating an unhashable argument in place is not noticed.
+        """
+        items = []
+        for k in sorted(kwargs):
+            v = kwargs[k]
+            try:
+                hash(v)
+            except TypeError:
+                v = ("id", id(v))
+            items.append((k, v))
+        return (template_path, template_name, tuple(items))
+
+    def get(self, key):
+        page = self.pages.get(key)
+        if page is not None:
+            self.pages.move_to_end(key)
+        return page
+
+    def put(self, key, body):
+        page = CachedPage(body)
+        self.pages[key] = page
+        self.pages.move_to_end(key)
+        while len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+        return page
+
+    def clear(self):
+        self.pages.clear()
+
+
+class TemplateReloader():
+    """
+    Watcher subscriber that recompiles changed templates and clears the page
+    cache when anything under the watched roots changes.
+    """
+
+    def __init__(self, loader, page_cache=None, roots=None, extra=None):
+        self.loader = loader
+        self.page_cache = page_cache
+        self.roots = [os.path.abspath(r).rstrip(os.sep) + os.sep for r in roots or [loader.root]]
+        self.extra = extra or []
+        self.changed = set()
+        self.pending = False
+
+    def __call__(self, path):
+        if path is not OVERFLOW and not any((path + os.sep).startswith(r) for r in self.roots):
+            return
+        if self.page_cache is not None:
+            self.page_cache.clear()
+        self.changed.add(path)
+        if not self.pending:
+            self.pending = True
+            tornado.ioloop.IOLoop.current().call_later(REWARM_DELAY, self.rewarm)
+
+    def template_name(self, path):
+        """Loader name of a changed template file, None if it is not a template"""
+        if path in self.extra:
+            return path
+        root = os.path.abspath(self.loader.root).rstrip(os.sep) + os.sep
+        if path.startswith(root) and path.endswith(TEMPLATE_EXTENSIONS):
+            return os.path.relpath(path, root)
+        return None
+
+    def rewarm(self):
+        self.pending = False
+        changed, self.changed = self.changed, set()
+        if any(path is OVERFLOW or os.path.isdir(path) for path in changed):
+            # Lost events or a whole directory moved, start over
+            self.loader.reset()
+            warm(self.loader, self.extra)
+            return
+        names = [name for name in map(self.template_name, changed) if name is not None]
+        if names:
+            recompile(self.loader, names)
+
+
+class CachedPageMixin():
+    """
+    Adds render_cached() to a RequestHandler. Only use it for pages that depend
+    on nothing but the template and its arguments, the page is shared by every
+    client (no current_user, xsrf_form_html(), locale, ...).
+    """
+
+    def render_cached(self, template_name, cache_key=None, **kwargs):
+        """
+        render() through the `page_cache` application setting when it is set.
+        The page is cached by the values of cache_key, kwargs when not given.
+        """
+        pages = self.settings.get("page_cache")
+        if pages is None:
+            return self.render(template_name, **kwargs)
+
+        key = pages.key(self.get_template_path(), template_name, kwargs if cache_key is None else cache_key)
+        page = pages.get(key)
+        if page is None:
+            page = pages.put(key, self.render_string(template_name, **kwargs))
+
+        self.set_header("Etag", page.etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return self.finish()
+        return self.finish(page.body)
@@ -0,0 +1,314 @@
+"""
+Streaming request bodies for large uploads.
+
+tornado normally buffers a whole request body in memory before the handler
+runs. Route handlers deriving from StreamingHandler get the body while it
+arrives instead: multipart/form-data is parsed incrementally and every other
+body is one raw part. By default file parts are written to temporary files
+and small form fields are kept as request arguments, so get_argument() and
+@Validator work as usual:
+
+    class Upload(StreamingHandler):
+        max_body_size = 4 * 1024 ** 3  # the server's --max-body-size if unset
+
+        async def post(self):
+            for part in self.files.get("video", []):
+                part.move(os.path.join(VIDEO_PATH, part.safe_filename))
+
+Overriding open_part(), receive() and close_part() hands the parts to a
+consumer coroutine instead. The next chunk is only read once receive()
+returns, so a slow consumer slows the client down rather than piling the
+body up in memory. Peak memory per request stays around one chunk (64KB)
+whatever the size of the upload.
+
+Temporary files still in place when the request finishes are deleted.
+"""
+import os
+import asyncio
+import inspect
+import tempfile
+import functools
+import email.utils
+import email.message
+
+import tornado.web
+import tornado.httputil
+
+import peonserver.log as plog
+
+MAX_FIELD_SIZE = 64 * 1024  # form fields without a filename are kept in memory up to this
+MAX_HEADER_SIZE = 16 * 1024  # headers of a single part
+
+START = "start"
+DATA = "data"
+END = "end"
+
+PREAMBLE = 0
+BOUNDARY = 1
+HEADERS = 2
+BODY = 3
+DONE = 4
+
+BODY_METHODS = ("post", "put", "patch", "delete")
+
+
+class MultipartError(tornado.httputil.HTTPInputError):
+    """Malformed multipart body, answered with 400"""
+
+
+def parse_header(value):
+    """(value, {parameter: value}) of a header like Content-Type or Content-Disposition"""
+    message = email.message.Message()
+    message["Content-Type"] = value
+    params = message.get_params(failobj=[("", "")])
+    return params[0][0].strip().lower(), \
+        {name.lower(): email.utils.collapse_rfc2231_value(param) for name, param in params[1:]}
+
+
+class Part():
+    """One part of a multipart body, or the whole of a raw body"""
+
+    def __init__(self, headers):
+        self.headers = headers
+        disposition, params = parse_header(headers.get("Content-Disposition", ""))
+        self.name = params.get("name")
+        self.filename = params.get("filename")
+        self.content_type = headers.get("Content-Type", "application/unknown")
+        self.size = 0
+        self.path = None  # temporary file holding the part, see StreamingHandler.receive
+        self.file = None
+        self.value = None  # bytearray of a form field
+
+    @property
+    def safe_filename(self):
+        """filename without any directory the client put in it"""
+        return os.path.basename((self.filename or "").replace("\\", "/")) or None
+
+    def move(self, destination):
+        """Keep the uploaded file at destination instead of deleting it"""
+        os.replace(self.path, destination)
+        self.path = None
+        return destination
+
+
+class MultipartParser():
+    """
+    Incremental multipart/form-data parser.
+
+    feed() takes the body in chunks of any size and returns the events they
+    complete: (START, part), (DATA, bytes) for the part started last and
+    (END, part). Only a partial delimiter or part header is kept between calls.
+    """
+
+    def __init__(self, boundary, max_header_size=MAX_HEADER_SIZE):
+        if isinstance(boundary, str):
+            boundary = boundary.encode("latin1")
+        self.delimiter = b"\r\n--" + boundary
+        # The first delimiter may start the body, without the CRLF before it
+        self.buffer = bytearray(b"\r\n")
+        self.max_header_size = max_header_size
+        self.state = PREAMBLE
+        self.part = None
+
+    def feed(self, data):
+        self.buffer += data
+        events = []
+        while True:
+            if self.state in (PREAMBLE, BODY):
+                index = self.buffer.find(self.delimiter)
+                if index < 0:
+                    # Keep what could be the start of a delimiter
+                    keep = len(self.delimiter) - 1
+                    if len(self.buffer) > keep:
+                        if self.state == BODY:
+                            events.append((DATA, bytes(self.buffer[:-keep])))
+                        del self.buffer[:-keep]
+                    return events
+                if self.state == BODY:
+                    if index:
+                        events.append((DATA, bytes(self.buffer[:index])))
+                    events.append((END, self.part))
+                    self.part = None
+                del self.buffer[:index + len(self.delimiter)]
+                self.state = BOUNDARY
+            elif self.state == BOUNDARY:
+                if len(self.buffer) < 2:
+                    return events
+                if self.buffer[:2] == b"--":
+                    # Closing delimiter, the epilogue is ignored
+                    self.state = DONE
+                    continue
+                index = self.buffer.find(b"\r\n")
+                if index < 0:
+                    self.check_header_size()
+                    return events
+                del self.buffer[:index + 2]
+                self.state = HEADERS
+            elif self.state == HEADERS:
+                if self.buffer[:2] == b"\r\n":
+                    index, end = 0, 2
+                else:
+                    index = self.buffer.find(b"\r\n\r\n")
+                    end = index + 4
+                if index < 0:
+                    self.check_header_size()
+                    return events
+                try:
+                    headers = tornado.httputil.HTTPHeaders.parse(self.buffer[:index].decode("utf-8"))
+                except (UnicodeDecodeError, tornado.httputil.HTTPInputError) as E:
+                    raise MultipartError(f"Invalid part headers: {E}")
+                del self.buffer[:end]
+                self.part = Part(headers)
+                events.append((START, self.part))
+                self.state = BODY
+            else:
+                self.buffer.clear()
+                return events
+
+    def check_header_size(self):
+        if len(self.buffer) > self.max_header_size:
+            raise MultipartError("Part headers too long")
+
+    def close(self):
+        if self.state != DONE:
+            raise MultipartError("Multipart body ended before its closing delimiter")
+
+
+def complete_body(method):
+    """Run StreamingHandler.body_complete() before a handler method"""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        await self.body_complete()
+        result = method(self, *args, **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+    wrapper.completes_body = True
+    return wrapper
+
+
+@tornado.web.stream_request_body
+class StreamingHandler(tornado.web.RequestHandler):
+    """
+    Base handler receiving the request body as it arrives, see the module
+    docstring. Subclasses can set max_body_size for their route, the
+    server's limit by default, and upload_path for the temporary files, the
+    system temporary directory by default.
+
+    After the body is received `files` maps part names to their file Parts,
+    and for raw bodies `body_part` is the single Part, None for an empty body.
+    """
+
+    max_body_size = None
+    max_field_size = MAX_FIELD_SIZE
+    upload_path = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in BODY_METHODS:
+            method = cls.__dict__.get(name)
+            if method is not None and not getattr(method, "completes_body", False):
+                setattr(cls, name, complete_body(method))
+
+    async def prepare(self):
+        self.files = {}
+        self.body_part = None
+        self.parser = None
+        self.received = []  # parts with temporary files to clean up
+        limit = self.max_body_size or self.settings.get("max_body_size")
+        length = self.request.headers.get("Content-Length")
+        if limit is not None and length is not None and int(length) > limit:
+            raise tornado.web.HTTPError(413, f"Request body is larger than {limit} bytes")
+        if self.max_body_size is not None:
+            # Applies to chunked bodies too, which tornado stops reading past the limit
+            self.request.connection.set_max_body_size(self.max_body_size)
+
+        content_type, params = parse_header(self.request.headers.get("Content-Type", ""))
+        if content_type == "multipart/form-data":
+            boundary = params.get("boundary")
+            if not boundary:
+                raise tornado.web.HTTPError(400, "Multipart body without a boundary")
+            self.parser = MultipartParser(boundary)
+
+    async def data_received(self, chunk):
+        if self.parser is None:
+            if self.body_part is None:
+                headers = tornado.httputil.HTTPHeaders()
+                if "Content-Type" in self.request.headers:
+                    headers["Content-Type"] = self.request.headers["Content-Type"]
+                self.body_part = Part(headers)
+                await self.open_part(self.body_part)
+            return await self.receive(self.body_part, chunk)
+        part = self.parser.part
+        for event, value in self.parser.feed(chunk):
+            if event is START:
+                part = value
+                await self.open_part(part)
+            elif event is DATA:
+                await self.receive(part, value)
+            else:
+                await self.close_part(value)
+
+    async def body_complete(self):
+        """Finish the last part once the whole body was received, before the handler method runs"""
+        if self.parser is not None:
+            try:
+                self.parser.close()
+            except MultipartError as E:
+                raise tornado.web.HTTPError(400, str(E))
+        elif self.body_part is not None:
+            await self.close_part(self.body_part)
+
+    def on_finish(self):
+        self.remove_files()
+
+    def on_connection_close(self):
+        super().on_connection_close()
+        self.remove_files()
+
+    async def open_part(self, part):
+        """Called for every part before its data, a temporary file for file parts and raw bodies"""
+        if part.filename is not None or part is self.body_part:
+            loop = asyncio.get_running_loop()
+            fd, part.path = await loop.run_in_executor(
+                None, lambda: tempfile.mkstemp(prefix="upload-", dir=self.upload_path))
+            part.file = os.fdopen(fd, "wb")
+            self.received.append(part)
+        else:
+            part.value = bytearray()
+
+    async def receive(self, part, chunk):
+        """Called with every chunk of a part's data, the next chunk is read once it returns"""
+        part.size += len(chunk)
+        if part.file is not None:
+            await asyncio.get_running_loop().run_in_executor(None, part.file.write, chunk)
+        else:
+            if part.size > self.max_field_size:
+                raise MultipartError(f"Form field {part.name} is larger than {self.max_field_size} bytes")
+            part.value += chunk
+
+    async def close_part(self, part):
+        """Called once a part is complete"""
+        if part.file is not None:
+            await asyncio.get_running_loop().run_in_executor(None, part.file.close)
+            part.file = None
+            if part.name is not None:
+                self.files.setdefault(part.name, []).append(part)
+        elif part.name is not None:
+            # Form fields become request arguments, as if the body had been buffered
+            value = bytes(part.value)
+            self.request.body_arguments.setdefault(part.name, []).append(value)
+            self.request.arguments.setdefault(part.name, []).append(value)
+
+    def remove_files(self):
+        received, self.received = getattr(self, "received", []), []
+        for part in received:
+            try:
+                if part.file is not None:
+                    part.file.close()
+                    part.file = None
+                if part.path is not None:
+                    os.unlink(part.path)
+                    part.path = None
+            except OSError as E:
+                plog.LOG.warning(f"Failed to remove upload {part.path}: {E}")
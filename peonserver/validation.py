@@ -0,0 +1,188 @@
+"""
+Request validation compiled from FormEncode schemas.
+
+compile_schema() looks at a schema once and keeps what the hot path needs:
+the field validators, which of them take every value of a repeated argument,
+whether undeclared arguments are kept at all, and the schema's missing value
+handling. Checking a request then runs each field validator directly instead
+of going through Schema.to_python's generic dictionary handling, with the
+same results and error messages. Schemas with pre_validators,
+chained_validators, if_empty or if_invalid, or overriding Schema's
+conversion, are still run through to_python, so any FormEncode schema stays
+a valid input.
+
+CompiledSchema.read() takes arguments straight from the request: a JSON object
+body is used as decoded, otherwise tornado's already parsed query and form
+arguments are decoded once, and only for the fields that will be kept.
+Repeated arguments reach multi-valued validators such as ForEach as a list,
+every other field gets the first value.
+"""
+import json
+import inspect
+
+from formencode import validators, api, Invalid, Schema
+from formencode.schema import format_compound_error
+
+JSON_TYPES = ("application/json",)
+
+_COMPILED = {}  # schema -> CompiledSchema
+
+
+def is_multi_valued(validator):
+    """Validators such as ForEach take every value of a repeated argument"""
+    return bool(getattr(validator, "accept_iterator", False)) and not isinstance(validator, Schema)
+
+def is_iterator(value):
+    # Same notion of a repeated value as Schema._value_is_iterator
+    if isinstance(value, (bytes, str)):
+        return False
+    if isinstance(value, (list, tuple)):
+        return True
+    try:
+        iter(value)
+        return True
+    except TypeError:
+        return False
+
+def overrides_conversion(schema):
+    """True when a Schema subclass replaces a step of the conversion compiled here"""
+    # Looked up without the descriptors, every plain attribute read makes a new bound method
+    cls = type(schema)
+    return any(inspect.getattr_static(cls, name) is not inspect.getattr_static(Schema, name)
+               for name in ("to_python", "_convert_to_python", "_validate_other", "_validate_python"))
+
+def bad_type(validator, value):
+    """Invalid for a value of a type the validator cannot handle, like a number from a JSON body"""
+    message = validator.message('badType', None, type=type(value).__name__, value=value)
+    return Invalid(message, value, None)
+
+
+class CompiledSchema():
+    """
+    A FormEncode schema reduced to what checking a request needs.
+
+    Usage: CompiledSchema(EmailValidator).check(handler) returns the converted
+    values or raises formencode.Invalid, exactly like EmailValidator.to_python.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema() if isinstance(schema, type) else schema
+        s = self.schema
+        self.fields = dict(s.fields)
+        self.multi = frozenset(name for name, v in self.fields.items() if is_multi_valued(v))
+        self.allow_extra = s.allow_extra_fields
+        self.keep_extra = s.allow_extra_fields and not s.filter_extra_fields
+        self.generic = bool(s.pre_validators or s.chained_validators or s.if_empty is not api.NoDefault
+                            or s.if_invalid is not api.NoDefault or overrides_conversion(s))
+        self.iterators = frozenset(name for name, v in self.fields.items() if getattr(v, "accept_iterator", False))
+        self.missing = {}  # name -> (action, value) for a field not in the input
+        for name, validator in self.fields.items():
+            if validator.if_missing is not api.NoDefault:
+                self.missing[name] = ("value", validator.if_missing)
+            elif s.ignore_key_missing:
+                self.missing[name] = ("skip", None)
+            elif s.if_key_missing is api.NoDefault:
+                try:
+                    message = validator.message('missing', None)
+                except KeyError:
+                    message = s.message('missingValue', None)
+                self.missing[name] = ("error", message)
+            else:
+                self.missing[name] = ("convert", s.if_key_missing)
+
+    def read(self, request):
+        """Arguments of request as a dictionary of values to validate"""
+        content_type = request.headers.get("Content-Type", "").split(";", 1)[0].strip().lower()
+        if content_type in JSON_TYPES and request.body:
+            try:
+                data = json.loads(request.body)
+            except ValueError as E:
+                raise Invalid(f"Invalid JSON body: {E}", request.body, None)
+            if not isinstance(data, dict):
+                raise Invalid("The input must be a JSON object", data, None)
+            return data
+
+        arguments = request.arguments
+        if self.keep_extra or not self.allow_extra:
+            names = arguments.keys()
+        else:
+            names = [name for name in self.fields if name in arguments]
+        params = {}
+        for name in names:
+            values = arguments[name]
+            if name in self.multi:
+                params[name] = [v.decode("utf-8") for v in values]
+            else:
+                params[name] = values[0].decode("utf-8")
+        return params
+
+    def to_python(self, params):
+        """Convert and validate params, raising Invalid with FormEncode's messages"""
+        if self.generic:
+            try:
+                return self.schema.to_python(params)
+            except (TypeError, AttributeError):
+                raise bad_type(self.schema, params)
+
+        schema = self.schema
+        fields = self.fields
+        result = {}
+        errors = {}
+        seen = 0
+        for name, value in params.items():
+            validator = fields.get(name)
+            if validator is None:
+                if not self.allow_extra:
+                    # Not collected per field, FormEncode stops at the first unexpected one
+                    raise Invalid(schema.message('notExpected', None, name=repr(name)), params, None)
+                if self.keep_extra:
+                    result[name] = value
+                continue
+            seen += 1
+            if name not in self.iterators and is_iterator(value):
+                # Still converted, an error of the validator itself replaces this one
+                errors[name] = Invalid(schema.message('singleValueExpected', None), params, None)
+            try:
+                result[name] = validator.to_python(value, None)
+            except Invalid as E:
+                errors[name] = E
+            except (TypeError, AttributeError):
+                # Validators of strings fail on the numbers, lists and objects of a JSON body
+                errors[name] = bad_type(validator, value)
+
+        if seen < len(fields):
+            for name, (action, value) in self.missing.items():
+                if name in params:
+                    continue
+                if action == "value":
+                    result[name] = value
+                elif action == "error":
+                    errors[name] = Invalid(value, None, None)
+                elif action == "convert":
+                    try:
+                        result[name] = fields[name].to_python(value, None)
+                    except Invalid as E:
+                        errors[name] = E
+
+        if errors:
+            raise Invalid(format_compound_error(errors), params, None, error_dict=errors)
+        return result
+
+    def check(self, handler):
+        return self.to_python(self.read(handler.request))
+
+
+def compile_schema(schema):
+    """CompiledSchema for schema, compiled once per schema class or instance"""
+    if isinstance(schema, CompiledSchema):
+        return schema
+    compiled = _COMPILED.get(schema)
+    if compiled is None:
+        compiled = _COMPILED[schema] = CompiledSchema(schema)
+    return compiled
+
+
+class EmailValidator(Schema):
+    allow_extra_fields = True
+
+    email = validators.Email(not_empty=True, min=5, max=256, strip=True)
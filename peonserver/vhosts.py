@@ -0,0 +1,166 @@
+"""
+Name-based virtual hosting.
+
+One server process can serve several websites, picked by the Host header of
+each request, instead of running a daemon per website. The website given with
+--website (or the default one) answers every host not named below. Further
+sites are listed in its globals.py, or with --site on the command line:
+
+    SITES = {
+        "blog.example.com": "/srv/sites/blog",
+        "shop.example.com, *.shop.example.com": "/srv/sites/shop",
+    }
+
+Every site directory is a website as made by create-website, with its own
+globals.py, static files, templates and routes. Its static build runs at
+startup, but its application (templates and routes) is only made on the first
+request for one of its hosts, so rarely visited sites cost next to nothing
+until then. Sites share the process: the file watcher, the static file and
+page caches, sessions, the database pool, CPU jobs, metrics and admission
+control, which are configured by the default website. Sites with the same
+template directory share its compiled templates.
+
+Hosted sites are imported as packages of their own rather than as
+`website`, their route modules as `<package>.routes.<module>`, so two sites
+may have route modules of the same name. Code in a site that imports from
+its own package should use relative imports.
+"""
+import os
+import re
+import sys
+import time
+import importlib
+import importlib.util
+import importlib.machinery
+import traceback
+
+import tornado.web
+import tornado.routing
+
+import peonserver.log as plog
+
+SITE_PACKAGE = "peonserver_site"
+
+# Optional website globals.py names and the make_app keyword arguments they fill in
+WEBSITE_SETTINGS = {
+    "SITES": "sites",
+}
+
+
+def parse_site(value):
+    """(hosts, path) of a --site HOSTS=PATH option"""
+    hosts, sep, path = value.partition("=")
+    if not sep or not hosts.strip() or not path.strip():
+        raise ValueError(f"Invalid site {value!r}, expected HOST[,HOST...]=PATH")
+    return hosts, path
+
+def resolve(sites):
+    """[(host names, absolute path)] of SITES or a list of (hosts, path), hosts comma separated or a list"""
+    items = sites.items() if isinstance(sites, dict) else sites or []
+    resolved = []
+    for hosts, path in items:
+        if isinstance(hosts, str):
+            hosts = hosts.split(",")
+        hosts = tuple(h.strip().lower() for h in hosts if h.strip())
+        path = os.path.abspath(os.path.expanduser(path))
+        if not os.path.isdir(path):
+            plog.LOG.error(f"Site {', '.join(hosts)} at {path} does not exist, skipped")
+            continue
+        resolved.append((hosts, path))
+    return resolved
+
+def host_pattern(host):
+    """Regular expression matching host, where * stands for one or more labels"""
+    return r"\.".join(".+" if label == "*" else re.escape(label) for label in host.split("."))
+
+def package_name(path, taken):
+    """
+    Package name for the site at path from its directory name, unique among
+    taken. Forked workers get the same names as the supervisor importing them.
+    """
+    slug = re.sub(r"\W", "_", os.path.basename(path)).lower() or "site"
+    name = f"{SITE_PACKAGE}_{slug}"
+    n = 2
+    while name in taken:
+        name = f"{SITE_PACKAGE}_{slug}_{n}"
+        n += 1
+    taken.add(name)
+    return name
+
+def import_package(name, path):
+    """Import directory path as package name, also without an __init__.py"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    init = os.path.join(path, "__init__.py")
+    if os.path.isfile(init):
+        spec = importlib.util.spec_from_file_location(name, init, submodule_search_locations=[path])
+    else:
+        spec = importlib.machinery.ModuleSpec(name, None, is_package=True)
+        spec.submodule_search_locations = [path]
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        if spec.loader is not None:
+            spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
+
+def import_site(path, package):
+    """globals module of the website at path, imported as package"""
+    import_package(package, path)
+    return importlib.import_module(f"{package}.globals")
+
+
+class LazySite(tornado.routing.Router):
+    """Route target making a site's application on its first request"""
+
+    def __init__(self, name, factory, fallback):
+        self.name = name
+        self.factory = factory  # factory() -> tornado.web.Application
+        self.fallback = fallback  # answers with 500 while the site cannot be made
+        self.application = None
+
+    def load(self):
+        if self.application is None:
+            start = time.perf_counter()
+            self.application = self.factory()
+            plog.LOG.info(f"Started site {self.name} in {(time.perf_counter() - start) * 1000.0:.1f}ms")
+        return self.application
+
+    def find_handler(self, request, **kwargs):
+        try:
+            application = self.load()
+        except Exception as E:
+            # Try again on the next request, the site may be fixed by then
+            plog.LOG.error(f"Failed to start site {self.name}: {E}")
+            plog.LOG.error(traceback.format_exc())
+            return self.fallback.get_handler_delegate(request, tornado.web.ErrorHandler, {"status_code": 500})
+        return application.find_handler(request, **kwargs)
+
+
+class VirtualHosts(tornado.routing.RuleRouter):
+    """
+    Routes each request to the site its Host header names, and to the default
+    application for any other host. Serve it like an application.
+    """
+
+    def __init__(self, default, sites):
+        """sites is a list of (host names, LazySite)"""
+        self.default = default
+        self.sites = sites
+        rules = []
+        for hosts, site in sites:
+            for host in hosts:
+                rules.append(tornado.routing.Rule(tornado.routing.HostMatches(host_pattern(host)), site))
+        rules.append(tornado.routing.Rule(tornado.routing.AnyMatches(), default))
+        super().__init__(rules)
+        plog.LOG.info(f"Hosting {len(sites)} site(s) besides the default website: "
+                      f"{', '.join(site.name for hosts, site in sites)}")
+
+    @property
+    def settings(self):
+        """Settings of the default application, for what the whole server is configured by"""
+        return self.default.settings
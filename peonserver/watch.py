@@ -0,0 +1,233 @@
+"""
+File change notifications on the tornado event loop.
+
+On Linux the kernel's inotify interface is used through ctypes, so nothing is
+polled and no extra package is needed. Elsewhere, or when inotify cannot be
+initialised, the watched trees are scanned for mtime changes on an interval.
+
+Subscribers are called with the absolute path of every changed file, each
+path once per batch of events. Directories created under a watched tree are
+watched as well.
+"""
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+import tornado.ioloop
+
+import peonserver.log as plog
+
+POLL_INTERVAL = 1.0  # seconds, only used without inotify
+
+# <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+OVERFLOW = None  # passed to subscribers when events were lost and everything may have changed
+
+
+class Watcher():
+    """Base class, see InotifyWatcher and PollingWatcher"""
+
+    def __init__(self, paths=None):
+        self.paths = []
+        self.subscribers = []
+        for path in paths or []:
+            self.add(path)
+
+    def add(self, path):
+        path = os.path.abspath(path)
+        if path not in self.paths:
+            self.paths.append(path)
+        return path
+
+    def subscribe(self, callback):
+        """callback(path) for every changed path, or callback(OVERFLOW) when events were lost"""
+        self.subscribers.append(callback)
+
+    def notify(self, paths):
+        for path in paths:
+            for callback in list(self.subscribers):
+                try:
+                    callback(path)
+                except Exception as E:
+                    plog.LOG.error(f"File watch subscriber {callback} failed for {path}: {E}")
+
+    def start(self):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+
+class InotifyWatcher(Watcher):
+
+    def __init__(self, paths=None):
+        self.fd = None
+        self.wds = {}  # watch descriptor -> directory
+        libname = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(libname, use_errno=True)
+        super().__init__(paths)
+
+    def add(self, path):
+        path = super().add(path)
+        if self.fd is not None:
+            self.add_tree(path)
+        return path
+
+    def add_tree(self, path):
+        top = path if os.path.isdir(path) else os.path.dirname(path)
+        for root, dirs, files in os.walk(top):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            self.add_watch(root)
+
+    def add_watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            plog.LOG.warning(f"Cannot watch {directory}: {os.strerror(err)}")
+            return
+        self.wds[wd] = directory
+
+    def start(self):
+        fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.fd = fd
+        for path in self.paths:
+            if os.path.exists(path):
+                self.add_tree(path)
+        tornado.ioloop.IOLoop.current().add_handler(self.fd, self.handle_events, tornado.ioloop.IOLoop.READ)
+
+    def stop(self):
+        if self.fd is not None:
+            tornado.ioloop.IOLoop.current().remove_handler(self.fd)
+            os.close(self.fd)
+            self.fd = None
+            self.wds = {}
+
+    def read_events(self):
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(self.fd, 64 * 1024)
+            except OSError as osE:
+                if osE.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def handle_events(self, fd, events):
+        data = self.read_events()
+        changed = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                changed.append(OVERFLOW)
+                continue
+            directory = self.wds.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.wds[wd]
+                continue
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and not os.path.basename(path).startswith("."):
+                self.add_tree(path)
+            if path not in changed:
+                changed.append(path)
+        self.notify(changed)
+
+
+class PollingWatcher(Watcher):
+
+    def __init__(self, paths=None, interval=POLL_INTERVAL):
+        self.interval = interval
+        self.mtimes = {}
+        self.callback = None
+        super().__init__(paths)
+
+    def add(self, path):
+        path = super().add(path)
+        if self.callback is not None:
+            # Files already there when a path is added while polling are not changes
+            self.mtimes.update(self.scan_path(path))
+        return path
+
+    def scan_path(self, path):
+        found = {}
+        if os.path.isfile(path):
+            walk = [(os.path.dirname(path), [], [os.path.basename(path)])]
+        else:
+            walk = os.walk(path)
+        for root, dirs, files in walk:
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for f in files:
+                full = os.path.join(root, f)
+                try:
+                    st = os.stat(full)
+                except OSError:
+                    continue
+                found[full] = (st.st_mtime_ns, st.st_size)
+        return found
+
+    def scan(self):
+        found = {}
+        for path in self.paths:
+            found.update(self.scan_path(path))
+        return found
+
+    def poll(self):
+        found = self.scan()
+        changed = [p for p, stamp in found.items() if self.mtimes.get(p) != stamp]
+        changed.extend(p for p in self.mtimes if p not in found)
+        self.mtimes = found
+        self.notify(changed)
+
+    def start(self):
+        self.mtimes = self.scan()
+        self.callback = tornado.ioloop.PeriodicCallback(self.poll, self.interval * 1000)
+        self.callback.start()
+
+    def stop(self):
+        if self.callback is not None:
+            self.callback.stop()
+            self.callback = None
+
+
+def make_watcher(paths=None, interval=POLL_INTERVAL):
+    """Start and return the best watcher available on this platform"""
+    paths = [p for p in paths or [] if os.path.exists(p)]
+    try:
+        watcher = InotifyWatcher(paths)
+        watcher.start()
+        return watcher
+    except (OSError, AttributeError, TypeError) as E:
+        plog.LOG.info(f"inotify unavailable ({E}), polling for file changes every {interval}s")
+    watcher = PollingWatcher(paths, interval)
+    watcher.start()
+    return watcher
@@ -0,0 +1,174 @@
+"""
+Pre-fork worker processes for PeonServer.
+
+The parent binds the listening sockets once and then forks the workers, which
+inherit those sockets and each build their own application. The parent stays
+behind as a supervisor and restarts any worker that dies until it is told to
+shut down with SIGTERM or SIGINT, which it forwards to every worker. Workers
+still running after the shutdown timeout are killed. Given a reload function,
+SIGHUP calls it and stops the workers once it succeeded.
+"""
+import os
+import time
+import random
+import signal
+import traceback
+
+import peonserver.log as plog
+
+DEFAULT_MAX_RESTARTS = 100
+DEFAULT_RESTART_DELAY = 1.0
+DEFAULT_SHUTDOWN_TIMEOUT = 35.0
+
+WORKER_ID = None  # Set in each forked worker, None in the supervisor or a single process
+
+
+def cpu_count():
+    """Number of CPUs this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class WorkerPool():
+    """
+    Fork and supervise a fixed number of worker processes.
+
+    Usage: bind sockets, then call run(target) where target(worker_id) serves
+    forever. run() only returns in the supervising parent, once every worker
+    has exited after a shutdown signal.
+    """
+
+    def __init__(self, num_workers=None, **kwargs):
+        """
+        :Parameters:
+            - num_workers: number of processes to fork, cpu_count() if unset or < 1
+            - max_restarts: give up after this many unexpected worker exits, default 100
+            - restart_delay: seconds to wait before restarting a worker, default 1.0
+            - shutdown_timeout: seconds workers get to exit once stopped before they are killed, default 35.0
+            - logger: logging.getLogger(name), plog.LOG if unset
+            - reload: reload() -> bool called on SIGHUP, workers are stopped when it returns True
+            - started: started() called once the first workers were forked
+        """
+        self.num_workers = num_workers if num_workers and num_workers > 0 else cpu_count()
+        self.max_restarts = kwargs.get("max_restarts", DEFAULT_MAX_RESTARTS)
+        self.restart_delay = kwargs.get("restart_delay", DEFAULT_RESTART_DELAY)
+        self.shutdown_timeout = kwargs.get("shutdown_timeout", DEFAULT_SHUTDOWN_TIMEOUT)
+        self.log = kwargs.get("logger", plog.LOG)
+        self.reload_function = kwargs.get("reload")
+        self.started = kwargs.get("started")
+        self.children = {}
+        self.restarts = 0
+        self.stopping = False
+
+    def spawn(self, worker_id, target):
+        pid = os.fork()
+        if pid > 0:
+            self.children[pid] = worker_id
+            self.log.info(f"Started worker {worker_id} with pid {pid}")
+            return
+
+        # Worker process: never return into the supervisor's stack.
+        global WORKER_ID
+        WORKER_ID = worker_id
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)  # reloading is up to the supervisor
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)  # until the worker handles it itself
+        random.seed()
+        code = 0
+        try:
+            target(worker_id)
+        except SystemExit as sE:
+            code = sE.code if isinstance(sE.code, int) else 0
+        except BaseException as E:
+            self.log.error(f"Worker {worker_id} failed: {E}")
+            self.log.error(traceback.format_exc())
+            code = 1
+        finally:
+            plog.shutdown()
+            # Skip atexit handlers such as Daemon.delpid, those belong to the supervisor.
+            os._exit(code)
+
+    def stop(self, signum=signal.SIGTERM, frame=None):
+        """Stop restarting workers and forward the signal to all of them"""
+        if not self.stopping:
+            self.log.info(f"Supervisor received signal {signum}, stopping {len(self.children)} worker(s)")
+            if self.shutdown_timeout:
+                signal.signal(signal.SIGALRM, self.kill)
+                signal.setitimer(signal.ITIMER_REAL, self.shutdown_timeout)
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def kill(self, signum=signal.SIGALRM, frame=None):
+        """Kill the workers that did not exit within the shutdown timeout"""
+        if self.children:
+            self.log.warning(f"{len(self.children)} worker(s) still running after {self.shutdown_timeout:g}s, killing them")
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def forward(self, signum, frame=None):
+        """Pass a signal on to every worker"""
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def reload(self, signum=signal.SIGHUP, frame=None):
+        if self.stopping:
+            return
+        self.log.info("Supervisor received SIGHUP, reloading")
+        if self.reload_function():
+            self.stop()
+        else:
+            self.log.error("Reload failed, keeping the current workers")
+
+    def run(self, target):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if self.reload_function is not None:
+            signal.signal(signal.SIGHUP, self.reload)
+        signal.signal(signal.SIGUSR2, self.forward)  # profile every worker
+        self.log.info(f"Starting {self.num_workers} worker processes")
+        for worker_id in range(self.num_workers):
+            self.spawn(worker_id, target)
+        if self.started is not None:
+            self.started()
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            worker_id = self.children.pop(pid, None)
+            if worker_id is None:
+                continue
+
+            code = os.waitstatus_to_exitcode(status)
+            if self.stopping:
+                self.log.info(f"Worker {worker_id} (pid {pid}) exited with {code}")
+                continue
+
+            self.restarts += 1
+            if self.max_restarts is not None and self.restarts > self.max_restarts:
+                self.log.error(f"Workers restarted more than {self.max_restarts} times, giving up")
+                self.stop()
+                continue
+
+            self.log.warning(f"Worker {worker_id} (pid {pid}) died with {code}, restarting")
+            time.sleep(self.restart_delay)
+            if not self.stopping:
+                self.spawn(worker_id, target)
+
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        self.log.info("All workers exited")